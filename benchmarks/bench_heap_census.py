@@ -0,0 +1,80 @@
+"""Measure how long a heap census stalls the rest of the application
+
+A ticker thread, which wants to wake up every millisecond, records how often
+it managed to and the longest gap between its wakeups while the heap (padded
+out with a number of small objects) is counted, first the naive way in one go
+and then with ``bugger.heap.census``: by default, and counting untracked
+objects too as ``%heap`` does.  Walking the heap a chunk at a time takes
+several times longer in all, but ``%heap``'s census must stall the ticker for
+less than half of the naive count's longest gap, most of which is its single
+``gc.get_objects()`` call.
+
+Usage: python benchmarks/bench_heap_census.py [millions of objects]
+"""
+import collections
+import gc
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bugger import heap
+
+
+class Ticker(threading.Thread):
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.max_gap = 0.0
+        self.ticks = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        last = time.time()
+        while not self.stopped.is_set():
+            time.sleep(0.001)
+            now = time.time()
+            self.max_gap = max(self.max_gap, now - last)
+            self.ticks += 1
+            last = now
+
+
+def measure(fn):
+    ticker = Ticker()
+    ticker.start()
+    time.sleep(0.05)
+    ticker.ticks = 0
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    ticks = ticker.ticks
+    ticker.stopped.set()
+    ticker.join()
+    return elapsed, ticker.max_gap, ticks / elapsed
+
+
+def naive():
+    collections.Counter(type(o) for o in gc.get_objects())
+
+
+def main(argv):
+    millions = float(argv[1]) if len(argv) > 1 else 3
+    padding = [[i] for i in xrange(int(millions * 1000000))]
+    print "%d objects tracked" % len(gc.get_objects())
+    print "%-10s%12s%16s%14s" % ("", "total s", "longest stall s", "ticks/s")
+    print "%-10s%12s%16s%14.0f" % ("idle", "", "", measure(lambda: time.sleep(1))[2])
+    gaps = {}
+    for name, fn in (("naive", naive), ("census", heap.census),
+                     ("%heap", lambda: heap.census(untracked=True))):
+        elapsed, gaps[name], rate = measure(fn)
+        print "%-10s%12.3f%16.3f%14.0f" % (name, elapsed, gaps[name], rate)
+    del padding
+    assert gaps['%heap'] * 2 < gaps['naive'], \
+        "%%heap stalled for %.3fs, the naive count for %.3fs" % (gaps['%heap'], gaps['naive'])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
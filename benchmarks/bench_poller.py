@@ -0,0 +1,80 @@
+"""Measure the cost of a single wakeup as the number of idle sessions grows
+
+Each idle session is a connected socket pair registered for reading which
+never becomes ready.  For every backend we repeatedly make one extra socket
+readable, wait for it and drain it, reporting the mean cost of that wakeup.
+With ``select`` the cost grows with the number of registered sockets (and
+stops at FD_SETSIZE); with ``poll`` it grows more slowly; with ``epoll`` it
+stays flat.
+
+Usage: python benchmarks/bench_poller.py [iterations]
+"""
+import os
+import resource
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bugger import eventloop
+
+SESSION_COUNTS = [10, 100, 500, 1000, 4000]
+SELECT_LIMIT = 500 # each session uses two fds, stay clear of FD_SETSIZE (1024)
+
+
+def _raise_fd_limit(wanted):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        wanted = min(wanted, hard)
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def time_wakeups(poller_factory, idle_sessions, iterations):
+    poller = poller_factory()
+    pairs = [socket.socketpair() for _ in range(idle_sessions)]
+    try:
+        for a, _b in pairs:
+            poller.register(a.fileno(), eventloop.EVENT_READ)
+        active, peer = socket.socketpair()
+        pairs.append((active, peer))
+        poller.register(active.fileno(), eventloop.EVENT_READ)
+
+        start = time.time()
+        for _ in xrange(iterations):
+            peer.send('x')
+            poller.poll(1.0)
+            active.recv(1)
+        return (time.time() - start) / iterations
+    finally:
+        for a, b in pairs:
+            a.close()
+            b.close()
+        poller.close()
+
+
+def main(argv):
+    iterations = int(argv[1]) if len(argv) > 1 else 2000
+    fd_limit = _raise_fd_limit(max(SESSION_COUNTS) * 2 + 64)
+
+    backends = [('select', eventloop.SelectPoller)]
+    if hasattr(eventloop.select, 'poll'):
+        backends.append(('poll', eventloop.PollPoller))
+    if hasattr(eventloop.select, 'epoll'):
+        backends.append(('epoll', eventloop.EpollPoller))
+
+    print "%-8s" % "sessions" + "".join("%14s" % name for name, _ in backends)
+    for count in SESSION_COUNTS:
+        row = "%-8d" % count
+        for name, factory in backends:
+            if (name == 'select' and count > SELECT_LIMIT) or count * 2 + 16 > fd_limit:
+                row += "%14s" % "n/a"
+                continue
+            row += "%11.2f us" % (time_wakeups(factory, count, iterations) * 1e6)
+        print row
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,49 @@
+"""Show that console input handling stays linear in the size of a paste
+
+Feeds pastes of increasing size through ``StreamInteractiveConsole.async_recv``
+in socket sized pieces: one made of many short statements and one made of a
+single very long line (a large literal).  The time per megabyte should stay
+roughly constant as the paste grows.
+
+Usage: python benchmarks/bench_receive.py [chunk size]
+"""
+import os
+import StringIO
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bugger.console import StreamInteractiveConsole
+
+
+def many_lines(megabytes):
+    line = "x = 1\n"
+    return line * int(megabytes * 1048576 / len(line))
+
+
+def one_line(megabytes):
+    return "x = '%s'\n" % ('x' * int(megabytes * 1048576))
+
+
+def time_paste(paste, chunk_size):
+    console = StreamInteractiveConsole(StringIO.StringIO(), StringIO.StringIO(), {})
+    console.async_init()
+    start = time.time()
+    for offset in xrange(0, len(paste), chunk_size):
+        console.async_recv(paste[offset:offset + chunk_size])
+    return time.time() - start
+
+
+def main(argv):
+    chunk_size = int(argv[1]) if len(argv) > 1 else 1024
+    print "%-10s%18s%18s" % ("MB", "many lines s/MB", "one line s/MB")
+    for megabytes in (0.25, 0.5, 1, 2):
+        print "%-10g%18.3f%18.3f" % (
+            megabytes,
+            time_paste(many_lines(megabytes), chunk_size) / megabytes,
+            time_paste(one_line(megabytes), chunk_size) / megabytes)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
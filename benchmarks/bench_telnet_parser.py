@@ -0,0 +1,70 @@
+"""Measure the cost of stripping telnet commands from large pastes
+
+Feeds a multi-megabyte paste, sprinkled with option negotiation, through
+``_TelnetStream.sanitize_input`` in socket sized chunks and in one large
+buffer.  For comparison the previous implementation, which searched for and
+sliced out one command at a time, is timed on the same input; its cost grows
+quadratically with the number of commands in a buffer.
+
+Usage: python benchmarks/bench_telnet_parser.py [megabytes]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bugger.console import _TelnetStream, TELNET_COMMANDS, TELNET_OPTIONS
+
+IAC = chr(TELNET_COMMANDS.IAC)
+NEGOTIATION = IAC + chr(TELNET_COMMANDS.DO) + chr(TELNET_OPTIONS.ECHO)
+
+
+def legacy_sanitize_input(data):
+    while IAC in data:
+        iac_index = data.index(IAC)
+        if iac_index + 3 <= len(data):
+            data = data[:iac_index] + data[iac_index+3:]
+        else:
+            break
+    return data.replace('\r\n', '\n')
+
+
+def make_paste(megabytes, command_every=256):
+    line = "result.append(compute(%d, value) * 2)  # some pasted code\r\n"
+    chunks = []
+    size = 0
+    i = 0
+    while size < megabytes * 1024 * 1024:
+        chunk = line % i
+        if i % (command_every // len(chunk) + 1) == 0:
+            chunk += NEGOTIATION
+        chunks.append(chunk)
+        size += len(chunk)
+        i += 1
+    return ''.join(chunks)
+
+
+def time_it(fn, data, chunk_size):
+    start = time.time()
+    for offset in xrange(0, len(data), chunk_size):
+        fn(data[offset:offset + chunk_size])
+    return time.time() - start
+
+
+def main(argv):
+    megabytes = float(argv[1]) if len(argv) > 1 else 4
+    data = make_paste(megabytes)
+    print "%.1f MB paste, %d telnet commands" % (len(data) / 1048576.0, data.count(IAC))
+    print "%-12s%14s%14s" % ("chunk size", "incremental", "legacy")
+    for chunk_size in (1024, 65536, len(data)):
+        incremental = time_it(_TelnetStream(None).sanitize_input, data, chunk_size)
+        if chunk_size == len(data) and megabytes > 1:
+            legacy = "(too slow)"
+        else:
+            legacy = "%11.3f s" % time_it(legacy_sanitize_input, data, chunk_size)
+        print "%-12d%11.3f s%14s" % (chunk_size, incremental, legacy)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
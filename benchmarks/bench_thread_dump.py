@@ -0,0 +1,60 @@
+"""Compare ``%threads`` with formatting every thread's stack with ``traceback``
+
+Starts a number of threads blocked some way down a call stack, then times a
+dump of all of them with ``bugger.threads.ThreadDumper`` and with
+``traceback.format_stack`` (which stats every frame's source file each time).
+
+Usage: python benchmarks/bench_thread_dump.py [threads] [depth]
+"""
+import os
+import sys
+import threading
+import time
+import traceback
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bugger.threads import ThreadDumper
+
+
+def nest(depth, event):
+    if depth:
+        return nest(depth - 1, event)
+    event.wait()
+
+
+def naive_dump():
+    lines = []
+    for ident, frame in sys._current_frames().items():
+        lines.append("Thread %d" % ident)
+        lines.extend(traceback.format_stack(frame))
+    return lines
+
+
+def time_it(fn, repeat=20):
+    start = time.time()
+    for _ in xrange(repeat):
+        fn()
+    return (time.time() - start) / repeat
+
+
+def main(argv):
+    nthreads = int(argv[1]) if len(argv) > 1 else 100
+    depth = int(argv[2]) if len(argv) > 2 else 30
+    event = threading.Event()
+    threads = [threading.Thread(target=nest, args=(depth, event)) for _ in range(nthreads)]
+    for thread in threads:
+        thread.start()
+    try:
+        dumper = ThreadDumper()
+        print "%d threads, %d frames deep" % (nthreads, depth)
+        print "%-12s%10.2f ms" % ("traceback", 1000 * time_it(naive_dump))
+        print "%-12s%10.2f ms" % ("%threads", 1000 * time_it(lambda: list(dumper.iter_dump())))
+    finally:
+        event.set()
+        for thread in threads:
+            thread.join()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,204 @@
+"""Telnet interactive console served from an application's own asyncio loop
+
+For applications which already run an asyncio (or trollius) event loop, a
+``TelnetInteractiveConsoleServer`` blocking a thread of its own is awkward.
+``AsyncTelnetConsoleServer`` instead registers a listening server with the
+application's loop and handles every session with a protocol object on that
+loop.  Input is parsed exactly like the threaded server (``_TelnetStream`` and
+``StreamInteractiveConsole``), but the compiled input is executed in an
+executor so that long running commands do not stall the loop::
+
+    >>> # doctest: +SKIP
+    >>> import asyncio
+    >>> from bugger.aioconsole import AsyncTelnetConsoleServer
+    >>> loop = asyncio.get_event_loop()
+    >>> console_server = AsyncTelnetConsoleServer(port=7070, locals=locals())
+    >>> loop.run_until_complete(console_server.start(loop))
+    >>> loop.run_forever()
+
+"""
+import logging
+
+try:
+    import asyncio
+except ImportError: # python 2, fall back to the trollius backport if present
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+from bugger.console import StreamInteractiveConsole, _TelnetStream, \
+    _install_stream_routers, _routed_output
+
+logger = logging.getLogger(__name__)
+
+
+class _TransportStream(object):
+    """File-like object writing to an asyncio transport from any thread
+
+    Console code runs in executor threads, so writes are handed to the loop
+    with ``call_soon_threadsafe`` which also keeps them in order.
+    """
+
+    def __init__(self, loop, transport):
+        self.loop = loop
+        self.transport = transport
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.loop.call_soon_threadsafe(self._write, data)
+
+    def _write(self, data):
+        if not self.closed:
+            self.transport.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.transport.close)
+
+
+class _TelnetConsoleProtocol(object):
+    """asyncio protocol driving one ``StreamInteractiveConsole`` session
+
+    Chunks of input are executed one at a time, in the order they arrived, in
+    the server's executor.  Input arriving while a chunk is executing is
+    queued rather than blocking the loop.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.loop = server.loop
+        self.transport = None
+        self.stream = None
+        self.console = None
+        self._pending = []
+        self._running = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.stream = _TransportStream(self.loop, transport)
+        self.console = StreamInteractiveConsole(_TelnetStream(self.stream),
+                                                _TelnetStream(self.stream),
+                                                self.server.locals)
+        self.server.sessions.add(self)
+        self.console.async_init()
+        self.server.client_connect(transport)
+
+    def data_received(self, data):
+        data = self.console.input_stream.sanitize_input(data)
+        if len(data) == 0:
+            return
+        self._pending.append(data)
+        self._run_next()
+
+    def eof_received(self):
+        return False # let the transport close itself
+
+    def connection_lost(self, exc):
+        self.stream.closed = True
+        self.server.sessions.discard(self)
+        self.server.client_disconnect(self.transport)
+        self._pending = []
+
+    def _run_next(self):
+        if self._running or not self._pending:
+            return
+        self._running = True
+        data = self._pending.pop(0)
+        future = self.loop.run_in_executor(self.server.executor, self._execute, data)
+        future.add_done_callback(self._execute_done)
+
+    def _execute(self, data):
+        """Push input through the console (runs in an executor thread)"""
+        try:
+            with _routed_output(self.console.output_stream, self.console.displayhook):
+                self.console.async_recv(data)
+        except SystemExit:
+            return False
+        return True
+
+    def _execute_done(self, future):
+        self._running = False
+        try:
+            keep_open = future.result()
+        except Exception:
+            logger.exception('Cleaning up client')
+            keep_open = False
+        if not keep_open:
+            self._pending = []
+            self.transport.close()
+            return
+        self._run_next()
+
+
+class AsyncTelnetConsoleServer(object):
+    """Make an interactive console available via telnet from an asyncio loop"""
+
+    def __init__(self, host='0.0.0.0', port=7070, locals=None, executor=None, backlog=5):
+        """Create a new console server (the server is not started)
+
+        ``executor`` is the ``concurrent.futures`` executor in which console
+        input is executed; if not provided the loop's default executor is used.
+        """
+        if asyncio is None:
+            raise RuntimeError("AsyncTelnetConsoleServer requires asyncio (or trollius)")
+        self.host = host
+        self.port = port
+        self.locals = locals
+        self.executor = executor
+        self.backlog = backlog
+        self.loop = None
+        self.server = None
+        self.sessions = set()
+
+    def client_connect(self, transport):
+        """Called when a client successfully connected to the server
+
+        Might be overridden in subclasses.
+        transport is the asyncio transport of the client connection.
+        """
+        pass
+
+    def client_disconnect(self, transport):
+        """Called when a client has disconnected from the server
+
+        Might be overridden in subclasses.
+        transport is the asyncio transport of the client connection.
+        """
+        pass
+
+    def start(self, loop=None):
+        """Start listening on ``loop`` and return a future for the server
+
+        The future completes once the server is listening; run it with
+        ``loop.run_until_complete()`` or wait on it from a coroutine.
+        """
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        _install_stream_routers()
+        future = asyncio.ensure_future(
+            self.loop.create_server(lambda: _TelnetConsoleProtocol(self),
+                                    self.host, self.port, backlog=self.backlog),
+            loop=self.loop)
+        future.add_done_callback(self._started)
+        return future
+
+    def _started(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.server = future.result()
+
+    def stop(self):
+        """Stop listening and close every session
+
+        Must be called from the loop's thread.  Returns the server's
+        ``wait_closed()`` coroutine, or None if the server never started.
+        """
+        for session in list(self.sessions):
+            session.transport.close()
+        if self.server is None:
+            return None
+        self.server.close()
+        return self.server.wait_closed()
@@ -0,0 +1,340 @@
+"""Load generator and latency benchmark for the telnet console server
+
+Opens a number of concurrent loopback sessions against a console server and
+keeps each of them busy with a mix of commands: trivial evaluations, commands
+producing large output and large pastes.  The round trip of a command is
+timed from sending its first byte to receiving the prompt which follows its
+output.  Results, including the server's CPU time and memory use, are written
+as JSON so that runs against different releases can be compared::
+
+    python -m bugger.bench --sessions 50 --duration 10 --workers 4 > result.json
+
+By default a server is started in a child process for the run (so that its
+resource usage can be measured on its own); ``--target host:port`` benchmarks
+a server which is already running instead.
+"""
+import argparse
+import errno
+import json
+import math
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from bugger import eventloop
+from bugger.console import TelnetInteractiveConsoleServer
+
+PROMPT = ">>> "
+
+DEFAULT_MIX = {'trivial': 8, 'output': 1, 'paste': 1}
+
+
+def make_commands(output_size=100000, paste_size=65536):
+    """Return the source sent for each kind of command in the mix"""
+    return {
+        'trivial': "1 + 1\r\n",
+        'output': "print 'x' * %d\r\n" % output_size,
+        # one long line, so that the paste is answered by a single prompt
+        'paste': "len('%s')\r\n" % ('x' * paste_size),
+    }
+
+
+def percentile(values, pct):
+    """Return the ``pct`` percentile of ``values`` (nearest rank)"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(0, min(rank, len(values)) - 1)]
+
+
+def _summarize(latencies, elapsed):
+    return {
+        'commands': len(latencies),
+        'commands_per_s': len(latencies) / elapsed if elapsed else None,
+        'p50_ms': _ms(percentile(latencies, 50)),
+        'p99_ms': _ms(percentile(latencies, 99)),
+        'max_ms': _ms(max(latencies) if latencies else None),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000.0, 3)
+
+
+class _Session(object):
+    """State of one benchmark connection"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.kind = None # kind of the command in flight, None before the banner
+        self.outgoing = None # memoryview of what remains to be sent
+        self.started = None
+        self.tail = '' # end of the output received so far
+        self.received = 0
+        self.commands = 0
+
+
+class LoadGenerator(object):
+    """Drive ``sessions`` concurrent console sessions from a single event loop"""
+
+    def __init__(self, address, sessions=10, mix=None, commands=None, seed=0):
+        self.address = address
+        self.sessions = sessions
+        self.mix = sorted((mix or DEFAULT_MIX).items())
+        self.commands = commands or make_commands()
+        self._random = random.Random(seed)
+        self._total_weight = sum(weight for _kind, weight in self.mix)
+        self.latencies = dict((kind, []) for kind, _weight in self.mix)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def _choose(self):
+        value = self._random.uniform(0, self._total_weight)
+        for kind, weight in self.mix:
+            value -= weight
+            if value <= 0:
+                break
+        return kind
+
+    def run(self, duration=None, commands_per_session=None):
+        """Run until ``duration`` seconds passed or each session ran its commands
+
+        Returns the time spent running commands (not connecting).
+        """
+        poller = eventloop.default_poller()
+        fd_to_session = {}
+        try:
+            for _ in range(self.sessions):
+                sock = socket.create_connection(self.address, 10.0)
+                sock.setblocking(0)
+                session = _Session(sock)
+                fd_to_session[sock.fileno()] = session
+                poller.register(sock.fileno(), eventloop.EVENT_READ)
+
+            # wait for every banner before timing anything
+            waiting = len(fd_to_session)
+            while waiting:
+                for fd, events in poller.poll(10.0):
+                    if self._receive(fd_to_session[fd]):
+                        waiting -= 1
+
+            start = time.time()
+            deadline = start + duration if duration is not None else None
+            active = set()
+            for session in fd_to_session.values():
+                self._send_next(poller, session)
+                active.add(session)
+            while active:
+                for fd, events in poller.poll(10.0):
+                    session = fd_to_session[fd]
+                    if events & eventloop.EVENT_WRITE:
+                        self._send(poller, session)
+                    if events & eventloop.EVENT_READ and self._receive(session):
+                        now = time.time()
+                        self.latencies[session.kind].append(now - session.started)
+                        session.commands += 1
+                        if (deadline is not None and now >= deadline) or \
+                                (commands_per_session is not None and
+                                 session.commands >= commands_per_session):
+                            active.discard(session)
+                        else:
+                            self._send_next(poller, session)
+            return time.time() - start
+        finally:
+            for session in fd_to_session.values():
+                session.sock.close()
+            poller.close()
+
+    def _send_next(self, poller, session):
+        session.kind = self._choose()
+        session.outgoing = memoryview(self.commands[session.kind])
+        session.started = time.time()
+        session.tail = ''
+        session.received = 0
+        self._send(poller, session)
+
+    def _send(self, poller, session):
+        try:
+            sent = session.sock.send(session.outgoing)
+        except socket.error as err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            sent = 0
+        self.bytes_sent += sent
+        session.outgoing = session.outgoing[sent:]
+        if session.outgoing:
+            poller.modify(session.sock.fileno(), eventloop.EVENT_READ | eventloop.EVENT_WRITE)
+        else:
+            poller.modify(session.sock.fileno(), eventloop.EVENT_READ)
+
+    def _receive(self, session):
+        """Read what is waiting, returning True once the prompt arrived"""
+        try:
+            data = session.sock.recv(65536)
+        except socket.error as err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        if not data:
+            raise EOFError("server closed a benchmark session")
+        self.bytes_received += len(data)
+        session.received += len(data)
+        session.tail = (session.tail + data)[-len(PROMPT):]
+        return session.tail == PROMPT and not session.outgoing
+
+
+#===============================================================================
+# Benchmark Server
+#
+# The server under test runs in a child process so that its CPU time and peak
+# RSS can be taken from the rusage reported when it exits.
+#===============================================================================
+def serve(port=0, workers=0, backlog=128):
+    """Run a console server until SIGTERM, printing its port once listening"""
+    server = TelnetInteractiveConsoleServer(host='127.0.0.1', port=port, locals={},
+                                            workers=workers, backlog=backlog)
+    server.listen()
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    sys.stdout.write("%d\n" % server.server_sock.getsockname()[1])
+    sys.stdout.flush()
+    server.accept_interactions()
+
+
+def _start_server(workers):
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+    process = subprocess.Popen([sys.executable, '-m', 'bugger.bench', '--serve',
+                                '--workers', str(workers)],
+                               stdout=subprocess.PIPE, env=env)
+    port = int(process.stdout.readline())
+    return process, ('127.0.0.1', port)
+
+
+def _stop_server(process):
+    """Stop the server and return its resource usage"""
+    process.send_signal(signal.SIGTERM)
+    _pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = status
+    process.stdout.close()
+    # ru_maxrss is in kilobytes on linux, bytes on OS X
+    max_rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return {
+        'cpu_user_s': round(usage.ru_utime, 3),
+        'cpu_system_s': round(usage.ru_stime, 3),
+        'max_rss_bytes': max_rss,
+    }
+
+
+def run(sessions=10, duration=5.0, commands_per_session=None, mix=None,
+        workers=0, target=None, output_size=100000, paste_size=65536, seed=0):
+    """Run the benchmark and return its results as a dict
+
+    Unless ``target`` (a ``(host, port)`` tuple) is provided, a server with
+    ``workers`` worker threads is started for the run.
+    """
+    process = None
+    if target is None:
+        process, address = _start_server(workers)
+    else:
+        address = target
+    server_usage = None
+    try:
+        generator = LoadGenerator(address, sessions, mix,
+                                  make_commands(output_size, paste_size), seed)
+        elapsed = generator.run(duration, commands_per_session)
+    finally:
+        if process is not None:
+            server_usage = _stop_server(process)
+
+    all_latencies = [l for latencies in generator.latencies.values() for l in latencies]
+    result = {
+        'config': {
+            'sessions': sessions,
+            'duration': duration,
+            'commands_per_session': commands_per_session,
+            'mix': dict(generator.mix),
+            'workers': workers if target is None else None,
+            'output_size': output_size,
+            'paste_size': paste_size,
+            'python': sys.version.split()[0],
+        },
+        'elapsed_s': round(elapsed, 3),
+        'bytes_sent': generator.bytes_sent,
+        'bytes_received': generator.bytes_received,
+        'latency': _summarize(all_latencies, elapsed),
+        'by_kind': dict((kind, _summarize(latencies, elapsed))
+                        for kind, latencies in generator.latencies.items()),
+        'server': server_usage,
+    }
+    if server_usage is not None and all_latencies:
+        server_usage['cpu_per_command_ms'] = _ms(
+            (server_usage['cpu_user_s'] + server_usage['cpu_system_s']) / len(all_latencies))
+    return result
+
+
+def _parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError("unknown command kind %r" % kind)
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def _parse_target(value):
+    host, _, port = value.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bugger.bench',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('--sessions', type=int, default=10,
+                        help="concurrent sessions (default: %(default)s)")
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help="seconds to run for (default: %(default)s)")
+    parser.add_argument('--commands', type=int, default=None,
+                        help="commands per session, instead of --duration")
+    parser.add_argument('--mix', type=_parse_mix, default=None,
+                        help="weights of each kind of command "
+                        "(default: trivial=8,output=1,paste=1)")
+    parser.add_argument('--output-size', type=int, default=100000,
+                        help="bytes printed by output commands (default: %(default)s)")
+    parser.add_argument('--paste-size', type=int, default=65536,
+                        help="size of pasted literals (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="worker threads of the server started for the run")
+    parser.add_argument('--target', type=_parse_target, default=None,
+                        help="host:port of a running server to benchmark instead")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="write JSON here, not stdout")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(workers=args.workers)
+        return
+
+    result = run(sessions=args.sessions,
+                 duration=args.duration if args.commands is None else None,
+                 commands_per_session=args.commands, mix=args.mix,
+                 workers=args.workers, target=args.target,
+                 output_size=args.output_size, paste_size=args.paste_size,
+                 seed=args.seed)
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output is None:
+        print output
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+"""Scripted access to consoles over the JSON lines protocol
+
+Ops tooling talks to a console server through its JSON protocol (see
+``bugger.console.JsonConsole``) rather than scraping telnet prompts::
+
+    from bugger.client import ConnectionPool, fan_out
+
+    pool = ConnectionPool(('app-host', 7071))
+    pool.eval("len(sys.modules)")             # -> '245', the repr of the result
+    pool.exec_("import gc; gc.collect()")     # -> what it printed
+
+    fan_out([('app-host', 7071), ('app-host', 7072)], "os.getpid()", timeout=2.0)
+
+Addresses are ``(host, port)`` tuples, or paths of Unix domain sockets.  A
+server's JSON port is used directly; for its telnet port, pass
+``handshake=True`` to switch the session over with ``%json``.
+
+``ConnectionPool`` keeps connections open between calls.  They are checked
+before being used again, so a connection closed by the server (say, after an
+idle timeout, or a restart) is replaced by a new one instead of failing the
+call, and TCP keepalive is turned on so that dead peers are noticed.
+"""
+import json
+import select
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+
+class ClientError(Exception):
+    """The connection to a console failed or its response made no sense"""
+
+
+class SendError(ClientError):
+    """Nothing of a request could be sent, so the console can't have run it"""
+
+
+class RemoteError(Exception):
+    """The code sent to the console raised an exception there
+
+    ``type``, ``message`` and ``traceback`` describe it and ``response`` is
+    the whole response.
+    """
+
+    def __init__(self, response):
+        error = response.get('error') or {}
+        Exception.__init__(self, "%s: %s" % (error.get('type'), error.get('message')))
+        self.response = response
+        self.type = error.get('type')
+        self.message = error.get('message')
+        self.traceback = error.get('traceback')
+
+
+def _connect(address, timeout, keepalive):
+    if isinstance(address, basestring):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(address)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+    sock = socket.create_connection(address, timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if keepalive is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'): # linux
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(keepalive)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(keepalive)))
+    return sock
+
+
+class Connection(object):
+    """A JSON protocol session with one console
+
+    ``timeout`` applies to connecting and to waiting for each response.
+    ``keepalive`` is the idle time, in seconds, after which TCP keepalive
+    probes start (None to leave keepalive off).
+    """
+
+    def __init__(self, address, timeout=10.0, handshake=False, keepalive=60.0):
+        self.address = address
+        self.timeout = timeout
+        self.sock = _connect(address, timeout, keepalive)
+        self._buffer = bytearray() # received, not yet returned by _readline
+        self._scanned = 0 # bytes of the buffer known not to hold a line ending
+        self._next_id = 0
+        self.last_used = time.time()
+        try:
+            if handshake:
+                self.sock.sendall("%json\r\n")
+            self.hello = self._read_hello()
+        except Exception:
+            self.close()
+            raise
+        self.pid = self.hello.get('pid')
+
+    def _read_hello(self):
+        # after a handshake, skip the telnet banner and prompt before the hello
+        while True:
+            line = self._readline()
+            start = line.find('{"')
+            if start < 0:
+                continue
+            hello = json.loads(line[start:])
+            if hello.get('protocol') != 'bugger-json':
+                raise ClientError("not a bugger console: %r" % line)
+            return hello
+
+    def _readline(self):
+        buf = self._buffer
+        end = buf.find('\n', self._scanned)
+        while end < 0:
+            self._scanned = len(buf)
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                raise ClientError("timed out waiting for %r" % (self.address,))
+            if not data:
+                raise ClientError("connection to %r closed" % (self.address,))
+            buf += data
+            end = buf.find('\n', self._scanned)
+        line = str(buf[:end + 1])
+        del buf[:end + 1]
+        self._scanned = 0
+        return line
+
+    def _send(self, data):
+        sent = 0
+        while sent < len(data):
+            try:
+                sent += self.sock.send(buffer(data, sent))
+            except socket.error as err:
+                if sent:
+                    raise # the console may have got (and run) some of it
+                raise SendError("sending to %r failed: %s" % (self.address, err))
+
+    def pipeline(self, requests, timeout=None):
+        """Send many ``(op, source)`` requests at once, returning their responses"""
+        ids = []
+        lines = []
+        for op, source in requests:
+            self._next_id += 1
+            ids.append(self._next_id)
+            lines.append(json.dumps({'id': self._next_id, 'op': op, 'source': source}) + '\n')
+        self.sock.settimeout(timeout if timeout is not None else self.timeout)
+        self._send(''.join(lines))
+        responses = []
+        for request_id in ids:
+            response = json.loads(self._readline())
+            if response.get('id') != request_id:
+                raise ClientError("response %r out of order, expected %r" %
+                                  (response.get('id'), request_id))
+            responses.append(response)
+        self.last_used = time.time()
+        return responses
+
+    def request(self, op, source, timeout=None):
+        """Run ``source`` and return the response (a dict, see ``JsonConsole``)"""
+        return self.pipeline([(op, source)], timeout)[0]
+
+    def eval(self, source, timeout=None):
+        """Evaluate an expression, returning the repr of its value
+
+        Raises ``RemoteError`` if it raised an exception.
+        """
+        response = self.request('eval', source, timeout)
+        if not response['ok']:
+            raise RemoteError(response)
+        return response['result']
+
+    def exec_(self, source, timeout=None):
+        """Execute statements, returning what they printed
+
+        Raises ``RemoteError`` if they raised an exception.
+        """
+        response = self.request('exec', source, timeout)
+        if not response['ok']:
+            raise RemoteError(response)
+        return response['stdout']
+
+    def is_stale(self):
+        """True if the server closed the connection (or sent something unasked)"""
+        if self._buffer:
+            return True
+        try:
+            if hasattr(select, 'poll'): # select() fails for descriptors past FD_SETSIZE
+                poller = select.poll()
+                poller.register(self.sock, select.POLLIN)
+                return bool(poller.poll(0)) # readable, or hung up
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class ConnectionPool(object):
+    """Connections to one console, reused between calls
+
+    At most ``size`` connections are open at once; callers beyond that wait
+    for one to be free.  A connection which has been idle is checked before
+    it is used again and replaced if the server closed it.  A call which
+    fails to send its request on a reused connection is retried once on a
+    new one (the server can't have run it); a call which fails later is not,
+    since the server may have run it.
+    """
+
+    def __init__(self, address, size=4, timeout=10.0, handshake=False, keepalive=60.0):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self.handshake = handshake
+        self.keepalive = keepalive
+        self._idle = [] # most recently used last
+        self._open = 0
+        self._condition = threading.Condition(threading.Lock())
+        self.connects = 0
+        self.pid = None # of the console, once connected
+
+    def _acquire(self):
+        with self._condition:
+            while True:
+                while self._idle:
+                    connection = self._idle.pop()
+                    if not connection.is_stale():
+                        return connection
+                    connection.close()
+                    self._open -= 1
+                if self._open < self.size:
+                    self._open += 1
+                    break
+                self._condition.wait()
+        try:
+            return self._connect()
+        except Exception:
+            self._discard(None)
+            raise
+
+    def _connect(self):
+        connection = Connection(self.address, self.timeout, self.handshake, self.keepalive)
+        self.connects += 1
+        self.pid = connection.pid
+        return connection
+
+    def _release(self, connection):
+        with self._condition:
+            self._idle.append(connection)
+            self._condition.notify()
+
+    def _discard(self, connection):
+        if connection is not None:
+            connection.close()
+        with self._condition:
+            self._open -= 1
+            self._condition.notify()
+
+    def pipeline(self, requests, timeout=None):
+        """Like ``Connection.pipeline``, on a pooled connection"""
+        connection = self._acquire()
+        reused = connection._next_id > 0
+        try:
+            try:
+                responses = connection.pipeline(requests, timeout)
+            except SendError:
+                if not reused:
+                    raise
+                # the request never got to the server, try again on a new connection
+                connection.close()
+                connection = self._connect()
+                responses = connection.pipeline(requests, timeout)
+        except Exception:
+            self._discard(connection)
+            raise
+        self._release(connection)
+        return responses
+
+    def request(self, op, source, timeout=None):
+        return self.pipeline([(op, source)], timeout)[0]
+
+    def eval(self, source, timeout=None):
+        """Evaluate an expression, returning the repr of its value"""
+        response = self.request('eval', source, timeout)
+        if not response['ok']:
+            raise RemoteError(response)
+        return response['result']
+
+    def exec_(self, source, timeout=None):
+        """Execute statements, returning what they printed"""
+        response = self.request('exec', source, timeout)
+        if not response['ok']:
+            raise RemoteError(response)
+        return response['stdout']
+
+    def close(self):
+        """Close the idle connections (those in use are closed when released)"""
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for connection in idle:
+            connection.close()
+
+
+def _error_response(err_type, message):
+    return {'id': None, 'ok': False, 'error': {'type': err_type, 'message': message}}
+
+
+def fan_out(targets, source, op='eval', timeout=5.0, pools=None, handshake=False):
+    """Run ``source`` on every target at once, returning the responses by target
+
+    Each target gets ``timeout`` seconds to connect and answer; those which
+    don't (or can't be reached) get a response with an error of type
+    'Timeout' or 'ConnectionError' instead, so the result always has an
+    entry for every target, in order.  ``pools``, a dict of address to
+    ``ConnectionPool``, is used (and filled in) to reuse connections between
+    calls.
+    """
+    if pools is None:
+        pools = {}
+    for target in targets:
+        if target not in pools:
+            pools[target] = ConnectionPool(target, timeout=timeout, handshake=handshake)
+    results = OrderedDict((target, None) for target in targets)
+
+    def run(target):
+        try:
+            results[target] = pools[target].request(op, source, timeout)
+        except ClientError as err:
+            kind = 'Timeout' if 'timed out' in str(err) else 'ConnectionError'
+            results[target] = _error_response(kind, str(err))
+        except socket.timeout:
+            results[target] = _error_response('Timeout', "timed out connecting")
+        except (socket.error, ValueError, EnvironmentError) as err:
+            results[target] = _error_response('ConnectionError', str(err))
+
+    threads = []
+    for target in targets:
+        thread = threading.Thread(target=run, args=(target,), name='bugger-fan-out')
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    deadline = time.time() + timeout
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.time()) + 0.1)
+    # a copy, since threads which overran may still fill in their entry
+    answered = OrderedDict()
+    for target in targets:
+        response = results[target]
+        if response is None:
+            response = _error_response('Timeout', "no answer in %.1f seconds" % timeout)
+        answered[target] = response
+    return answered
@@ -0,0 +1,250 @@
+"""Completion of python names and attributes, for TAB in the telnet console
+
+``Completer`` follows the semantics of the standard library's ``rlcompleter``:
+a plain word completes to keywords, names in the namespace and builtins;
+``expr.word`` completes to the attributes of ``expr`` (and of its class and
+base classes); callables get a ``(`` appended.  It does not need readline
+and ``expr`` is only ever a dotted name, which is looked up rather than
+evaluated.
+
+Listing the attributes of an object with ``dir()`` and sorting them is what
+takes the time on large modules and objects, so the sorted names are kept in
+an ``AttributeIndex``, shared by every completer, and searched with bisect.
+An entry is used again while the sizes of the object's ``__dict__`` and its
+class's ``__dict__`` are unchanged and it is younger than ``ttl`` seconds (the
+sizes catch names being added and removed, the age catches the rest).  The
+names in a completer's namespace and the builtins are indexed the same way.
+"""
+import __builtin__
+import bisect
+import collections
+import keyword
+import re
+import threading
+import time
+import weakref
+from types import ModuleType
+
+KEYWORDS = sorted(keyword.kwlist)
+
+_ATTRIBUTE_TEXT = re.compile(r"(\w+(\.\w+)*)\.(\w*)$")
+
+
+def _prefix_range(names, prefix):
+    """Return the slice of sorted ``names`` starting with ``prefix``"""
+    if not prefix:
+        return 0, len(names)
+    start = bisect.bisect_left(names, prefix)
+    # the prefix is made of word characters, so this is the first name past it
+    after = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return start, bisect.bisect_left(names, after, start)
+
+
+def _common_prefix(first, last):
+    """Return the common prefix of the first and last of some sorted names"""
+    size = min(len(first), len(last))
+    i = 0
+    while i < size and first[i] == last[i]:
+        i += 1
+    return first[:i]
+
+
+def _class_members(cls):
+    names = dir(cls)
+    for base in getattr(cls, '__bases__', ()):
+        names.extend(_class_members(base))
+    return names
+
+
+def _attribute_names(obj):
+    names = set(dir(obj))
+    names.discard('__builtins__')
+    if hasattr(obj, '__class__'):
+        names.add('__class__')
+        names.update(_class_members(obj.__class__))
+    return sorted(name for name in names if isinstance(name, basestring))
+
+
+def _version(obj):
+    """Cheap fingerprint of an object's attributes: the sizes of its dicts"""
+    try:
+        size = len(obj.__dict__)
+    except Exception:
+        size = None
+    try:
+        class_size = len(type(obj).__dict__)
+    except Exception:
+        class_size = None
+    return size, class_size
+
+
+class AttributeIndex(object):
+    """Sorted attribute names of objects, cached with invalidation
+
+    At most ``maxsize`` objects are indexed, least recently used first out.
+    Objects are held by weak reference, except for modules (which can't be,
+    and are kept alive by ``sys.modules`` anyway); others which can't be (such
+    as instances of most builtin types) are listed afresh each time.
+    """
+
+    def __init__(self, maxsize=256, ttl=5.0, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = collections.OrderedDict() # id -> (ref, version, expires, names)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def names(self, obj):
+        """Return the sorted attribute names of ``obj``"""
+        key = id(obj)
+        version = _version(obj)
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                ref, entry_version, expires, names = entry
+                if ref() is obj and entry_version == version and now < expires:
+                    self._entries[key] = entry # most recently used
+                    self.hits += 1
+                    return names
+            self.misses += 1
+        names = _attribute_names(obj)
+        if isinstance(obj, ModuleType):
+            ref = lambda: obj
+        else:
+            try:
+                ref = weakref.ref(obj)
+            except TypeError:
+                return names
+        with self._lock:
+            self._entries[key] = (ref, version, now + self.ttl, names)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return names
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+attribute_index = AttributeIndex() # shared by completers unless given their own
+
+
+class Completions(object):
+    """Result of ``Completer.complete``
+
+    ``matches`` are the first completions, in order, of ``total``; ``prefix``
+    is what all of them start with (the whole completion if there is just
+    one), which the text being completed can be extended to.
+    """
+
+    def __init__(self, matches, total, prefix):
+        self.matches = matches
+        self.total = total
+        self.prefix = prefix
+
+
+class Completer(object):
+    """Complete names in ``namespace``, like ``rlcompleter.Completer``"""
+
+    def __init__(self, namespace, index=None, ttl=5.0, clock=time.time):
+        self.namespace = namespace
+        self.index = index if index is not None else attribute_index
+        self.ttl = ttl
+        self.clock = clock
+        self._keys = {} # id of a dict -> (dict, size, expires, sorted keys)
+
+    def complete(self, text, limit=100):
+        """Return the ``Completions`` of ``text``, with at most ``limit`` matches"""
+        if '.' in text:
+            return self.attr_matches(text, limit)
+        return self.global_matches(text, limit)
+
+    def global_matches(self, text, limit=100):
+        """Complete keywords, names in the namespace and builtins"""
+        candidates = []
+        for names, namespace in ((KEYWORDS, None),
+                                 (self._sorted_keys(self.namespace), self.namespace),
+                                 (self._sorted_keys(__builtin__.__dict__), __builtin__.__dict__)):
+            start, end = _prefix_range(names, text)
+            candidates.extend((name, namespace) for name in names[start:end]
+                              if name != '__builtins__')
+        if not candidates:
+            return Completions([], 0, text)
+        # a name is completed from the first place it is found in
+        seen = {}
+        for name, namespace in candidates:
+            seen.setdefault(name, namespace)
+        names = sorted(seen)
+        matches = []
+        for name in names[:limit]:
+            namespace = seen[name]
+            if namespace is None:
+                matches.append(name)
+            elif name in namespace: # unless removed since it was indexed
+                matches.append(self._callable_postfix(namespace[name], name))
+        if len(names) > 1:
+            prefix = _common_prefix(names[0], names[-1])
+        else: # the name itself, unless removed since it was indexed
+            prefix = matches[0] if matches else text
+        return Completions(matches, len(names), prefix)
+
+    def attr_matches(self, text, limit=100):
+        """Complete ``expr.word`` to the attributes of the dotted name ``expr``"""
+        match = _ATTRIBUTE_TEXT.match(text)
+        if match is None:
+            return Completions([], 0, text)
+        expr, attr = match.group(1, 3)
+        try:
+            obj = self._lookup(expr)
+            names = self.index.names(obj)
+        except Exception: # no such object, or a broken __dir__
+            return Completions([], 0, text)
+        start, end = _prefix_range(names, attr)
+        matches = []
+        for name in names[start:end]:
+            if len(matches) >= limit:
+                break
+            try:
+                value = getattr(obj, name)
+            except Exception: # listed, but not really there
+                continue
+            matches.append(self._callable_postfix(value, "%s.%s" % (expr, name)))
+        total = end - start
+        if not total:
+            return Completions([], 0, text)
+        if total == 1:
+            prefix = matches[0] if matches else text
+        else:
+            prefix = "%s.%s" % (expr, _common_prefix(names[start], names[end - 1]))
+        return Completions(matches, total, prefix)
+
+    def _lookup(self, expr):
+        parts = expr.split('.')
+        if parts[0] in self.namespace:
+            obj = self.namespace[parts[0]]
+        else:
+            obj = __builtin__.__dict__[parts[0]]
+        for part in parts[1:]:
+            obj = getattr(obj, part)
+        return obj
+
+    def _sorted_keys(self, namespace):
+        now = self.clock()
+        entry = self._keys.get(id(namespace))
+        if entry is not None and entry[0] is namespace and entry[1] == len(namespace) \
+                and now < entry[2]:
+            return entry[3]
+        names = sorted(name for name in namespace.keys() if isinstance(name, basestring))
+        self._keys[id(namespace)] = (namespace, len(namespace), now + self.ttl, names)
+        return names
+
+    def _callable_postfix(self, value, word):
+        if hasattr(value, '__call__'):
+            word += '('
+        return word
@@ -2,15 +2,33 @@
 
 
 """
+import __builtin__
 import code
-import select
+import codeop
+import collections
+import cProfile
+import errno
+import json
+import os
+import re
 import socket
+import stat
 import sys
 import logging
+import threading
+import time
+import traceback
+import Queue
 from contextlib import contextmanager
 
+from bugger import completion
+from bugger import eventloop
+from bugger import heap
+from bugger import profiling
+from bugger import threads
+from bugger.display import iter_repr
+
 _stdout = sys.stdout
-_stderr = sys.stderr
 
 DEBUG_TELNET_OPTIONS = False
 
@@ -29,6 +47,9 @@ logger = logging.getLogger(__name__)
 # +-----+-------------------+--------+
 #===============================================================================
 class TELNET_COMMANDS(object):
+    EOF = 236 # RFC 1184
+    SUSP = 237
+    ABORT = 238
     SE = 240
     NOP = 241
     DM = 242
@@ -58,8 +79,336 @@ class TELNET_OPTIONS(object):
     LINEMODE = 34 # RFC 1184
     ENVIRONMENT_VARIABLES = 36 # RFC 1408
 
+class TELNET_LINEMODE(object):
+    # suboptions (IAC SB LINEMODE <suboption> ... IAC SE)
+    MODE = 1
+    FORWARDMASK = 2
+    SLC = 3
+    # bits of the mode
+    EDIT = 1
+    TRAPSIG = 2
+    MODE_ACK = 4
+
+#===============================================================================
+# Command Execution
+#
+# Console input is executed either inline by the server loop or, so that one
+# slow command does not hold up every other session, on a pool of worker
+# threads.  Output from the console (print statements, the display hook,
+# tracebacks) has to reach the session which ran the command while output
+# from the rest of the application keeps going to the real stdout/stderr,
+# even with several commands running at once.  Rather than swapping
+# sys.stdout for every command, sys.stdout and sys.stderr are replaced once by
+# routers which forward writes to the stream bound to the current thread,
+# falling back to the original stream.  sys.displayhook is routed the same
+# way, so that each console can display results its own way.
+#===============================================================================
+class _StreamRouter(object):
+    """File-like object forwarding to the stream bound to the current thread
+
+    Threads which have not bound a stream write to ``default``.
+    """
+
+    def __init__(self, default):
+        self.default = default
+        self._local = threading.local()
+
+    def bind(self, stream):
+        """Route this thread's output to ``stream``, returning the previous binding"""
+        previous = getattr(self._local, 'stream', None)
+        self._local.stream = stream
+        return previous
+
+    def _target(self):
+        stream = getattr(self._local, 'stream', None)
+        if stream is None:
+            return self.default
+        return stream
+
+    def _get_softspace(self):
+        return getattr(self._target(), 'softspace', 0)
+
+    def _set_softspace(self, value):
+        try:
+            self._target().softspace = value
+        except AttributeError:
+            pass
+
+    softspace = property(_get_softspace, _set_softspace)
+
+    def write(self, data):
+        self._target().write(data)
+
+    def __getattr__(self, attr):
+        return getattr(self._target(), attr)
+
+class _DisplayHookRouter(object):
+    """Display hook calling the hook bound to the current thread (or ``default``)"""
+
+    def __init__(self, default):
+        self.default = default
+        self._local = threading.local()
+
+    def bind(self, hook):
+        """Use ``hook`` for this thread, returning the previous binding"""
+        previous = getattr(self._local, 'hook', None)
+        self._local.hook = hook
+        return previous
+
+    def __call__(self, value):
+        hook = getattr(self._local, 'hook', None)
+        if hook is None:
+            hook = self.default
+        hook(value)
+
+_install_lock = threading.Lock()
+
+def _install_stream_routers():
+    """Replace sys.stdout and sys.stderr with routers (if not already done)
+
+    This is done when a server starts; it is repeated (cheaply) for every
+    command in case the application has since replaced sys.stdout/sys.stderr
+    itself, in which case the application's stream becomes the default.
+    """
+    if (isinstance(sys.stdout, _StreamRouter) and isinstance(sys.stderr, _StreamRouter)
+            and isinstance(sys.displayhook, _DisplayHookRouter)):
+        return
+    with _install_lock:
+        if not isinstance(sys.stdout, _StreamRouter):
+            sys.stdout = _StreamRouter(sys.stdout)
+        if not isinstance(sys.stderr, _StreamRouter):
+            sys.stderr = _StreamRouter(sys.stderr)
+        if not isinstance(sys.displayhook, _DisplayHookRouter):
+            sys.displayhook = _DisplayHookRouter(sys.displayhook)
+
+@contextmanager
+def _routed_output(stream, displayhook=None):
+    """Route this thread's sys.stdout and sys.stderr output to ``stream``
+
+    If provided, ``displayhook`` is used in place of sys.displayhook as well.
+    """
+    _install_stream_routers()
+    stdout, stderr, hook_router = sys.stdout, sys.stderr, sys.displayhook
+    previous_stdout = stdout.bind(stream)
+    previous_stderr = stderr.bind(stream)
+    previous_hook = hook_router.bind(displayhook)
+    try:
+        yield
+    finally:
+        stdout.bind(previous_stdout)
+        stderr.bind(previous_stderr)
+        hook_router.bind(previous_hook)
+
+class _WorkerPool(object):
+    """Bounded pool of threads executing work on behalf of sessions
+
+    Work is submitted along with a session key.  Work for one session runs one
+    item at a time, in the order submitted, while different sessions run
+    concurrently on up to ``size`` threads.
+    """
+
+    def __init__(self, size, name='bugger-console-worker'):
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = {} # session key -> deque of work, present while busy
+        self._threads = []
+        for i in range(size):
+            thread = threading.Thread(name='%s-%d' % (name, i), target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, fn, *args):
+        """Run ``fn(*args)`` after all previously submitted work for ``key``"""
+        with self._lock:
+            if key in self._pending:
+                self._pending[key].append((fn, args))
+                return
+            self._pending[key] = collections.deque()
+        self._queue.put((key, fn, args))
+
+    def busy(self, key):
+        """Return True if work for ``key`` is running or waiting to run"""
+        with self._lock:
+            return key in self._pending
+
+    def discard(self, key):
+        """Drop any work for ``key`` which has not yet started"""
+        with self._lock:
+            if key in self._pending:
+                self._pending[key].clear()
+
+    def shutdown(self, wait=True):
+        """Stop the worker threads once they finish their current work"""
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            key, fn, args = item
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception('Unexpected error in console worker')
+            with self._lock:
+                pending = self._pending[key]
+                if pending:
+                    fn, args = pending.popleft()
+                    self._queue.put((key, fn, args))
+                else:
+                    del self._pending[key]
+
+
+def _complete_lines(buf, data):
+    """Return the complete lines in the input pending in ``buf`` plus ``data``
+
+    ``buf`` is a bytearray, left holding the partial line at the end of the
+    input, if any; None is returned when there is no complete line yet.  Only
+    ``data`` is scanned for a line ending.  When nothing is pending, ``data``
+    is split as it is; otherwise the complete lines are copied out of ``buf``
+    in one piece and split from that copy.
+    """
+    if not buf: # the usual case, input arriving a whole line at a time
+        lines = data.split('\n')
+        buf += lines.pop()
+        return lines or None
+    scan_start = len(buf)
+    buf += data
+    lines_end = buf.rfind('\n', scan_start)
+    if lines_end < 0:
+        return None
+    lines = memoryview(buf)[:lines_end].tobytes().split('\n')
+    del buf[:lines_end + 1]
+    return lines
+
+
+class _SessionDetached(Exception):
+    """Raised out of ``async_recv()`` when another process took over a session"""
+
+class CodeCache(object):
+    """LRU cache of compiled console input, shared by every session
+
+    Entries are keyed by the source buffer along with everything else which
+    affects compilation, so the same code object is reused whenever an input
+    is repeated (polling scripts, re-run diagnostics).  Sources longer than
+    ``max_source_size`` characters are not cached.  ``hits`` and ``misses``
+    count lookups.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, maxsize=512, max_source_size=4096):
+        self.maxsize = maxsize
+        self.max_source_size = max_source_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the entry for ``key``, marking it as most recently used"""
+        with self._lock:
+            value = self._entries.pop(key, self._MISSING)
+            if value is self._MISSING:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Return a dict of the cache's size and hit/miss counts"""
+        with self._lock:
+            return {'size': len(self._entries), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses}
+
+class _CachingCommandCompiler(codeop.CommandCompiler):
+    """``codeop.CommandCompiler`` which looks inputs up in a ``CodeCache``
+
+    Both complete (a code object) and incomplete (None) results are cached;
+    errors are not.  The compiler flags are part of the key since a
+    ``__future__`` import changes how later input compiles, and a cached code
+    object using a future feature turns it on just as compiling it would.
+    """
+
+    def __init__(self, cache):
+        codeop.CommandCompiler.__init__(self)
+        self.cache = cache
+
+    def __call__(self, source, filename="<input>", symbol="single"):
+        if len(source) > self.cache.max_source_size:
+            return codeop.CommandCompiler.__call__(self, source, filename, symbol)
+        key = (source, filename, symbol, self.compiler.flags)
+        code = self.cache.get(key, self)
+        if code is self:
+            code = codeop.CommandCompiler.__call__(self, source, filename, symbol)
+            self.cache.put(key, code)
+        elif code is not None:
+            for feature in codeop._features:
+                if code.co_flags & feature.compiler_flag:
+                    self.compiler.flags |= feature.compiler_flag
+        return code
+
 class StreamInteractiveConsole(code.InteractiveConsole):
-    """Interactive console that works off an input and output stream"""
+    """Interactive console that works off an input and output stream
+
+    Lines starting with ``%`` (outside of a multi-line statement) are magic
+    commands rather than python.  ``%name args`` calls ``magics[name]`` with
+    the console and the argument string; see ``default_magics``.
+
+    Results are displayed with a bounded, incremental repr (see
+    ``bugger.display``): after ``display_page_size`` characters the output
+    stops and ``%more`` shows the next page.  ``display_max_depth`` and
+    ``display_max_items`` abbreviate deeply nested and long containers.
+
+    Compiled input is cached in ``code_cache``, which is shared by all
+    consoles; set it to None to compile every input afresh.
+
+    ``stats()`` (and ``%stats``) reports the commands run by the console, the
+    time spent compiling and executing them and the bytes of input received.
+    """
+
+    # name -> handler(console, args) available in every new console
+    default_magics = {}
+
+    display_page_size = 64 * 1024
+    display_max_depth = 8
+    display_max_items = None
+    display_write_size = 8192 # characters written to the stream at a time
+
+    default_terminal_width = 80 # unless the client says how wide it is (NAWS)
+
+    sampler = None # the process wide bugger.profiling.Sampler, once %sample used
+
+    thread_dumper = threads.ThreadDumper() # shared, so %threads compares with any last dump
+
+    heap_snapshots = collections.OrderedDict() # name -> bugger.heap.Snapshot, shared
+    max_heap_snapshots = 10
+
+    code_cache = CodeCache()
+
+    line_editor = None # set by servers editing the lines of clients in character mode
 
     def __init__(self, input_stream, output_stream, locals=None):
         """Initialize an interactive interpreter talking to the provided streams
@@ -68,11 +417,25 @@ class StreamInteractiveConsole(code.InteractiveConsole):
         objects.
         """
         code.InteractiveConsole.__init__(self, locals)
+        if self.code_cache is not None:
+            self.compile = _CachingCommandCompiler(self.code_cache)
         self.input_stream = input_stream
         self.output_stream = output_stream
+        self.magics = dict(self.default_magics)
+        self._display_remainder = None
         self._asyn_more = 0
-        self._byte_buffer = ''
+        self._byte_buffer = bytearray()
+        self.successor = None # console taking over the session, see async_recv
+        self.commands = 0
+        self.compile_time = 0.0
+        self.exec_time = 0.0
+        self.bytes_in = 0
     
+    @property
+    def terminal_width(self):
+        """Columns that reports (e.g. %profile) are formatted to fit"""
+        return getattr(self.input_stream, 'window_width', None) or self.default_terminal_width
+
     def async_init(self, banner=None, ps1=None, ps2=None):
         """Initialize the interpreter when operating in async mode
 
@@ -106,34 +469,331 @@ class StreamInteractiveConsole(code.InteractiveConsole):
         self.write(sys.ps1)
 
     def async_recv(self, bytes=''):
-        """Notify this console that there is data to receive"""
+        """Notify this console that there is data to receive
+
+        Only complete lines are decoded and pushed; a trailing partial line is
+        kept in a buffer until the rest of it comes.  Each byte is scanned for
+        a line ending once, so large pastes arriving in many pieces are
+        handled in linear time (see ``_complete_lines``).
+
+        A magic command may hand the session over to another console (such as
+        a ``JsonConsole``) by setting ``successor``; the rest of the input,
+        and any which comes later, is then passed on to it.
+        """
+        if self.successor is not None: # input queued before the hand over
+            return self.successor.async_recv(bytes)
         if not bytes:
             bytes = self.input_stream.read()
+        self.bytes_in += len(bytes)
+        buf = self._byte_buffer
+        lines = _complete_lines(buf, bytes)
+        if lines is None:
+            return None
+
         encoding = getattr(sys.stdin, 'encoding', None)
-        unpushed_bytes = ''.join([self._byte_buffer, bytes])
-        
-        # split on both \r\n and \n (effectively convert to just \n)
-        if not '\n' in unpushed_bytes:
-            self._byte_buffer += bytes
+        for i, line in enumerate(lines):
+            if line.endswith('\r'): # split on both \r\n and \n
+                line = line[:-1]
+            if line == '\x04': # EOF
+                raise SystemExit
+            if encoding and not isinstance(line, unicode):
+                line = line.decode(encoding)
+            if not self._asyn_more and line.startswith('%'):
+                self.run_magic(line)
+                if self.successor is not None:
+                    rest = ''.join(l + '\n' for l in lines[i + 1:]) + str(buf)
+                    del buf[:]
+                    return self.successor.async_recv(rest) if rest else None
+                continue
+            self._asyn_more = self.push(line)
+
+        # only write prompt if we are done with all lines and we did in
+        # fact receive a line.  This makes things work out nicer if they
+        # can push multiple lines at once (some clients)
+        if self._asyn_more:
+            prompt = sys.ps2
         else:
-            for line in ('\n'.join(unpushed_bytes.rstrip().split('\r\n'))).split('\n'):
-                if line == '\x04': # EOF
-                    raise SystemExit
-                if encoding and not isinstance(line, unicode):
-                    line = line.decode(encoding)
-                self._asyn_more = self.push(line)
-            
-            # only write prompt if we are done with all lines and we did in
-            # fact receive a line.  This makes things work out nicer if they
-            # can push multiple lines at once (some clients)
-            if self._asyn_more:
-                prompt = sys.ps2
+            prompt = sys.ps1
+        self.write(prompt)
+
+        return bytes
+
+    def runsource(self, source, filename="<input>", symbol="single"):
+        """Compile and run some source, timing the compile (see ``stats()``)"""
+        start = time.time()
+        try:
+            code = self.compile(source, filename, symbol)
+        except (OverflowError, SyntaxError, ValueError):
+            self.compile_time += time.time() - start
+            self.showsyntaxerror(filename)
+            return False
+        self.compile_time += time.time() - start
+        if code is None:
+            return True
+        self.runcode(code)
+        return False
+
+    def runcode(self, codeobj):
+        """Execute a code object, counting and timing it (see ``stats()``)"""
+        self.commands += 1
+        start = time.time()
+        try:
+            code.InteractiveConsole.runcode(self, codeobj)
+        finally:
+            self.exec_time += time.time() - start
+
+    def stats(self):
+        """Return a dict of this console's counters"""
+        return {'commands': self.commands,
+                'compile_time': self.compile_time,
+                'exec_time': self.exec_time,
+                'bytes_in': self.bytes_in}
+
+    def stats_magic(self, args):
+        """%stats: show the counters of this console"""
+        self.write("%(commands)d commands, %(compile_time).3f s compiling, "
+                   "%(exec_time).3f s executing, %(bytes_in)d bytes in\n" % self.stats())
+
+    def run_magic(self, line):
+        """Run the magic command on ``line`` (which starts with ``%``)"""
+        name, _, args = line[1:].strip().partition(' ')
+        try:
+            handler = self.magics.get(name)
+            if handler is None:
+                self.write("Unknown magic command %%%s, available: %s\n" %
+                           (name, ', '.join('%' + n for n in sorted(self.magics))))
+                return
+            handler(self, args.strip())
+        except (_SessionDetached, SystemExit):
+            raise
+        except Exception:
+            self.showtraceback()
+
+    def displayhook(self, value):
+        """Display a result, a page at a time (used in place of sys.displayhook)"""
+        if value is None:
+            return
+        __builtin__._ = None
+        self._display_remainder = iter_repr(value, self.display_max_depth,
+                                            self.display_max_items)
+        self._display_page()
+        __builtin__._ = value
+
+    def _display_page(self):
+        """Write the next page of the result being displayed"""
+        pieces = []
+        size = written = 0
+        try:
+            for piece in self._display_remainder:
+                pieces.append(piece)
+                size += len(piece)
+                if size >= self.display_write_size:
+                    self.write(''.join(pieces))
+                    pieces = []
+                    written += size
+                    size = 0
+                    if written >= self.display_page_size:
+                        self.write("\n... (%d characters shown, %%more for the next page)\n" % written)
+                        return
+        except:
+            self._display_remainder = None
+            raise
+        self._display_remainder = None
+        self.write(''.join(pieces) + '\n')
+
+    def more_magic(self, args):
+        """%more: show the next page of the last result"""
+        if self._display_remainder is None:
+            self.write("Nothing more to show\n")
+            return
+        try:
+            self._display_page()
+        except RuntimeError as err: # e.g. dictionary changed size during iteration
+            self._display_remainder = None
+            self.write("\nCan't show more: %s\n" % err)
+
+    def profile_magic(self, args):
+        """%profile [-n N] [-s cumulative|tottime] [-o FILE] STMT: profile a statement
+
+        Runs the statement in the console's namespace under cProfile and
+        shows the top N (default 20) functions by cumulative or self time.
+        ``-o`` also saves the raw pstats data to FILE, on the server.
+        """
+        limit, sort, filename = 20, 'cumulative', None
+        while args.startswith('-'):
+            option, _, rest = args.partition(' ')
+            value, _, args = rest.strip().partition(' ')
+            args = args.strip()
+            if option == '-n' and value.isdigit():
+                limit = int(value)
+            elif option == '-s' and value in profiling.SORT_KEYS:
+                sort = value
+            elif option == '-o' and value:
+                filename = value
             else:
-                prompt = sys.ps1
-            self._byte_buffer = ''
-            self.write(prompt)
-    
-            return bytes
+                self.write("Usage: %profile [-n N] [-s cumulative|tottime] [-o FILE] STMT\n")
+                return
+        if not args:
+            self.write("Usage: %profile [-n N] [-s cumulative|tottime] [-o FILE] STMT\n")
+            return
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.runctx(args, self.locals, self.locals)
+        except SystemExit:
+            raise
+        except: # report on the statement up to the exception
+            self.showtraceback()
+        for line in profiling.iter_report(profiler, sort, limit, self.terminal_width):
+            self.write(line + '\n')
+        if filename is not None:
+            profiler.dump_stats(filename)
+            self.write("Saved pstats data to %s\n" % os.path.abspath(filename))
+
+    def sample_magic(self, args):
+        """%sample [start [MS] | stop | top [N] | collapsed [FILE] | reset]: sampling profiler
+
+        Samples the stacks of every thread in the process every MS
+        milliseconds (default 10) in the background until stopped.  ``top``
+        shows the functions seen running most, ``collapsed`` writes the
+        samples as collapsed stacks (for flamegraph.pl) to FILE on the server
+        or to the console.  Without arguments, shows what sampling has cost.
+        """
+        command, _, args = args.partition(' ')
+        args = args.strip()
+        sampler = StreamInteractiveConsole.sampler
+        if command == 'start':
+            if sampler is None:
+                sampler = StreamInteractiveConsole.sampler = profiling.Sampler()
+            if args:
+                sampler.interval = float(args) / 1000.0
+            sampler.start()
+        elif sampler is None:
+            self.write("The sampler has not been started, use %sample start [MS]\n")
+            return
+        elif command == 'stop':
+            sampler.stop()
+        elif command == 'reset':
+            sampler.reset()
+        elif command == 'top':
+            for line in sampler.iter_top(int(args) if args else 20, self.terminal_width):
+                self.write(line + '\n')
+            return
+        elif command == 'collapsed':
+            if not args:
+                for line in sampler.iter_collapsed():
+                    self.write(line + '\n')
+                return
+            with open(args, 'w') as f:
+                for line in sampler.iter_collapsed():
+                    f.write(line + '\n')
+            self.write("Saved collapsed stacks to %s\n" % os.path.abspath(args))
+            return
+        elif command not in ('', 'status'):
+            self.write("Usage: %sample [start [MS] | stop | top [N] | collapsed [FILE] | reset]\n")
+            return
+        stats = sampler.stats()
+        self.write("Sampler %s every %g ms: %d samples, %d stack nodes (%d truncated), "
+                   "sampling took %.3f s of %.3f s (%.2f%%)\n" %
+                   ('running' if stats['running'] else 'stopped', 1000 * stats['interval'],
+                    stats['samples'], stats['nodes'], stats['truncated'],
+                    stats['sampling_time'], stats['elapsed'], 100 * stats['overhead']))
+
+    def threads_magic(self, args):
+        """%threads [NAME]: dump the stack of every thread (whose name contains NAME)
+
+        Threads waiting on a lock in the same place as in the previous dump
+        are flagged as possibly blocked.
+        """
+        for line in self.thread_dumper.iter_dump(args or None):
+            self.write(line + '\n')
+
+    def heap_magic(self, args):
+        """%heap [N | snapshot [NAME] | diff [A [B]] | list | trace start|stop]: heap census
+
+        Counts objects by type a chunk at a time, letting other threads run
+        in between, and shows the N (default 20) types using the most memory.
+        Objects are found by walking references from modules and thread
+        stacks, including those the garbage collector does not track
+        (strings...).
+        ``snapshot`` keeps a census under NAME; ``diff`` shows what grew
+        from snapshot A (default: the last) to B (default: now).  ``trace``
+        starts or stops tracemalloc, when available, so that snapshots also
+        record where memory was allocated.
+        """
+        command, _, args = args.partition(' ')
+        names = args.split()
+        snapshots = self.heap_snapshots
+        if command.isdigit() or not command:
+            snapshot = heap.census(untracked=True)
+            self._write_heap_table(snapshot.top(int(command or 20)))
+            self._write_census_summary(snapshot)
+        elif command == 'snapshot':
+            name = names[0] if names else str(len(snapshots) + 1)
+            snapshot = snapshots[name] = heap.census(untracked=True)
+            while len(snapshots) > self.max_heap_snapshots:
+                snapshots.popitem(last=False)
+            self.write("Snapshot %s: " % name)
+            self._write_census_summary(snapshot)
+        elif command == 'list':
+            for name, snapshot in snapshots.items():
+                self.write("%-10s %s, %d objects, %d bytes\n" %
+                           (name, time.ctime(snapshot.taken), snapshot.count, snapshot.size))
+        elif command == 'diff':
+            if not snapshots or any(name not in snapshots for name in names[:2]):
+                self.write("No such snapshot, take one with %%heap snapshot [NAME] (have: %s)\n" %
+                           (', '.join(snapshots) or 'none'))
+                return
+            old = snapshots[names[0]] if names else snapshots.values()[-1]
+            new = snapshots[names[1]] if len(names) > 1 else heap.census(untracked=True)
+            self._write_heap_table(heap.diff(old, new), sign='+')
+            for line in heap.allocation_diff(old, new):
+                self.write(line + '\n')
+        elif command == 'trace':
+            if heap.tracemalloc is None:
+                self.write("tracemalloc is not available on this python\n")
+            elif names == ['start']:
+                heap.tracemalloc.start(25)
+            elif names == ['stop']:
+                heap.tracemalloc.stop()
+            else:
+                self.write("Usage: %heap trace start|stop\n")
+        else:
+            self.write("Usage: %heap [N | snapshot [NAME] | diff [A [B]] | list | trace start|stop]\n")
+
+    def why_magic(self, args):
+        """%why EXPR: show the shortest chains of references keeping a value alive
+
+        Searches from the value of EXPR back to module globals, thread stacks
+        and this console's namespace, a chunk of objects at a time.
+        """
+        if not args:
+            self.write("Usage: %why EXPR\n")
+            return
+        value = eval(args, self.locals)
+        extra_roots = []
+        if not any(getattr(module, '__dict__', None) is self.locals
+                   for module in sys.modules.values()):
+            extra_roots.append((self.locals, "console namespace"))
+        result = heap.find_retention_paths(value, extra_roots=extra_roots)
+        del value, extra_roots
+        for i, (root_label, path) in enumerate(result.paths):
+            self.write("Path %d, %d references:\n" % (i + 1, len(path) - 1))
+            for line in heap.iter_path_lines(root_label, path):
+                self.write("  " + line + "\n")
+        self.write("%s %d objects to a depth of %d%s\n" % (
+            "Found by searching" if result.paths else "No path found searching",
+            result.searched, result.depth,
+            " (stopped at the search limits)" if result.limited else ""))
+
+    def _write_heap_table(self, rows, sign=''):
+        self.write("%12s %14s  %s\n" % ('objects', 'bytes', 'type'))
+        for name, count, size in rows:
+            self.write(("%" + sign + "12d %" + sign + "14d  %s\n") % (count, size, name))
+
+    def _write_census_summary(self, snapshot):
+        self.write("%d objects of %d types, %d bytes (census took %.3f s)\n" %
+                   (snapshot.count, len(snapshot.types), snapshot.size, snapshot.duration))
 
     def close(self):
         """Close the input and output streams"""
@@ -150,62 +810,945 @@ class StreamInteractiveConsole(code.InteractiveConsole):
         """Write the specified data to the output stream"""
         self.output_stream.write(data)
 
+StreamInteractiveConsole.default_magics['more'] = StreamInteractiveConsole.more_magic
+StreamInteractiveConsole.default_magics['stats'] = StreamInteractiveConsole.stats_magic
+StreamInteractiveConsole.default_magics['profile'] = StreamInteractiveConsole.profile_magic
+StreamInteractiveConsole.default_magics['sample'] = StreamInteractiveConsole.sample_magic
+StreamInteractiveConsole.default_magics['threads'] = StreamInteractiveConsole.threads_magic
+StreamInteractiveConsole.default_magics['heap'] = StreamInteractiveConsole.heap_magic
+StreamInteractiveConsole.default_magics['why'] = StreamInteractiveConsole.why_magic
+
+#===============================================================================
+# JSON Lines Protocol
+#
+# Tools talking to the console would otherwise have to scrape prompts out of
+# the telnet stream.  A session can instead speak JSON, a request or response
+# per line, either from the start (on the server's ``json_port``) or after
+# sending ``%json`` on the telnet port.
+#===============================================================================
+class _Capture(object):
+    """File-like object collecting what is written to it, as UTF-8"""
+
+    def __init__(self):
+        self.pieces = []
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.pieces.append(data)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self.pieces)
+
+def _text(data):
+    """``data`` as unicode, for JSON (which would refuse bytes which aren't UTF-8)"""
+    if isinstance(data, str):
+        return data.decode('utf-8', 'replace')
+    return data
+
+class JsonConsole(object):
+    """Console speaking a machine readable protocol, a JSON object per line
+
+    Each request is a JSON object on a line of its own::
+
+        {"id": 1, "op": "eval", "source": "len(sys.modules)"}
+
+    ``op`` is "eval" for an expression, whose repr is returned, or "exec"
+    for statements.  There is a response line for each request, in order::
+
+        {"id": 1, "ok": true, "result": "245", "stdout": "", "time": 2.1e-05}
+        {"id": 2, "ok": false, "error": {"type": "NameError", "message": "...",
+         "traceback": "..."}, "stdout": "", "time": 1.5e-05}
+
+    ``stdout`` is what the code printed and ``time`` the seconds it took to
+    run.  Results longer than ``max_result_size`` characters are cut short
+    (and marked ``"truncated": true``).
+
+    Requests may be pipelined: every complete request received is run in
+    turn, against ``locals``, and their responses are written together.  The
+    console starts by writing ``{"protocol": "bugger-json", "version": 1,
+    "pid": ...}``.
+    """
+
+    protocol = 'bugger-json'
+    version = 1
+
+    max_result_size = 1024 * 1024
+    display_max_depth = StreamInteractiveConsole.display_max_depth
+
+    displayhook = None # results are returned, never displayed
+    successor = None # never hands the session over
+    line_editor = None
+
+    def __init__(self, input_stream, output_stream, locals=None):
+        if locals is None:
+            locals = {"__name__": "__console__", "__doc__": None}
+        self.input_stream = input_stream
+        self.output_stream = output_stream
+        self.locals = locals
+        self._byte_buffer = bytearray()
+        self.commands = 0
+        self.compile_time = 0.0
+        self.exec_time = 0.0
+        self.bytes_in = 0
+
+    def async_init(self):
+        """Write the hello line"""
+        self.write(json.dumps({'protocol': self.protocol, 'version': self.version,
+                               'pid': os.getpid()}) + '\n')
+
+    def async_recv(self, bytes=''):
+        """Run the complete requests received and write their responses"""
+        if not bytes:
+            bytes = self.input_stream.read()
+        self.bytes_in += len(bytes)
+        lines = _complete_lines(self._byte_buffer, bytes)
+        if lines is None:
+            return None
+        responses = []
+        for line in lines:
+            if line.strip():
+                responses.append(json.dumps(self.handle(line)) + '\n')
+        self.write(''.join(responses))
+        return bytes
+
+    def handle(self, line):
+        """Run the request on ``line`` and return the response (a dict)"""
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            op = request.get('op', 'eval')
+            source = request['source']
+            if op not in ('eval', 'exec'):
+                raise ValueError("unknown op %r" % op)
+        except Exception as err:
+            return {'id': None, 'ok': False,
+                    'error': {'type': 'ProtocolError', 'message': _text(str(err))}}
+
+        response = {'id': request_id}
+        output = _Capture()
+        start = compiled = time.time()
+        try:
+            code_object = self._compile(source, op)
+            compiled = time.time()
+            self.compile_time += compiled - start
+            self.commands += 1
+            with _routed_output(output):
+                if op == 'eval':
+                    response['result'] = self._repr(eval(code_object, self.locals))
+                else:
+                    exec code_object in self.locals
+            response['ok'] = True
+        except (Exception, SystemExit) as err:
+            response['ok'] = False
+            response['error'] = {'type': type(err).__name__,
+                                 'message': _text(str(err)),
+                                 'traceback': _text(traceback.format_exc())}
+        self.exec_time += time.time() - compiled
+        response['stdout'] = _text(output.getvalue())
+        response['time'] = time.time() - start
+        if response.get('result') is not None and len(response['result']) > self.max_result_size:
+            response['result'] = response['result'][:self.max_result_size]
+            response['truncated'] = True
+        return response
+
+    def _compile(self, source, mode):
+        cache = StreamInteractiveConsole.code_cache
+        if cache is None or len(source) > cache.max_source_size:
+            return compile(source, '<json>', mode)
+        key = (source, '<json>', mode, 0)
+        code_object = cache.get(key)
+        if code_object is None:
+            code_object = compile(source, '<json>', mode)
+            cache.put(key, code_object)
+        return code_object
+
+    def _repr(self, value):
+        pieces = []
+        size = 0
+        for piece in iter_repr(value, self.display_max_depth):
+            pieces.append(piece)
+            size += len(piece)
+            if size > self.max_result_size:
+                break
+        return _text(''.join(pieces))
+
+    def stats(self):
+        """Return a dict of this console's counters"""
+        return {'commands': self.commands,
+                'compile_time': self.compile_time,
+                'exec_time': self.exec_time,
+                'bytes_in': self.bytes_in}
+
+    def close(self):
+        """Close the input and output streams"""
+        self.input_stream.close()
+        self.output_stream.close()
+
+    def write(self, data):
+        """Write the specified data to the output stream"""
+        self.output_stream.write(data)
+
 class _TelnetStream(object):
-    """Wrap raw stream and make console and telnet play nice with each other"""
-    
-    def __init__(self, stream):
+    """Wrap raw stream and make console and telnet play nice with each other
+
+    Input is run through a small state machine which strips out telnet
+    commands.  The state lives on the stream so that commands split across
+    reads are picked up where they left off; each buffer is scanned once, with
+    the plain data between commands copied out in slices.
+
+    Options are negotiated with the client following RFC 1143 (without its
+    queue of pending requests), so that no request is ever answered twice
+    and negotiation can't loop.  ``options`` maps each option to its state at
+    our end and at the client's; the client may enable the options in
+    ``remote_options`` at its end and ask for those in ``local_options`` at
+    ours, anything else is refused.  Negotiation is written with ``reply``.
+
+    ``negotiate()`` asks for LINEMODE (RFC 1184): the client edits and echoes
+    each line itself and sends it when it is complete.  For TAB completion,
+    the client is asked to also send what it has when TAB is pressed.  If it
+    refuses LINEMODE, character mode is the fallback: the server echoes
+    (ECHO, with SUPPRESS GO AHEAD) and the client sends every keystroke.
+    It also asks the client for the size of its window (NAWS, RFC 1073),
+    keeping the width in ``window_width``.
+    """
+
+    # parser states
+    _DATA, _IAC, _OPTION, _SB, _SB_IAC = range(5)
+    MAX_SUBNEGOTIATION = 4096 # drop (absurdly) long subnegotiations
+
+    # option states, at each end
+    NO, YES, WANTNO, WANTYES = range(4)
+
+    # input to stand in for commands sent by clients trapping signals
+    COMMAND_INPUT = {TELNET_COMMANDS.IP: '\x03', TELNET_COMMANDS.EOF: '\x04'}
+
+    def __init__(self, stream, reply=None):
         self.stream = stream
-    
-    def _handle_telnet_option(self, option_bytes):
-        assert len(option_bytes) == 3
-        assert option_bytes[0] == chr(TELNET_COMMANDS.IAC)
-        command, option = [ord(x) for x in option_bytes[1:]]
+        self.reply = reply
+        self.options = {} # option -> [state at our end, state at the client's]
+        self.local_options = set()
+        self.remote_options = set()
+        self.tab_completion = False
+        self.linemode_mode = None # as acknowledged by the client
+        self.forwarding_tab = False # client sends its line when TAB is pressed
+        self.window_width = None # columns, as last reported by the client
+        self._state = self._DATA
+        self._command = None
+        self._subnegotiation = []
+        self._subnegotiation_size = 0
+        self._pending_cr = False
+
+    def _debug(self, command, option=None):
+        inverse_command_map = dict([(v, k) for (k, v) in TELNET_COMMANDS.__dict__.items() if not k.startswith('_')])
+        inverse_options_map = dict([(v, k) for (k, v) in TELNET_OPTIONS.__dict__.items() if not k.startswith('_')])
+        command_description = inverse_command_map.get(command, "Unknown")
+        option_description = inverse_options_map.get(option, "Unknown")
+        _stdout.write("TELNET: Command/Option = %s/%s, %s/%s\n" % (command, option, command_description, option_description))
+
+    def _handle_telnet_command(self, command):
+        """Called for two byte commands (IAC <command>), e.g. NOP or AYT
+
+        Returns the input to take the place of the command, if any.
+        """
         if DEBUG_TELNET_OPTIONS:
-            inverse_command_map = dict([(v, k) for (k, v) in TELNET_COMMANDS.__dict__.items() if not k.startswith('_')])
-            inverse_options_map = dict([(v, k) for (k, v) in TELNET_OPTIONS.__dict__.items() if not k.startswith('_')])
-            command_description = inverse_command_map.get(command, "Unknown")
-            option_description = inverse_options_map.get(option, "Unknown")
-            _stdout.write(self.write("TELNET: Command/Option = %s/%s, %s/%s\r\n" % (command, option, command_description, option_description)))
-    
+            self._debug(command)
+        if self.tab_completion: # there is a line editor to handle ^C and ^D
+            return self.COMMAND_INPUT.get(command)
+        return None
+
+    def _handle_telnet_option(self, command, option):
+        """Called for option negotiation (IAC WILL/WONT/DO/DONT <option>)"""
+        if DEBUG_TELNET_OPTIONS:
+            self._debug(command, option)
+        if command in (TELNET_COMMANDS.WILL, TELNET_COMMANDS.WONT):
+            end, enable, supported = 1, command == TELNET_COMMANDS.WILL, self.remote_options
+            agree, refuse = TELNET_COMMANDS.DO, TELNET_COMMANDS.DONT
+        else:
+            end, enable, supported = 0, command == TELNET_COMMANDS.DO, self.local_options
+            agree, refuse = TELNET_COMMANDS.WILL, TELNET_COMMANDS.WONT
+        state = self._option(option)
+        current = state[end]
+        if enable:
+            if current == self.NO:
+                if option in supported:
+                    state[end] = self.YES
+                    self._send_option(agree, option)
+                    self._option_changed(option, end == 0, True)
+                else:
+                    self._send_option(refuse, option)
+            elif current == self.WANTYES:
+                state[end] = self.YES
+                self._option_changed(option, end == 0, True)
+            elif current == self.WANTNO: # an error (DONT answered by WILL), stays off
+                state[end] = self.NO
+        elif current != self.NO:
+            state[end] = self.NO
+            if current == self.YES:
+                self._send_option(refuse, option)
+            self._option_changed(option, end == 0, False)
+
+    def _option(self, option):
+        state = self.options.get(option)
+        if state is None:
+            state = self.options[option] = [self.NO, self.NO]
+        return state
+
+    def _send_option(self, command, option):
+        if self.reply is not None:
+            self.reply(chr(TELNET_COMMANDS.IAC) + chr(command) + chr(option))
+
+    def _send_subnegotiation(self, data):
+        if self.reply is not None:
+            IAC = chr(TELNET_COMMANDS.IAC)
+            self.reply(IAC + chr(TELNET_COMMANDS.SB) + data.replace(IAC, IAC + IAC) +
+                       IAC + chr(TELNET_COMMANDS.SE))
+
+    def local_enabled(self, option):
+        return self.options.get(option, (self.NO, self.NO))[0] == self.YES
+
+    def remote_enabled(self, option):
+        return self.options.get(option, (self.NO, self.NO))[1] == self.YES
+
+    def enable_local(self, option, enable=True):
+        """Ask to enable (WILL) or disable (WONT) ``option`` at our end"""
+        self._request(0, option, enable, TELNET_COMMANDS.WILL, TELNET_COMMANDS.WONT)
+
+    def enable_remote(self, option, enable=True):
+        """Ask the client to enable (DO) or disable (DONT) ``option`` at its end"""
+        self._request(1, option, enable, TELNET_COMMANDS.DO, TELNET_COMMANDS.DONT)
+
+    def _request(self, end, option, enable, agree, refuse):
+        state = self._option(option)
+        if enable and state[end] == self.NO:
+            state[end] = self.WANTYES
+            self._send_option(agree, option)
+        elif not enable and state[end] == self.YES:
+            state[end] = self.WANTNO
+            self._send_option(refuse, option)
+
+    @property
+    def character_mode(self):
+        """True if the client sends every keystroke, leaving echo to us"""
+        return self.local_enabled(TELNET_OPTIONS.ECHO)
+
+    @property
+    def linemode(self):
+        """True if the client edits lines itself (RFC 1184)"""
+        return self.remote_enabled(TELNET_OPTIONS.LINEMODE)
+
+    def negotiate(self, tab_completion=True):
+        """Start negotiating LINEMODE, or character mode if ``tab_completion``"""
+        self.tab_completion = tab_completion
+        self.remote_options.update((TELNET_OPTIONS.LINEMODE, TELNET_OPTIONS.SUPRESS_GO_AHEAD,
+                                    TELNET_OPTIONS.WINDOW_SIZE))
+        self.local_options.add(TELNET_OPTIONS.SUPRESS_GO_AHEAD)
+        self.enable_remote(TELNET_OPTIONS.LINEMODE)
+        self.enable_remote(TELNET_OPTIONS.WINDOW_SIZE)
+
+    def request_character_mode(self):
+        """Offer to echo and suppress go ahead, which puts clients in character mode"""
+        for option in (TELNET_OPTIONS.ECHO, TELNET_OPTIONS.SUPRESS_GO_AHEAD):
+            self.local_options.add(option)
+            self.enable_local(option)
+
+    def _option_changed(self, option, local, enabled):
+        """Called when an option is enabled, disabled or refused"""
+        if option == TELNET_OPTIONS.WINDOW_SIZE and not local and not enabled:
+            self.window_width = None
+        if option != TELNET_OPTIONS.LINEMODE or local:
+            return
+        if enabled:
+            mode = TELNET_LINEMODE.EDIT
+            if self.tab_completion:
+                mode |= TELNET_LINEMODE.TRAPSIG
+            self._send_subnegotiation(chr(TELNET_OPTIONS.LINEMODE) +
+                                      chr(TELNET_LINEMODE.MODE) + chr(mode))
+            if self.tab_completion: # bit 9 of the mask, TAB
+                self._send_subnegotiation(chr(TELNET_OPTIONS.LINEMODE) +
+                                          chr(TELNET_COMMANDS.DO) +
+                                          chr(TELNET_LINEMODE.FORWARDMASK) + '\x00\x40')
+        else:
+            self.linemode_mode = None
+            self.forwarding_tab = False
+            if self.tab_completion:
+                self.request_character_mode()
+
+    def _handle_subnegotiation(self, data):
+        """Called with the bytes between IAC SB and IAC SE (IAC IAC unescaped)"""
+        if DEBUG_TELNET_OPTIONS and data:
+            self._debug(TELNET_COMMANDS.SB, ord(data[0]))
+        if len(data) >= 5 and ord(data[0]) == TELNET_OPTIONS.WINDOW_SIZE and \
+                self.remote_enabled(TELNET_OPTIONS.WINDOW_SIZE):
+            self.window_width = (ord(data[1]) << 8 | ord(data[2])) or None # 0: unknown
+            return
+        if len(data) < 3 or ord(data[0]) != TELNET_OPTIONS.LINEMODE or not self.linemode:
+            return
+        suboption, argument = ord(data[1]), ord(data[2])
+        if suboption == TELNET_LINEMODE.MODE:
+            self.linemode_mode = argument & ~TELNET_LINEMODE.MODE_ACK
+        elif argument == TELNET_LINEMODE.FORWARDMASK and \
+                suboption in (TELNET_COMMANDS.WILL, TELNET_COMMANDS.WONT):
+            self.forwarding_tab = suboption == TELNET_COMMANDS.WILL
+
     def __getattr__(self, attr):
         return getattr(self.stream, attr)
-    
+
     def sanitize_input(self, data):
-        # first, check for any special telnet sequences (IAC = Interpret As Command)
+        """Strip telnet commands from ``data`` and return the remaining input
+
+        Escaped 0xFF bytes (IAC IAC) are passed through as data and line
+        endings are converted to ``\\n``.
+        """
         IAC = chr(TELNET_COMMANDS.IAC)
-        while IAC in data:
-            # check to ensure that there are 3 bytes following IAC, as we are
-            # dealing with a stream of data
-            iac_index = data.index(IAC)
-            if iac_index + 3 <= len(data):
-                telnet_option_bytes = data[iac_index:iac_index + 3]
-                data = data[:iac_index] + data[iac_index+3:]
-                self._handle_telnet_option(telnet_option_bytes)
-            else:
-                break
-        
-        return data.replace('\r\n', '\n')
+        out = []
+        pos = 0
+        end = len(data)
+        state = self._state
+        while pos < end:
+            if state == self._DATA:
+                iac_index = data.find(IAC, pos)
+                if iac_index < 0:
+                    out.append(data[pos:] if pos else data)
+                    break
+                out.append(data[pos:iac_index])
+                pos = iac_index + 1
+                state = self._IAC
+            elif state == self._IAC:
+                command = ord(data[pos])
+                pos += 1
+                if command == TELNET_COMMANDS.IAC:
+                    out.append(IAC)
+                    state = self._DATA
+                elif TELNET_COMMANDS.WILL <= command <= TELNET_COMMANDS.DONT:
+                    self._command = command
+                    state = self._OPTION
+                elif command == TELNET_COMMANDS.SB:
+                    self._subnegotiation = []
+                    self._subnegotiation_size = 0
+                    state = self._SB
+                else:
+                    inserted = self._handle_telnet_command(command)
+                    if inserted:
+                        out.append(inserted)
+                    state = self._DATA
+            elif state == self._OPTION:
+                option = ord(data[pos])
+                pos += 1
+                state = self._DATA
+                self._handle_telnet_option(self._command, option)
+            elif state == self._SB:
+                iac_index = data.find(IAC, pos)
+                chunk_end = end if iac_index < 0 else iac_index
+                self._append_subnegotiation(data[pos:chunk_end])
+                if iac_index < 0:
+                    break
+                pos = iac_index + 1
+                state = self._SB_IAC
+            else: # self._SB_IAC
+                command = ord(data[pos])
+                pos += 1
+                if command == TELNET_COMMANDS.IAC:
+                    self._append_subnegotiation(IAC)
+                    state = self._SB
+                elif command == TELNET_COMMANDS.SE:
+                    subnegotiation = ''.join(self._subnegotiation)
+                    self._subnegotiation = []
+                    state = self._DATA
+                    self._handle_subnegotiation(subnegotiation)
+                else: # protocol violation, ignore the stray command
+                    state = self._SB
+        self._state = state
+
+        data = ''.join(out)
+        if self._pending_cr:
+            data = '\r' + data
+            self._pending_cr = False
+        if data.endswith('\r'): # might be the first half of a \r\n
+            data = data[:-1]
+            self._pending_cr = True
+        return data.replace('\r\n', '\n').replace('\r\0', '\r')
+
+    def _append_subnegotiation(self, data):
+        if self._subnegotiation_size + len(data) <= self.MAX_SUBNEGOTIATION:
+            self._subnegotiation.append(data)
+            self._subnegotiation_size += len(data)
 
     def read(self, *args, **kwargs):
         underlying_read = self.stream.read(*args, **kwargs)
         return self.sanitize_input(underlying_read)
     
     def write(self, s):
-        # for telnet, convert newlines to always be \r\n
-        self.stream.write(s.replace('\r\n', '\n').replace('\n', '\r\n'))
+        # for telnet, convert newlines to always be \r\n and escape IAC
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        if '\n' in s:
+            if '\r' in s:
+                s = s.replace('\r\n', '\n')
+            s = s.replace('\n', '\r\n')
+        if '\xff' in s:
+            s = s.replace('\xff', '\xff\xff')
+        self.stream.write(s)
+
+class _LineEditor(object):
+    """Edit the lines typed by a client in character mode, complete them in LINEMODE
+
+    In character mode typed characters are echoed and collected until Enter,
+    when the line is handed to the console.  Backspace erases a character, ^U the line and ^C
+    abandons the statement being entered; ^D on an empty line ends the
+    session.  Escape sequences (arrow keys and so on) are ignored.
+
+    TAB completes the word before the cursor (see ``bugger.completion``),
+    filling in as much as all the candidates have in common.  If there is
+    nothing to fill in, a second TAB lists the candidates.  At the start of a
+    line TAB indents.
+
+    A client in LINEMODE edits and echoes lines itself, sending what it has
+    when TAB is pressed.  The editor then holds on to that start of the line,
+    showing the line afresh with the completion, until the rest of it comes
+    (the client can't erase the part already sent).
+    """
+
+    max_listed = 100 # candidates listed by a second TAB
+    indent = '    '
+
+    _PLAIN = re.compile(r'[^\x00-\x1f\x7f]+')
+    _ESCAPE = re.compile(r'\x1b(?:\[[0-9;?]*[\x40-\x7e]|O.|[^\[O])')
+    _WORD = re.compile(r'[\w.]*$')
+
+    def __init__(self, console):
+        self.console = console
+        self.completer = completion.Completer(console.locals)
+        self._line = bytearray()
+        self._echo = True
+        self._escape = '' # start of an escape sequence split across reads
+        self._tabbed = False # last key was a TAB with nothing to fill in
+
+    def feed(self, data, echo=True):
+        """Handle typed ``data``, returning the lines it completed
+
+        ``echo`` is False if the client echoes what is typed itself.
+        """
+        if self._escape:
+            data = self._escape + data
+            self._escape = ''
+        self._echo = echo
+        lines = []
+        shown = []
+        pos = 0
+        end = len(data)
+        while pos < end:
+            match = self._PLAIN.match(data, pos)
+            if match is not None:
+                self._line += match.group()
+                shown.append(match.group())
+                pos = match.end()
+                self._tabbed = False
+                continue
+            char = data[pos]
+            if char == '\x1b':
+                match = self._ESCAPE.match(data, pos)
+                if match is not None:
+                    pos = match.end()
+                elif end - pos < 16: # incomplete, wait for the rest
+                    self._escape = data[pos:]
+                    break
+                else: # not a sequence we know, drop the escape
+                    pos += 1
+                continue
+            pos += 1
+            if char == '\t':
+                self._show(shown)
+                self._complete()
+                continue
+            self._tabbed = False
+            if char in '\r\n':
+                shown.append('\n')
+                lines.append(str(self._line) + '\n')
+                self._line = bytearray()
+            elif char in '\x7f\x08':
+                if self._line:
+                    # erase the whole of a UTF-8 encoded character
+                    while len(self._line) > 1 and 0x80 <= self._line[-1] < 0xc0:
+                        del self._line[-1]
+                    del self._line[-1]
+                    shown.append('\b \b')
+            elif char == '\x15': # ^U
+                shown.append('\b \b' * len(self._line.decode('utf-8', 'replace')))
+                self._line = bytearray()
+            elif char == '\x03': # ^C
+                self._show(shown)
+                self._line = bytearray()
+                self.console.resetbuffer()
+                self.console._asyn_more = 0
+                self._write('^C\nKeyboardInterrupt\n' + sys.ps1)
+            elif char == '\x04' and not self._line: # ^D
+                lines.append('\x04\n')
+        self._show(shown)
+        return ''.join(lines)
+
+    def _show(self, shown):
+        """Echo what was typed, if echoing, emptying ``shown``"""
+        if self._echo:
+            self._write(''.join(shown))
+        del shown[:]
+
+    def _write(self, data):
+        if data:
+            self.console.write(data)
+
+    def _prompt(self):
+        return sys.ps2 if self.console._asyn_more else sys.ps1
+
+    def _complete(self):
+        line = str(self._line)
+        if not line.strip():
+            self._insert(self.indent)
+            return
+        word = self._WORD.search(line).group()
+        result = self.completer.complete(word, self.max_listed)
+        if len(result.prefix) > len(word):
+            self._insert(result.prefix[len(word):])
+            self._tabbed = False
+        elif result.total > 1 and self._tabbed:
+            self._write('\n' + self._format_listing(word, result) + '\n' +
+                        self._prompt() + line)
+        else:
+            self._write('\a' if self._echo else '\a\r' + self._prompt() + line)
+            self._tabbed = True
+
+    def _insert(self, text):
+        self._line += text
+        if self._echo:
+            self._write(text)
+        else: # the client echoed the TAB itself, so show the whole line
+            self._write('\r' + self._prompt() + str(self._line))
+
+    def _format_listing(self, word, result):
+        start = word.rfind('.') + 1 # list attributes without the object
+        items = [match[start:] for match in result.matches]
+        width = max(len(item) for item in items) + 2
+        columns = max(1, self.console.terminal_width // width)
+        rows = [''.join(item.ljust(width) for item in items[i:i + columns]).rstrip()
+                for i in xrange(0, len(items), columns)]
+        if result.total > len(items):
+            rows.append("(%d more)" % (result.total - len(items)))
+        return '\n'.join(rows)
+
+class _OutputBuffer(object):
+    """Outbound data for one client, coalesced and sent by the server loop
+
+    ``write()`` may be called from any thread.  It only appends to the buffer,
+    calling ``notify()`` when the server loop needs to know that there is
+    something to send.  The loop then calls ``flush()``, which sends as much
+    as the non-blocking socket will take in as few calls as possible.
+
+    Once more than ``high_water`` bytes are waiting, writers are paused until
+    the loop has sent enough.  The loop's own thread can't wait on itself, so
+    when it is the writer (inline execution) it sends what the socket takes
+    without blocking and buffers the rest, up to ``limit`` bytes (by default
+    four times ``high_water``); the loop then reads no more of the client's
+    input until it has caught up.  If ``pause`` is False, or the buffer goes
+    past ``limit``, the buffer is marked ``overflowed``, further output is
+    dropped and the server disconnects the client.
+
+    ``bytes_sent`` counts the bytes sent and ``peak`` is the most that was
+    ever waiting to be sent.
+    """
+
+    def __init__(self, sock, notify, high_water=1024 * 1024, pause=True, limit=None):
+        self.sock = sock
+        self.notify = notify
+        self.high_water = high_water
+        self.pause = pause
+        self.limit = limit if limit is not None else 4 * high_water
+        self.loop_thread = None
+        self.overflowed = False
+        self.closed = False
+        self.blocking = False
+        self.bytes_sent = 0
+        self.peak = 0
+        self._chunks = collections.deque()
+        self._size = 0
+        self._notified = False
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return self._size
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if not data:
+            return
+        if self.blocking:
+            self.sock.sendall(data)
+            self.bytes_sent += len(data)
+            return
+        with self._cond:
+            if self.closed or self.overflowed:
+                return
+            if self._size and self._size + len(data) > self.high_water:
+                self._make_room(len(data))
+            if not self.overflowed:
+                self._chunks.append(data)
+                self._size += len(data)
+                if self._size > self.peak:
+                    self.peak = self._size
+            notify = not self._notified and not self.closed
+            self._notified = True
+        if notify:
+            self.notify()
+
+    def _make_room(self, size):
+        # called with self._cond held
+        if not self.pause:
+            self._overflow()
+        elif threading.current_thread() is self.loop_thread:
+            try:
+                self.flush() # the condition's lock is reentrant
+            except socket.error:
+                self._overflow()
+                return
+            if self._size + size > self.limit:
+                self._overflow()
+        else:
+            while (self._size and self._size + size > self.high_water and
+                   not (self.closed or self.overflowed)):
+                self._cond.wait()
+
+    def _overflow(self):
+        self.overflowed = True
+        self._chunks.clear()
+        self._size = 0
+        self._cond.notify_all()
+
+    def flush(self):
+        """Send as much as the socket will take, returning True once empty"""
+        with self._cond:
+            if self.closed or not self._chunks:
+                self._notified = False
+                return True
+            if len(self._chunks) == 1:
+                data = self._chunks.popleft()
+            else:
+                data = ''.join(self._chunks)
+                self._chunks.clear()
+        try:
+            sent = self.sock.send(data)
+        except socket.error as err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            sent = 0
+        with self._cond:
+            if sent < len(data):
+                self._chunks.appendleft(data[sent:])
+            self._size -= sent
+            self.bytes_sent += sent
+            self._notified = bool(self._chunks)
+            self._cond.notify_all()
+            return not self._chunks
+
+    def detach(self):
+        """Stop sending (but keep) buffered data, before handing off the socket"""
+        with self._cond:
+            self.closed = True
+
+    def set_blocking(self):
+        """Write straight to the socket from now on, starting with anything buffered
+
+        Used in a forked child process where there is no server loop; as the
+        other threads are gone, any lock they held is abandoned as well.
+        """
+        self._cond = threading.Condition()
+        self.closed = False
+        self.blocking = True
+        self.sock.setblocking(1)
+        data = ''.join(self._chunks)
+        self._chunks.clear()
+        self._size = 0
+        if data:
+            self.sock.sendall(data)
+            self.bytes_sent += len(data)
+
+    def close(self):
+        """Drop buffered data and release any paused writers"""
+        with self._cond:
+            self.closed = True
+            self._chunks.clear()
+            self._size = 0
+            self._cond.notify_all()
+
+def _remove_socket_file(path):
+    """Remove the file of a Unix domain socket, if there is one"""
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except OSError:
+        pass
+
 
 class TelnetInteractiveConsoleServer(object):
     """Make an interactive console available via telnet which can interact with your app"""
 
-    def __init__(self, host='0.0.0.0', port=7070, locals=None, select_timeout=5.0):
+    recv_size = 65536 # most bytes read from a client at once
+
+    def __init__(self, host='0.0.0.0', port=7070, locals=None, select_timeout=5.0,
+                 poller=None, workers=0, snapshot=False,
+                 output_high_water=1024 * 1024, output_overflow='pause',
+                 max_sessions=None, max_sessions_per_peer=None,
+                 idle_timeout=None, session_timeout=None, backlog=5,
+                 line_editing=True, json_port=None, unix_socket=None,
+                 json_unix_socket=None, reuse_port=False):
+        """Create a new console server (the server is not started)
+
+        ``poller`` is the event loop backend used to wait on the sockets; if
+        not provided, the best one available on this platform will be used
+        (see ``bugger.eventloop.default_poller``).
+
+        ``workers`` is the number of threads used to execute console input.
+        With the default of 0, input is executed inline by the server loop and
+        a slow command holds up every session.  Otherwise each session's input
+        is executed in order on a pool of that many threads while the server
+        loop keeps accepting and reading from clients.
+
+        ``snapshot`` runs every session in a child process forked on connect,
+        against a copy-on-write image of this process, so that heavy
+        introspection does not slow the live process down.  Any session may
+        also move itself into such a child with the ``%snapshot`` command.
+        Only the forking thread exists in the child; other threads' work (and
+        changes made in the child) are not visible to the other side.
+
+        Output for each client is buffered and sent by the server loop when
+        the client can take it.  ``output_high_water`` is the number of bytes
+        which may be waiting for a client; beyond that ``output_overflow``
+        decides what happens: 'pause' makes the command producing the output
+        wait for the client and 'disconnect' disconnects the client.  Inline
+        execution can't wait without holding up every session, so with
+        'pause' a command's output is buffered up to four times
+        ``output_high_water`` (the client is disconnected beyond that) and
+        the session's input is not read until the client has caught up.
+
+        ``max_sessions`` and ``max_sessions_per_peer`` (sessions from one
+        client address) limit the number of concurrent sessions; connections
+        beyond them are sent a short message and closed.  Sessions are closed
+        after ``idle_timeout`` seconds without input, and ``session_timeout``
+        seconds after they connected, if set.  ``backlog`` is passed to
+        ``listen()``.
+
+        Clients are asked to edit lines themselves (LINEMODE) and send them
+        when complete.  Unless ``line_editing`` is False, TAB completes python
+        names and attributes: the client is asked to send what it has when
+        TAB is pressed, and clients which refuse LINEMODE are asked to go into
+        character mode, with the server echoing and editing what is typed.
+
+        Sessions may speak JSON instead (see ``JsonConsole``), for tools:
+        those connecting to ``json_port``, if given, do from the start and a
+        telnet session switches with the ``%json`` command.  JSON sessions
+        share ``locals`` with the telnet sessions but are never snapshots.
+
+        ``unix_socket`` and ``json_unix_socket`` are paths of Unix domain
+        sockets to listen on instead of ``host`` with ``port`` and
+        ``json_port``; the socket files are removed when the server stops.
+        ``reuse_port`` sets SO_REUSEPORT on TCP sockets, so that several
+        processes can listen on the same port (each connection goes to one
+        of them).  See ``bugger.prefork`` for servers in forked workers.
+
+        ``stats()`` (and the ``%stats`` command) reports counters for the
+        server and each of its sessions.
+
+        The server loop blocks until there is something to do, ``stop()``
+        wakes it up.  ``select_timeout`` only applies while there are
+        snapshot processes to reap.
+        """
+        if snapshot and not hasattr(os, 'fork'):
+            raise ValueError("snapshot sessions require os.fork()")
+        if output_overflow not in ('pause', 'disconnect'):
+            raise ValueError("output_overflow must be 'pause' or 'disconnect'")
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError("reuse_port requires SO_REUSEPORT, which this platform lacks")
         self.host = host
         self.port = port
         self.select_timeout = select_timeout
         self.locals = locals
         self.has_exit = False
-        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.unix_socket = unix_socket
+        self.json_unix_socket = json_unix_socket
+        self.reuse_port = reuse_port
+        self.server_sock = self._make_socket(unix_socket)
+        self.json_port = json_port
+        self.json_sock = None
+        if json_port is not None or json_unix_socket is not None:
+            self.json_sock = self._make_socket(json_unix_socket)
+        self._listening_pid = None # the process which bound the sockets
+        self.poller = poller if poller is not None else eventloop.default_poller()
+        self.workers = workers
+        self._pool = None
+        self.snapshot = snapshot
+        self._snapshot_pids = set()
+        self.output_high_water = output_high_water
+        self.output_overflow = output_overflow
+        self.max_sessions = max_sessions
+        self.max_sessions_per_peer = max_sessions_per_peer
+        self.idle_timeout = idle_timeout
+        self.session_timeout = session_timeout
+        self.backlog = backlog
+        self.line_editing = line_editing
         self.client_sockets = {}
+        self._fd_to_client = {}
+        self._output_buffers = {}
+        self._flush_queue = collections.deque() # clients with output to send
+        self._loop_calls = collections.deque() # (function, args, done) for the loop to run
+        self._writing = set() # clients waiting for their socket to be writable
+        self._backlogged = set() # clients whose input waits for their output to drain
+        self._waker = eventloop.Waker()
+        self._loop_thread = None
+        self._stopped = threading.Event()
+        # timeouts fire up to a quarter late (and at most a second)
+        self._timers = eventloop.TimerWheel(resolution=min(
+            [1.0] + [t / 4.0 for t in (idle_timeout, session_timeout) if t]))
+        self._client_timers = {} # client -> {'idle'/'session': timer}
+        self._last_input = {} # client -> time of its last input
+        self._client_peers = {} # client -> peer address
+        self._connected_at = {} # client -> time it connected
+        self.accepts = 0
+        self.rejects = 0
+        self.timeouts = 0
+        self.loop_iterations = 0
+        self.loop_time = 0.0 # spent handling events, not waiting for them
+        self.loop_time_max = 0.0
+        self._peer_sessions = collections.defaultdict(int) # peer address -> sessions
+        self._recv_buffer = bytearray(self.recv_size) # shared by all clients
+        self._recv_view = memoryview(self._recv_buffer)
+        self._listening = False
+
+    def _make_socket(self, unix_path):
+        if unix_path is not None:
+            return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return sock
+
+    @property
+    def address(self):
+        """Where the telnet console listens: ``(host, port)`` or a path"""
+        if self.unix_socket is not None:
+            return self.unix_socket
+        return self.server_sock.getsockname()[:2]
+
+    @property
+    def json_address(self):
+        """Where the JSON console listens, if anywhere"""
+        if self.json_sock is None:
+            return None
+        if self.json_unix_socket is not None:
+            return self.json_unix_socket
+        return self.json_sock.getsockname()[:2]
 
     def client_connect(self, client):
         """Called when a client successfully connected to the server
@@ -223,9 +1766,24 @@ class TelnetInteractiveConsoleServer(object):
         """
         pass
 
-    def stop(self):
-        """Cleanly shutdown and kill this console session"""
+    def stop(self, timeout=None):
+        """Cleanly shutdown and kill this console session
+
+        The server loop is woken up and closes every session and the server
+        socket.  Unless called from the server loop itself (e.g. by a console
+        command), this waits up to ``timeout`` seconds (forever if None) for
+        that to finish and returns True if it did.
+        """
         self.has_exit = True
+        loop_thread = self._loop_thread
+        if loop_thread is None:
+            if self._listening:
+                self._shutdown()
+            return True
+        if loop_thread is threading.current_thread():
+            return False
+        self._waker.wake()
+        return self._stopped.wait(timeout)
 
     def accept_interactions(self):
         """Accept and interact with clients via telnet
@@ -244,52 +1802,566 @@ class TelnetInteractiveConsoleServer(object):
             >>> console.stop() # this will end the target method and thread
 
         """
-        self.server_sock.bind((self.host, self.port))
-        self.server_sock.listen(5) # backlog a few connections
+        # announce the loop before checking has_exit, so that a concurrent
+        # stop() either sees the loop and waits for it or is seen by it
+        self._stopped.clear()
+        self._loop_thread = threading.current_thread()
+        try:
+            if self.has_exit:
+                return
+            if not self._listening:
+                self.listen()
+            if self.workers:
+                self._pool = _WorkerPool(self.workers)
+            self._run_loop(self.server_sock.fileno(), self._waker.fileno(),
+                           self.json_sock.fileno() if self.json_sock is not None else None)
+        finally:
+            self._shutdown()
+            self._loop_thread = None
+            self._stopped.set()
 
+    def _run_loop(self, server_fd, waker_fd, json_fd=None):
+        """Dispatch socket events until ``has_exit`` is set"""
         while not self.has_exit:
-            rl = select.select(self.client_sockets.keys() + [self.server_sock], [], [], self.select_timeout)[0]
-            if self.server_sock in rl:
-                rl.remove(self.server_sock) # we process others as normal
-                client, _addr = self.server_sock.accept() # accept the connection
-                client_console = StreamInteractiveConsole(_TelnetStream(client.makefile('r', 0)),
-                                                          _TelnetStream(client.makefile('w', 0)),
-                                                          self.locals)
-                self.client_sockets[client] = client_console
-
-                with self.cleanup_client(client):
-                    client_console.async_init()
-                    self.client_connect(client)
-
-            for client in rl:
-                with self.cleanup_client(client):
-                    bytes = client.recv(1024)
-
-                if bytes == '': # client disconnect
-                    self.client_disconnect(client)
-                    client.close()
-                    del self.client_sockets[client]
+            timeout = self._timers.timeout() # None if nothing but sockets to wait for
+            if self._snapshot_pids:
+                self._reap_snapshots()
+                timeout = min(timeout, self.select_timeout) if timeout is not None \
+                    else self.select_timeout
+            events_ready = self.poller.poll(timeout)
+            start = time.time()
+            for fd, events in events_ready:
+                if fd == server_fd or fd == json_fd:
+                    self._accept_client(json=(fd == json_fd))
+                    continue
+                if fd == waker_fd:
+                    self._waker.drain()
+                    continue
+
+                client = self._fd_to_client.get(fd)
+                if client is None: # closed earlier in this iteration
+                    continue
+                if events & eventloop.EVENT_WRITE:
+                    self._flush_client(client)
+                if events & eventloop.EVENT_READ and client in self.client_sockets:
+                    self._read_client(client)
+            for timeout in self._timers.expire():
+                self._session_timeout(*timeout)
+            self._run_loop_calls()
+            self._flush_pending()
+            elapsed = time.time() - start
+            self.loop_iterations += 1
+            self.loop_time += elapsed
+            if elapsed > self.loop_time_max:
+                self.loop_time_max = elapsed
+
+    def _shutdown(self):
+        """Close every session and stop listening, after the loop exits"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False) # don't wait on runaway commands
+            self._pool = None
+        for client in list(self.client_sockets):
+            with self.cleanup_client(client):
+                self.client_disconnect(client)
+                self._remove_client(client)
+        for sock in (self.server_sock, self.json_sock):
+            if sock is None:
+                continue
+            try:
+                self.poller.unregister(sock.fileno())
+                sock.close()
+            except (socket.error, IOError, OSError, KeyError):
+                pass
+        if self._listening_pid == os.getpid(): # not a forked child's copy
+            for path in (self.unix_socket, self.json_unix_socket):
+                if path is not None:
+                    _remove_socket_file(path)
+        self._listening = False
+
+    def close_sockets(self):
+        """Close the server's sockets when its loop isn't running
+
+        This is for a forked child's copy of a server started by its parent
+        (only the forking thread exists in the child, so the copy has no
+        loop), and for a server which failed to listen.  Socket files are
+        left alone, since they may belong to the parent.
+        """
+        self.has_exit = True
+        for client, client_console in self.client_sockets.items():
+            client_console.close()
+            client.close()
+        self.client_sockets.clear()
+        for sock in (self.server_sock, self.json_sock):
+            if sock is not None:
+                sock.close()
+        self.poller.close()
+        self._waker.close()
+        self._listening = False
+
+    def listen(self):
+        """Bind the server socket and start listening for connections
+
+        This is called by ``accept_interactions()`` if it has not been called
+        already.  Calling it up front guarantees that clients may connect as
+        soon as it returns, even if the server loop runs in another thread.
+        """
+        self._bind(self.server_sock, self.unix_socket, self.port)
+        if self.json_sock is not None:
+            self._bind(self.json_sock, self.json_unix_socket, self.json_port)
+        self._listening_pid = os.getpid()
+        self.server_sock.listen(self.backlog)
+        self.poller.register(self.server_sock.fileno(), eventloop.EVENT_READ)
+        if self.json_sock is not None:
+            self.json_sock.listen(self.backlog)
+            self.poller.register(self.json_sock.fileno(), eventloop.EVENT_READ)
+        self.poller.register(self._waker.fileno(), eventloop.EVENT_READ)
+        self._listening = True
+        _install_stream_routers()
+
+    def _bind(self, sock, unix_path, port):
+        if unix_path is None:
+            sock.bind((self.host, port))
+            return
+        _remove_socket_file(unix_path) # left behind by a process which died
+        sock.bind(unix_path)
+
+    def _accept_client(self, json=False):
+        """Accept a pending connection and register it with the poller
+
+        ``json`` connections (to ``json_port``) get a ``JsonConsole``.
+        """
+        server_sock = self.json_sock if json else self.server_sock
+        client, addr = server_sock.accept() # accept the connection
+        peer = addr[0] if isinstance(addr, tuple) else addr
+        reason = self._admission_refused(peer)
+        if reason is not None:
+            self.rejects += 1
+            self._reject_client(client, reason)
+            return
+        self.accepts += 1
+        client.setblocking(0)
+        output_buffer = _OutputBuffer(client, lambda: self._schedule_flush(client),
+                                      self.output_high_water,
+                                      pause=(self.output_overflow == 'pause'))
+        output_buffer.loop_thread = self._loop_thread
+        if json:
+            client_console = JsonConsole(_TelnetStream(client.makefile('r', 0)),
+                                         output_buffer, self.locals)
+        else:
+            input_stream = _TelnetStream(client.makefile('r', 0), reply=output_buffer.write)
+            client_console = StreamInteractiveConsole(input_stream, _TelnetStream(output_buffer),
+                                                      self.locals)
+            if self.line_editing:
+                client_console.line_editor = _LineEditor(client_console)
+            input_stream.negotiate(tab_completion=self.line_editing)
+            if self.snapshot:
+                self._fork_session(client, client_console, on_connect=True)
+                client_console.close()
+                client.close()
+                return
+            if hasattr(os, 'fork'):
+                client_console.magics['snapshot'] = \
+                    lambda console, args: self._snapshot_magic(client, console)
+            client_console.magics['stats'] = \
+                lambda console, args: self._stats_magic(client, console)
+            client_console.magics['json'] = lambda console, args: self._json_magic(client, console)
+        self.client_sockets[client] = client_console
+        self._output_buffers[client] = output_buffer
+        self._fd_to_client[client.fileno()] = client
+        self.poller.register(client.fileno(), eventloop.EVENT_READ)
+        self._client_peers[client] = peer
+        self._connected_at[client] = time.time()
+        self._peer_sessions[peer] += 1
+        timers = self._client_timers[client] = {}
+        if self.idle_timeout is not None:
+            self._last_input[client] = self._timers.clock()
+            timers['idle'] = self._timers.schedule(self.idle_timeout, (client, 'idle'))
+        if self.session_timeout is not None:
+            timers['session'] = self._timers.schedule(self.session_timeout, (client, 'session'))
+
+        with self.cleanup_client(client):
+            client_console.async_init()
+            self.client_connect(client)
+
+    def _read_client(self, client):
+        """Read and handle input from a client whose socket is readable"""
+        with self.cleanup_client(client):
+            try:
+                nbytes = client.recv_into(self._recv_buffer)
+            except socket.error as err:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+        if client not in self.client_sockets: # recv failed, cleaned up
+            return
+
+        if nbytes == 0: # client disconnect
+            self.client_disconnect(client)
+            self._remove_client(client)
+            return
+
+        if client in self._last_input:
+            self._last_input[client] = self._timers.clock()
+        client_console = self.client_sockets[client]
+        bytes = ''
+        with self.cleanup_client(client):
+            # copied out, as the receive buffer is reused by the next read
+            bytes = self._client_input(client_console, self._recv_view[:nbytes].tobytes())
+        if len(bytes) == 0:
+            return
+        if self._pool is not None:
+            self._pool.submit(client, self._execute, client, client_console, bytes)
+            return
+        with self.cleanup_client(client): # an error ends this session, not the loop
+            try:
+                with _routed_output(client_console.output_stream, client_console.displayhook):
+                    client_console.async_recv(bytes)
+            except (SystemExit,):
+                self._remove_client(client)
+            except _SessionDetached:
+                self._remove_client(client, flush=False)
+
+    def _client_input(self, client_console, data):
+        """Return the console input in ``data`` read from a client
+
+        Telnet commands are stripped and, in character mode, keystrokes are
+        edited into lines.  In LINEMODE, lines sent for TAB completion are held
+        until the rest of them comes.
+        """
+        while client_console.successor is not None: # handed over by a worker
+            client_console = client_console.successor
+        input_stream = client_console.input_stream
+        data = input_stream.sanitize_input(data)
+        editor = client_console.line_editor
+        if not data or editor is None:
+            return data
+        if input_stream.character_mode:
+            data = editor.feed(data)
+        elif input_stream.linemode and input_stream.forwarding_tab:
+            data = editor.feed(data, echo=False)
+        return data
+
+    def _admission_refused(self, peer):
+        """Return why a new session from ``peer`` is refused, or None to admit it"""
+        if self.max_sessions is not None and len(self.client_sockets) >= self.max_sessions:
+            return "Too many console sessions (%d)" % self.max_sessions
+        if self.max_sessions_per_peer is not None and \
+                self._peer_sessions.get(peer, 0) >= self.max_sessions_per_peer:
+            return "Too many console sessions from %s (%d)" % (peer, self.max_sessions_per_peer)
+        return None
+
+    def _reject_client(self, client, reason):
+        """Tell a client why it was refused and close its connection"""
+        logger.warning('Refusing console session: %s', reason)
+        try:
+            client.setblocking(0)
+            client.send("%s, try again later\r\n" % reason)
+        except socket.error:
+            pass # not worth waiting for
+        client.close()
+
+    def _session_timeout(self, client, kind):
+        """Close a session whose idle or session timeout expired"""
+        if client not in self.client_sockets:
+            return
+        if kind == 'idle':
+            # rather than moving the timer on every input, check for input
+            # since it was set when it expires
+            idle = self._timers.clock() - self._last_input[client]
+            busy = self._pool is not None and self._pool.busy(client)
+            if idle < self.idle_timeout or busy:
+                delay = self.idle_timeout - idle if not busy else self.idle_timeout
+                self._client_timers[client]['idle'] = self._timers.schedule(delay, (client, 'idle'))
+                return
+            message = "idle for %d seconds" % idle
+        else:
+            message = "open for %d seconds" % self.session_timeout
+        self.timeouts += 1
+        with self.cleanup_client(client):
+            self.client_sockets[client].write("\nSession closed, %s\n" % message)
+        if client in self.client_sockets:
+            self.client_disconnect(client)
+            self._remove_client(client)
+
+    def stats(self):
+        """Return a dict of counters for the server and each of its sessions
+
+        Loop times are in seconds spent handling events (not waiting for
+        them).  Each session's entry adds the bytes sent to it and the most
+        output that was ever waiting for it to the console's ``stats()``.
+        """
+        now = time.time()
+        sessions = []
+        for client, client_console in list(self.client_sockets.items()):
+            output_buffer = self._output_buffers.get(client)
+            if output_buffer is None:
+                continue
+            session = client_console.stats()
+            session.update({
+                'fd': client.fileno(),
+                'peer': self._client_peers.get(client),
+                'connected_for': now - self._connected_at.get(client, now),
+                'bytes_out': output_buffer.bytes_sent,
+                'output_peak': output_buffer.peak,
+                'output_buffered': len(output_buffer),
+            })
+            sessions.append(session)
+        code_cache = StreamInteractiveConsole.code_cache
+        return {
+            'accepts': self.accepts,
+            'rejects': self.rejects,
+            'timeouts': self.timeouts,
+            'loop_iterations': self.loop_iterations,
+            'loop_time': self.loop_time,
+            'loop_time_max': self.loop_time_max,
+            'code_cache': code_cache.stats() if code_cache is not None else None,
+            'sessions': sessions,
+        }
+
+    def _stats_magic(self, client, client_console):
+        """%stats: show the counters of the server and its sessions"""
+        stats = self.stats()
+        lines = ["%d sessions: %d accepted, %d rejected, %d timed out" %
+                 (len(stats['sessions']), stats['accepts'], stats['rejects'], stats['timeouts'])]
+        if stats['loop_iterations']:
+            lines.append("loop: %d iterations, %.3f ms mean, %.3f ms max" %
+                         (stats['loop_iterations'],
+                          1000.0 * stats['loop_time'] / stats['loop_iterations'],
+                          1000.0 * stats['loop_time_max']))
+        if stats['code_cache'] is not None:
+            lines.append("code cache: %(hits)d hits, %(misses)d misses, "
+                         "%(size)d/%(maxsize)d entries" % stats['code_cache'])
+        lines.append("  %-5s %-16s %8s %10s %10s %10s %10s %10s" %
+                     ('fd', 'peer', 'commands', 'compile s', 'exec s',
+                      'bytes in', 'bytes out', 'out peak'))
+        for session in sorted(stats['sessions'], key=lambda session: session['fd']):
+            current = '*' if session['fd'] == client.fileno() else ' '
+            lines.append("%s %-5d %-16s %8d %10.3f %10.3f %10d %10d %10d" %
+                         (current, session['fd'], session['peer'], session['commands'],
+                          session['compile_time'], session['exec_time'],
+                          session['bytes_in'], session['bytes_out'], session['output_peak']))
+        client_console.write('\n'.join(lines) + '\n')
+
+    def _call_in_loop(self, function, *args):
+        """Have the server loop run ``function(*args)``, which changes its state
+
+        Runs it straight away if called by the loop (or with no loop running),
+        otherwise at the loop's next iteration.  Returns an event set once it
+        has run.
+        """
+        done = threading.Event()
+        if self._loop_thread is None or threading.current_thread() is self._loop_thread:
+            function(*args)
+            done.set()
+            return done
+        self._loop_calls.append((function, args, done))
+        self._waker.wake()
+        return done
+
+    def _run_loop_calls(self):
+        while self._loop_calls:
+            function, args, done = self._loop_calls.popleft()
+            try:
+                function(*args)
+            except Exception:
+                logger.exception("Error in %r called by a worker", function)
+            done.set()
+
+    def _schedule_flush(self, client):
+        """Ask the server loop to send a client's buffered output"""
+        self._flush_queue.append(client)
+        if threading.current_thread() is not self._loop_thread:
+            self._waker.wake()
+
+    def _flush_pending(self):
+        """Send output buffered since the last loop iteration"""
+        while self._flush_queue:
+            client = self._flush_queue.popleft()
+            if client not in self.client_sockets:
+                continue
+            if client not in self._writing or self._output_buffers[client].overflowed:
+                self._flush_client(client)
+
+    def _flush_client(self, client):
+        """Send what we can of a client's output, waiting on the poller for the rest"""
+        output_buffer = self._output_buffers[client]
+        if output_buffer.overflowed:
+            logger.warning('Disconnecting client %r, more than %d bytes of output waiting',
+                           client, output_buffer.high_water)
+            self.client_disconnect(client)
+            self._remove_client(client)
+            return
+        with self.cleanup_client(client):
+            empty = output_buffer.flush()
+            # input isn't read from a client which is behind on its output
+            backlogged = len(output_buffer) > output_buffer.high_water
+            writing = not empty
+            if writing != (client in self._writing) or backlogged != (client in self._backlogged):
+                events = 0 if backlogged else eventloop.EVENT_READ
+                if writing:
+                    events |= eventloop.EVENT_WRITE
+                self.poller.modify(client.fileno(), events)
+                if writing:
+                    self._writing.add(client)
+                else:
+                    self._writing.discard(client)
+                if backlogged:
+                    self._backlogged.add(client)
                 else:
-                    client_console = self.client_sockets[client]
-                    bytes = client_console.input_stream.sanitize_input(bytes)
-                    if len(bytes) == 0:
-                        continue
-                    sys.stdout = client_console.output_stream
-                    sys.stderr = client_console.output_stream
-                    try:
-                        bytes = client_console.async_recv(bytes)
-                    except (SystemExit,):
-                        sys.stdout = _stdout
-                        sys.stderr = _stderr
-                        client_console.close()
-                        client.close()
-                        del self.client_sockets[client]
-        
-        # after main loop, ensure that we perform cleanup
+                    self._backlogged.discard(client)
+
+    def _execute(self, client, client_console, bytes):
+        """Push input through a client's console (runs in a worker thread)
+
+        Clients are only ever removed by the server loop; on exit (or an
+        unexpected error) we shut down the reading side of the socket so that
+        the loop sees the disconnect and cleans up, and anything else changing the loop's state is handed
+        to it with ``_call_in_loop``.
+        """
         try:
+            with _routed_output(client_console.output_stream, client_console.displayhook):
+                client_console.async_recv(bytes)
+        except _SessionDetached:
+            self._call_in_loop(self._remove_client, client, False)
+        except (socket.error, ValueError):
+            pass # client went away while the command was running
+        except (SystemExit, Exception) as err:
+            if not isinstance(err, SystemExit):
+                logger.exception('Ending session of client %r', client)
+            try:
+                client.shutdown(socket.SHUT_RD)
+            except socket.error:
+                pass
+
+    def _json_magic(self, client, client_console):
+        """%json: switch this session to the JSON lines protocol (see ``JsonConsole``)"""
+        json_console = JsonConsole(client_console.input_stream,
+                                   self._output_buffers[client], client_console.locals)
+        client_console.input_stream.tab_completion = False
+        client_console.successor = json_console
+        self._call_in_loop(self._replace_console, client, client_console, json_console)
+        json_console.async_init()
+
+    def _replace_console(self, client, old_console, new_console):
+        if self.client_sockets.get(client) is old_console:
+            self.client_sockets[client] = new_console
+
+    def _snapshot_magic(self, client, client_console):
+        """%snapshot: continue this session in a forked child process"""
+        # stop reading from the client before the child starts to
+        stopped = self._call_in_loop(self._stop_reading, client)
+        while not stopped.wait(0.1):
+            if self.has_exit:
+                return # the server is going away, and the session with it
+        self._output_buffers[client].detach() # the child sends what is left
+        self._fork_session(client, client_console, on_connect=False)
+        raise _SessionDetached
+
+    def _stop_reading(self, client):
+        fd = client.fileno()
+        if self._fd_to_client.pop(fd, None) is not None:
+            self.poller.unregister(fd)
+
+    def _fork_session(self, client, client_console, on_connect):
+        """Fork a child process to serve ``client``, returning its pid"""
+        pid = os.fork()
+        if pid == 0:
+            self._run_snapshot_session(client, client_console, on_connect)
+        self._call_in_loop(self._snapshot_pids.add, pid)
+        return pid
+
+    def _run_snapshot_session(self, client, client_console, on_connect):
+        """Serve ``client`` from a forked child process and exit when done
+
+        Only the forking thread exists in the child, so this avoids anything
+        (such as logging) which may wait on a lock held by another thread at
+        the time of the fork.
+        """
+        try:
+            for other, console in self.client_sockets.items():
+                if other is not client:
+                    console.close()
+                    other.close()
             self.server_sock.close()
-        except socket.error:
+            if self.json_sock is not None:
+                self.json_sock.close()
+            self.poller.close()
+            client_console.magics.pop('snapshot', None)
+            client_console.output_stream.set_blocking()
+            sys.stdout = sys.stderr = client_console.output_stream
+            sys.displayhook = client_console.displayhook
+            client_console.write("Snapshot of process %d running in process %d, "
+                                 "the session ends when it exits\n" %
+                                 (os.getppid(), os.getpid()))
+            if on_connect:
+                client_console.async_init()
+            else:
+                client_console.write(sys.ps1)
+            while True:
+                nbytes = client.recv_into(self._recv_buffer)
+                if nbytes == 0:
+                    break
+                bytes = self._client_input(client_console, self._recv_view[:nbytes].tobytes())
+                if len(bytes) > 0:
+                    client_console.async_recv(bytes)
+        except SystemExit:
             pass
+        except BaseException:
+            traceback.print_exc(None, sys.__stderr__)
+        finally:
+            os._exit(0)
+
+    def _reap_snapshots(self):
+        """Collect the exit status of finished snapshot processes"""
+        for pid in list(self._snapshot_pids):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                    continue
+            except OSError:
+                pass
+            self._snapshot_pids.discard(pid)
+
+    def _remove_client(self, client, flush=True):
+        """Unregister and close the provided client and its console
+
+        Unless ``flush`` is False (the session was handed to another process),
+        a last attempt is made to send any output still buffered for the
+        client.
+        """
+        if self._pool is not None:
+            self._pool.discard(client)
+        output_buffer = self._output_buffers.pop(client, None)
+        if output_buffer is not None and flush:
+            try:
+                output_buffer.flush()
+            except socket.error:
+                pass
+        self._writing.discard(client)
+        self._backlogged.discard(client)
+        for timer in self._client_timers.pop(client, {}).values():
+            self._timers.cancel(timer)
+        self._last_input.pop(client, None)
+        self._connected_at.pop(client, None)
+        peer = self._client_peers.pop(client, None)
+        if peer is not None:
+            self._peer_sessions[peer] -= 1
+            if not self._peer_sessions[peer]:
+                del self._peer_sessions[peer]
+        console = self.client_sockets.pop(client, None)
+        fd = client.fileno()
+        if self._fd_to_client.pop(fd, None) is not None:
+            self.poller.unregister(fd)
+        if console is not None:
+            console.close()
+        if flush:
+            # closing with unread input (such as late replies to option
+            # negotiation) resets the connection, losing output in flight
+            try:
+                client.setblocking(0)
+                client.recv_into(self._recv_buffer)
+            except socket.error:
+                pass
+        client.close()
 
     @contextmanager
     def cleanup_client(self, client):
@@ -297,10 +2369,8 @@ class TelnetInteractiveConsoleServer(object):
             yield
         except Exception as err:
             logger.exception('Cleaning up client')
-            console = self.client_sockets.pop(client)
             try:
-                console.close()
-                client.close()
+                self._remove_client(client)
             except Exception as err:
                 logger.exception('Unexpected error when cleaning up client %r', err)
 
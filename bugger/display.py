@@ -0,0 +1,86 @@
+"""Incremental, bounded repr of (potentially huge) results
+
+Evaluating a large container at the console would normally build its entire
+repr in memory before writing any of it.  ``iter_repr`` instead produces the
+repr a piece at a time, walking containers lazily, so that a caller can stop
+consuming it at any point (and carry on later) without ever holding more than
+it has asked for.  Like ``repr.Repr`` (``reprlib`` on python 3), nesting
+deeper than ``max_depth`` and containers holding more than ``max_items`` are
+abbreviated with ``...``.
+
+    >>> ''.join(iter_repr({'a': [1, 2, 3]}, max_items=2))
+    "{'a': [1, 2, ...]}"
+
+"""
+
+STRING_CHUNK = 4096 # long strings are escaped this many characters at a time
+
+
+def _has_default_repr(obj, base):
+    return isinstance(obj, base) and type(obj).__repr__ is base.__repr__
+
+
+def iter_repr(obj, max_depth=8, max_items=None):
+    """Generate the pieces of the repr of ``obj``
+
+    Containers deeper than ``max_depth`` are shown as e.g. ``[...]``; only the
+    first ``max_items`` items of each container are shown (all, if None).
+    """
+    return _iter_repr(obj, max_depth, max_items, set())
+
+
+def _iter_repr(obj, depth, max_items, seen):
+    if _has_default_repr(obj, dict):
+        opening, closing, items = '{', '}', obj.iteritems()
+    elif _has_default_repr(obj, list):
+        opening, closing, items = '[', ']', obj
+    elif _has_default_repr(obj, tuple):
+        opening, closing, items = '(', ',)' if len(obj) == 1 else ')', obj
+    elif _has_default_repr(obj, set) or _has_default_repr(obj, frozenset):
+        if not obj:
+            yield repr(obj)
+            return
+        opening, closing, items = '%s([' % type(obj).__name__, '])', obj
+    elif isinstance(obj, basestring) and len(obj) > STRING_CHUNK:
+        for piece in _iter_long_string(obj):
+            yield piece
+        return
+    else:
+        yield repr(obj)
+        return
+
+    if id(obj) in seen or (depth <= 0 and len(obj) > 0):
+        yield opening + '...' + closing.lstrip(',')
+        return
+
+    seen.add(id(obj))
+    try:
+        yield opening
+        for i, item in enumerate(items):
+            if i:
+                yield ', '
+            if max_items is not None and i >= max_items:
+                yield '...'
+                break
+            if opening == '{':
+                key, item = item
+                for piece in _iter_repr(key, depth - 1, max_items, seen):
+                    yield piece
+                yield ': '
+            for piece in _iter_repr(item, depth - 1, max_items, seen):
+                yield piece
+        yield closing
+    finally:
+        seen.discard(id(obj))
+
+
+def _iter_long_string(s):
+    if isinstance(s, unicode):
+        yield "u'"
+        for start in xrange(0, len(s), STRING_CHUNK):
+            yield s[start:start + STRING_CHUNK].encode('unicode_escape').replace("'", "\\'")
+    else:
+        yield "'"
+        for start in xrange(0, len(s), STRING_CHUNK):
+            yield s[start:start + STRING_CHUNK].encode('string_escape')
+    yield "'"
@@ -0,0 +1,321 @@
+"""Event loop backends used to multiplex the console server's sockets
+
+The console server registers each socket once with a poller and then asks the
+poller which of them are ready.  This keeps the cost of a wakeup proportional
+to the number of *ready* sockets rather than the number of *connected* ones
+and avoids the FD_SETSIZE limit of ``select.select``.
+
+Three backends are provided, ``EpollPoller`` (Linux), ``PollPoller`` (most
+other unixes) and ``SelectPoller`` (everything else).  ``default_poller()``
+picks the best one available on the current platform.  A ``Waker`` lets
+other threads interrupt a loop blocked in ``poll()`` and a ``TimerWheel``
+keeps track of the loop's timeouts.
+"""
+import errno
+import fcntl
+import os
+import select
+import time
+
+EVENT_READ = 0x01
+EVENT_WRITE = 0x04
+
+
+def _is_eintr(err):
+    """Return True if the provided exception was caused by an interrupted syscall"""
+    return getattr(err, 'errno', None) == errno.EINTR or \
+        (isinstance(getattr(err, 'args', None), tuple) and
+         len(err.args) > 0 and err.args[0] == errno.EINTR)
+
+
+class Poller(object):
+    """Interface for an event loop backend
+
+    File descriptors are registered once with a mask of ``EVENT_READ`` and/or
+    ``EVENT_WRITE``.  ``poll()`` returns a list of ``(fd, events)`` tuples for
+    those file descriptors which are ready.  Error and hangup conditions are
+    reported as ``EVENT_READ`` so that the caller will discover them on its
+    next ``recv()``.
+    """
+
+    def register(self, fd, events):
+        raise NotImplementedError
+
+    def modify(self, fd, events):
+        raise NotImplementedError
+
+    def unregister(self, fd):
+        raise NotImplementedError
+
+    def poll(self, timeout=None):
+        """Wait up to ``timeout`` seconds (forever if None) for ready fds"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class EpollPoller(Poller):
+    """Poller backed by Linux's ``epoll``"""
+
+    _ERROR_MASK = select.EPOLLERR | select.EPOLLHUP if hasattr(select, 'epoll') else 0
+
+    def __init__(self):
+        self._epoll = select.epoll()
+
+    def _to_native(self, events):
+        mask = 0
+        if events & EVENT_READ:
+            mask |= select.EPOLLIN
+        if events & EVENT_WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def register(self, fd, events):
+        self._epoll.register(fd, self._to_native(events))
+
+    def modify(self, fd, events):
+        self._epoll.modify(fd, self._to_native(events))
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        try:
+            native_events = self._epoll.poll(timeout)
+        except (IOError, OSError, select.error) as err:
+            if _is_eintr(err):
+                return []
+            raise
+        ready = []
+        for fd, mask in native_events:
+            events = 0
+            if mask & (select.EPOLLIN | self._ERROR_MASK):
+                events |= EVENT_READ
+            if mask & select.EPOLLOUT:
+                events |= EVENT_WRITE
+            ready.append((fd, events))
+        return ready
+
+    def close(self):
+        self._epoll.close()
+
+
+class PollPoller(Poller):
+    """Poller backed by ``poll(2)``"""
+
+    _ERROR_MASK = select.POLLERR | select.POLLHUP | select.POLLNVAL if hasattr(select, 'poll') else 0
+
+    def __init__(self):
+        self._poll = select.poll()
+
+    def _to_native(self, events):
+        mask = 0
+        if events & EVENT_READ:
+            mask |= select.POLLIN
+        if events & EVENT_WRITE:
+            mask |= select.POLLOUT
+        return mask
+
+    def register(self, fd, events):
+        self._poll.register(fd, self._to_native(events))
+
+    def modify(self, fd, events):
+        self._poll.modify(fd, self._to_native(events))
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout=None):
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        try:
+            native_events = self._poll.poll(timeout)
+        except (IOError, OSError, select.error) as err:
+            if _is_eintr(err):
+                return []
+            raise
+        ready = []
+        for fd, mask in native_events:
+            events = 0
+            if mask & (select.POLLIN | self._ERROR_MASK):
+                events |= EVENT_READ
+            if mask & select.POLLOUT:
+                events |= EVENT_WRITE
+            ready.append((fd, events))
+        return ready
+
+
+class SelectPoller(Poller):
+    """Poller backed by ``select.select``, for platforms lacking anything better
+
+    This is subject to the platform's FD_SETSIZE limit and costs O(n) per
+    wakeup, but the registered sets are at least maintained incrementally.
+    """
+
+    def __init__(self):
+        self._readers = set()
+        self._writers = set()
+
+    def register(self, fd, events):
+        if events & EVENT_READ:
+            self._readers.add(fd)
+        if events & EVENT_WRITE:
+            self._writers.add(fd)
+
+    def modify(self, fd, events):
+        self.unregister(fd)
+        self.register(fd, events)
+
+    def unregister(self, fd):
+        self._readers.discard(fd)
+        self._writers.discard(fd)
+
+    def poll(self, timeout=None):
+        try:
+            rl, wl, xl = select.select(self._readers, self._writers, self._readers, timeout)
+        except (IOError, OSError, select.error) as err:
+            if _is_eintr(err):
+                return []
+            raise
+        ready = {}
+        for fd in rl:
+            ready[fd] = EVENT_READ
+        for fd in xl:
+            ready[fd] = EVENT_READ
+        for fd in wl:
+            ready[fd] = ready.get(fd, 0) | EVENT_WRITE
+        return ready.items()
+
+
+def default_poller():
+    """Return a new instance of the best poller available on this platform"""
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    if hasattr(select, 'poll'):
+        return PollPoller()
+    return SelectPoller()
+
+
+class Waker(object):
+    """Self-pipe which lets other threads wake a loop blocked in ``poll()``
+
+    Register ``fileno()`` for ``EVENT_READ`` and call ``drain()`` when it is
+    ready.  Any number of ``wake()`` calls before the drain cost one wakeup.
+    """
+
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        for fd in (self._read_fd, self._write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    def fileno(self):
+        return self._read_fd
+
+    def wake(self):
+        """Wake the loop (safe to call from any thread)"""
+        try:
+            os.write(self._write_fd, 'x')
+        except OSError as err:
+            # a full pipe means a wakeup is already pending
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def drain(self):
+        """Consume pending wakeups, called by the loop when ``fileno()`` is ready"""
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+class Timer(object):
+    """A timeout scheduled with a ``TimerWheel``"""
+
+    __slots__ = ('deadline', 'item', 'slot')
+
+    def __init__(self, deadline, item, slot):
+        self.deadline = deadline
+        self.item = item
+        self.slot = slot
+
+
+class TimerWheel(object):
+    """Hashed timing wheel holding the timeouts of an event loop
+
+    Timers are hashed into one of ``slots`` buckets by their deadline rounded
+    to ``resolution`` seconds, so scheduling and cancelling are O(1) however
+    many timers there are.  The loop passes ``timeout()`` to ``poll()`` and
+    calls ``expire()`` after it returns.  Timers fire up to ``resolution``
+    seconds late, never early.
+    """
+
+    def __init__(self, resolution=1.0, slots=64, clock=time.time):
+        self.resolution = resolution
+        self.clock = clock
+        self._slots = [set() for _ in range(slots)]
+        self._tick = self._tick_of(clock())
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _tick_of(self, when):
+        return int(when // self.resolution)
+
+    def schedule(self, delay, item):
+        """Schedule ``item`` to be returned by ``expire()`` after ``delay`` seconds"""
+        deadline = self.clock() + delay
+        tick = max(self._tick_of(deadline), self._tick)
+        slot = self._slots[tick % len(self._slots)]
+        timer = Timer(deadline, item, slot)
+        slot.add(timer)
+        self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        """Cancel a timer which may or may not have expired already"""
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self._count -= 1
+
+    def timeout(self):
+        """Seconds until the next timer may expire, None if there are none"""
+        if not self._count:
+            return None
+        nslots = len(self._slots)
+        for ahead in range(nslots):
+            if self._slots[(self._tick + ahead) % nslots]:
+                break
+        # timers more than one revolution away are found on the way round
+        when = (self._tick + ahead + 1) * self.resolution
+        return max(0.0, when - self.clock())
+
+    def expire(self):
+        """Remove and return the items of all timers whose deadline has passed"""
+        now = self.clock()
+        tick = self._tick_of(now)
+        nslots = len(self._slots)
+        expired = []
+        for t in range(self._tick, self._tick + min(tick - self._tick + 1, nslots)):
+            slot = self._slots[t % nslots]
+            for timer in [timer for timer in slot if timer.deadline <= now]:
+                slot.discard(timer)
+                timer.slot = None
+                expired.append(timer)
+        self._tick = tick
+        self._count -= len(expired)
+        expired.sort(key=lambda timer: timer.deadline)
+        return [timer.item for timer in expired]
@@ -0,0 +1,273 @@
+"""Fleet console: one prompt for the consoles of every worker of a server
+
+With a pre-fork server (gunicorn, uwsgi...) each worker has a console of its
+own.  The fleet console sends every command to all of them at once over the
+JSON protocol (see ``bugger.client``) and shows the answers grouped, so that
+workers which agree are listed together under a single answer::
+
+    python -m bugger.fleet --ports 7071-7102
+    python -m bugger.fleet --registry /var/run/myapp/bugger.registry
+
+    fleet>>> len(gc.get_objects())
+    [pids 4101, 4102, 4105] 183204
+    [pid 4103] 351880
+    [127.0.0.1:7075] ConnectionError: [Errno 111] Connection refused
+
+Workers are found by trying each port of a range, or by reading a registry
+file listing the address of each worker's console, one per line: the path of
+a Unix domain socket, or ``host:port``.  Blank lines and lines starting with
+``#`` are ignored.  ``%discover`` looks for them again (say, after workers were
+restarted) and ``%workers`` lists them.
+"""
+import argparse
+import codeop
+import sys
+
+from bugger import client
+
+MAX_LISTED = 8 # pids listed for a group of answers before summarizing the rest
+
+
+def parse_address(text):
+    """Return the address in ``text``, a ``host:port`` or the path of a socket"""
+    host, sep, port = text.rpartition(':')
+    if sep and port.isdigit() and '/' not in text:
+        return (host or '127.0.0.1', int(port))
+    return text
+
+
+def read_registry(path):
+    """Return the addresses listed in a registry file (none if it is missing)"""
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except IOError:
+        return []
+    addresses = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            address = parse_address(line)
+            if address not in addresses:
+                addresses.append(address)
+    return addresses
+
+
+def discover(ports=(), host='127.0.0.1', registry=None, timeout=1.0, pools=None):
+    """Return the addresses of the consoles which answer, of those in a port
+    range and in a registry file
+
+    The consoles are all tried at once, each given ``timeout`` seconds.
+    ``pools`` is passed on to ``client.fan_out``, to keep the connections.
+    """
+    candidates = [(host, port) for port in ports]
+    if registry is not None:
+        candidates.extend(address for address in read_registry(registry)
+                          if address not in candidates)
+    if not candidates:
+        return []
+    results = client.fan_out(candidates, "None", timeout=timeout, pools=pools)
+    return [address for address, response in results.items() if response['ok']]
+
+
+def format_address(address):
+    """The inverse of ``parse_address``"""
+    if isinstance(address, tuple):
+        return "%s:%d" % address
+    return address
+
+
+class Group(object):
+    """Workers which gave the same answer, and the answer they gave"""
+
+    def __init__(self, response):
+        self.response = response
+        self.labels = []
+
+    @property
+    def text(self):
+        response = self.response
+        text = response.get('stdout') or ''
+        if response['ok']:
+            if response.get('result') is not None:
+                text += response['result']
+        else:
+            error = response['error']
+            text += "%s: %s" % (error.get('type'), error.get('message'))
+        if response.get('truncated'):
+            text += ' ... (truncated)'
+        return text.rstrip('\n')
+
+    def describe(self):
+        """The workers in the group, e.g. ``pids 4101, 4102``"""
+        pids = [label for label in self.labels if isinstance(label, (int, long))]
+        others = [format_address(label) for label in self.labels
+                  if not isinstance(label, (int, long))]
+        parts = []
+        if pids:
+            pids.sort()
+            listed = ', '.join(str(pid) for pid in pids[:MAX_LISTED])
+            if len(pids) > MAX_LISTED:
+                listed += ' ... (%d more)' % (len(pids) - MAX_LISTED)
+            parts.append(('pids ' if len(pids) > 1 else 'pid ') + listed)
+        parts.extend(others)
+        return ', '.join(parts)
+
+
+def _answer_key(response):
+    if response['ok']:
+        return (True, response.get('result'), response.get('stdout'))
+    error = response['error']
+    return (False, error.get('type'), error.get('message'), response.get('stdout'))
+
+
+class FleetConsole(object):
+    """Sends each command to the consoles at ``targets`` and groups the answers
+
+    ``rediscover`` is called with no arguments for a new list of targets on
+    ``%discover``.
+    """
+    ps1 = 'fleet>>> '
+    ps2 = '... '
+
+    def __init__(self, targets, timeout=5.0, rediscover=None, pools=None):
+        self.targets = list(targets)
+        self.timeout = timeout
+        self.rediscover = rediscover
+        self.pools = pools if pools is not None else {}
+        self.buffer = []
+
+    def broadcast(self, source, op='exec'):
+        """Run ``source`` on every worker, returning the ``Group`` of each answer
+
+        Groups are ordered biggest first.  Workers which could not be reached
+        or did not answer in time are grouped by their error like the rest.
+        """
+        results = client.fan_out(self.targets, source, op=op, timeout=self.timeout,
+                                 pools=self.pools)
+        groups = {}
+        order = []
+        for address, response in results.items():
+            key = _answer_key(response)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = Group(response)
+                order.append(key)
+            pool = self.pools.get(address)
+            pid = pool.pid if pool is not None and response.get('id') is not None else None
+            group.labels.append(pid if pid is not None else address)
+        return sorted((groups[key] for key in order), key=lambda g: len(g.labels), reverse=True)
+
+    def run_source(self, source):
+        """Run a complete command everywhere and return the text to show
+
+        Expressions are evaluated, so their values are shown, and anything
+        else is executed.
+        """
+        try:
+            compile(source, '<fleet>', 'eval')
+            op = 'eval'
+        except SyntaxError:
+            op = 'exec'
+        if not self.targets:
+            return "no workers (try %discover)\n"
+        lines = []
+        for group in self.broadcast(source, op):
+            text = group.text
+            prefix = "[%s]" % group.describe()
+            if '\n' in text:
+                lines.append(prefix)
+                lines.append(text)
+            elif text:
+                lines.append("%s %s" % (prefix, text))
+            else:
+                lines.append(prefix)
+        return '\n'.join(lines) + '\n'
+
+    def push(self, line):
+        """Add a line of input, returning ``(more, output)``
+
+        ``more`` is True while the command is incomplete, as with
+        ``code.InteractiveConsole.push``.
+        """
+        if not self.buffer and line.strip().startswith('%'):
+            return False, self.run_magic(line.strip()[1:])
+        self.buffer.append(line)
+        source = '\n'.join(self.buffer)
+        try:
+            code_object = codeop.compile_command(source, '<fleet>', 'single')
+        except (SyntaxError, OverflowError, ValueError) as err:
+            self.buffer = []
+            return False, "SyntaxError: %s\n" % err
+        if code_object is None:
+            return True, ''
+        self.buffer = []
+        return False, self.run_source(source)
+
+    def run_magic(self, command):
+        name = command.split()[0] if command.split() else ''
+        if name == 'workers':
+            lines = []
+            for address in self.targets:
+                pool = self.pools.get(address)
+                pid = pool.pid if pool is not None else None
+                lines.append("%s%s" % (format_address(address),
+                                       " (pid %d)" % pid if pid is not None else ''))
+            return "%d workers\n%s" % (len(self.targets), ''.join(l + '\n' for l in lines))
+        if name == 'discover':
+            if self.rediscover is None:
+                return "nowhere to discover workers from\n"
+            self.targets = list(self.rediscover())
+            return "%d workers\n" % len(self.targets)
+        return "unknown command %%%s (try %%workers or %%discover)\n" % name
+
+    def interact(self, stdin=None, stdout=None):
+        """Read commands until end of file, like ``code.InteractiveConsole``"""
+        stdin = stdin or sys.stdin
+        stdout = stdout or sys.stdout
+        stdout.write("%d workers\n" % len(self.targets))
+        more = False
+        while True:
+            stdout.write(self.ps2 if more else self.ps1)
+            stdout.flush()
+            line = stdin.readline()
+            if not line:
+                stdout.write('\n')
+                break
+            more, output = self.push(line.rstrip('\r\n'))
+            stdout.write(output)
+
+
+def _parse_ports(value):
+    first, _, last = value.partition('-')
+    try:
+        return range(int(first), int(last or first) + 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError("not a port or range of ports: %r" % value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bugger.fleet',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('--ports', type=_parse_ports, default=[],
+                        help="port, or range of ports (first-last), of the workers' "
+                        "JSON consoles")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="host of the ports (default: %(default)s)")
+    parser.add_argument('--registry', default=None,
+                        help="file listing the workers' console addresses")
+    parser.add_argument('--timeout', type=float, default=5.0,
+                        help="seconds to wait for each worker (default: %(default)s)")
+    args = parser.parse_args(argv)
+    if not args.ports and args.registry is None:
+        parser.error("give --ports or --registry")
+
+    pools = {}
+    find = lambda: discover(args.ports, args.host, args.registry,
+                            min(args.timeout, 1.0), pools)
+    fleet = FleetConsole(find(), args.timeout, rediscover=find, pools=pools)
+    fleet.interact()
+
+
+if __name__ == '__main__':
+    main()
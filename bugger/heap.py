@@ -0,0 +1,397 @@
+"""Heap census, snapshot diffs and retention paths, for ``%heap`` and ``%why``
+
+Counting every object on a large heap in one go holds the GIL (and so stalls
+the application) for as long as it takes, starting with the single call to
+``gc.get_objects()`` which lists them all.  ``census()`` instead walks the
+heap from its roots (loaded modules and the stacks of threads) in chunks,
+sleeping briefly between chunks so that other threads get to run.  The result
+is a compact ``Snapshot`` (a count and total shallow size per type) and two
+snapshots can be diffed to show which types are growing.
+
+``find_retention_paths()`` answers "why is this object still alive?" with the
+shortest chains of references to it from module globals or thread stacks.
+
+When ``tracemalloc`` is available (python 3.4+, or a patched python 2 with the
+pytracemalloc backport) and tracing, a snapshot also records allocation sites
+and a diff shows where the growth was allocated.
+"""
+import gc
+import os
+import sys
+import thread
+import threading
+import time
+from types import FrameType
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+_SEQUENCES = (list, tuple) # read a slice per chunk by the census, when long
+_SEEN_SHARDS = 4096 # a census keeps the ids it saw in many small sets, as
+                    # resizing a set of millions would stall like gc.get_objects()
+
+
+def _type_name(tp):
+    module = getattr(tp, '__module__', None)
+    if module in (None, '__builtin__', 'builtins'):
+        return tp.__name__
+    return '%s.%s' % (module, tp.__name__)
+
+
+class Snapshot(object):
+    """Object counts and shallow sizes per type at some point in time"""
+
+    def __init__(self, types, taken, duration, traces=None):
+        self.types = types # type name -> (count, size)
+        self.taken = taken
+        self.duration = duration # seconds the census took
+        self.traces = traces # tracemalloc snapshot, if tracing
+
+    @property
+    def count(self):
+        return sum(count for count, _size in self.types.itervalues())
+
+    @property
+    def size(self):
+        return sum(size for _count, size in self.types.itervalues())
+
+    def top(self, limit=20, key='size'):
+        """Return the ``(name, count, size)`` of the ``limit`` biggest types"""
+        index = 1 if key == 'size' else 0
+        entries = sorted(self.types.iteritems(), key=lambda item: item[1][index], reverse=True)
+        return [(name, count, size) for name, (count, size) in entries[:limit]]
+
+
+def census(chunk_size=5000, pause=0.0005, untracked=False):
+    """Count the objects reachable from modules and thread stacks, by type
+
+    Objects are looked at ``chunk_size`` at a time with a ``pause`` between
+    chunks, during which other threads run; lists and tuples longer than that
+    are read a slice per chunk.  Sizes are shallow, as reported by
+    ``sys.getsizeof``.  Only objects tracked by the garbage collector (the
+    containers) are counted, unless ``untracked`` is True, when strings,
+    numbers and so on are counted too.
+
+    The heap changes while it is walked, so objects created or moved meanwhile
+    may be missed, and garbage waiting for a collection is not counted.
+    Automatic garbage collection is disabled while a chunk is counted (a
+    collection would walk the heap again, without letting go of the GIL) and
+    enabled again for the pauses.
+    """
+    start = time.time()
+    traces = None
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        traces = tracemalloc.take_snapshot()
+    types = _census(chunk_size, pause, untracked)
+    summary = {}
+    for tp, (count, size) in types.iteritems():
+        name = _type_name(tp)
+        if name in summary: # same name, different type
+            count += summary[name][0]
+            size += summary[name][1]
+        summary[name] = (count, size)
+    return Snapshot(summary, start, time.time() - start, traces)
+
+
+def _census_roots():
+    """Return the modules, and the innermost frame of each thread's stack
+
+    The frames of the census itself are left out.
+    """
+    roots = [sys.modules]
+    current = thread.get_ident()
+    for ident, frame in sys._current_frames().items():
+        if ident == current:
+            while frame is not None and frame.f_globals is globals():
+                frame = frame.f_back
+        if frame is not None:
+            roots.append(frame)
+    return roots
+
+
+def _census(chunk_size, pause, untracked):
+    types = {} # type -> [count, size]
+    seen = [set() for _ in xrange(_SEEN_SHARDS)] # ids of the objects counted
+    todo = _census_roots() # objects found, possibly already counted
+    spans = [] # [sequence, offset] for long lists and tuples being read
+    is_tracked = gc.is_tracked
+    gc_enabled = gc.isenabled()
+    try:
+        while todo or spans:
+            gc.disable()
+            if spans and len(todo) < chunk_size: # read on once the rest is done
+                span = spans[-1]
+                sequence, offset = span
+                todo.extend(sequence[offset:offset + chunk_size])
+                span[1] += chunk_size
+                if span[1] >= len(sequence):
+                    spans.pop()
+                del sequence, span
+            # take chunks off the end, dropping references as we go
+            chunk = todo[-chunk_size:]
+            del todo[-chunk_size:]
+            counted = []
+            expand = []
+            for obj in chunk:
+                obj_id = id(obj)
+                shard = seen[(obj_id >> 4) % _SEEN_SHARDS]
+                if obj_id in shard or not (untracked or is_tracked(obj)):
+                    continue
+                shard.add(obj_id)
+                counted.append(obj)
+                if type(obj) in _SEQUENCES and len(obj) > chunk_size:
+                    spans.append([obj, 0])
+                else:
+                    expand.append(obj)
+            del chunk
+            _count(types, counted)
+            todo.extend(gc.get_referents(*expand))
+            del counted, expand
+            if gc_enabled:
+                gc.enable()
+            if pause is not None:
+                time.sleep(pause)
+        # let go of the ids bit by bit as well, freeing millions takes a while
+        while seen:
+            freed = 0
+            while seen and freed < chunk_size * 20:
+                freed += len(seen.pop())
+            if pause is not None:
+                time.sleep(pause)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return types
+
+
+def _count(types, objects):
+    getsizeof = sys.getsizeof
+    for obj in objects:
+        tp = type(obj)
+        entry = types.get(tp)
+        if entry is None:
+            entry = types[tp] = [0, 0]
+        entry[0] += 1
+        try:
+            entry[1] += getsizeof(obj)
+        except Exception: # e.g. a broken __sizeof__
+            pass
+
+
+def diff(old, new, limit=20, key='size'):
+    """Return the ``(name, count change, size change)`` of the types which grew most"""
+    index = 1 if key == 'size' else 0
+    changes = []
+    for name in set(old.types) | set(new.types):
+        old_count, old_size = old.types.get(name, (0, 0))
+        new_count, new_size = new.types.get(name, (0, 0))
+        change = (new_count - old_count, new_size - old_size)
+        if change != (0, 0):
+            changes.append((name, change[0], change[1]))
+    changes.sort(key=lambda change: change[1 + index], reverse=True)
+    return changes[:limit]
+
+
+def allocation_diff(old, new, limit=10):
+    """Return lines describing the allocation sites which grew most
+
+    Empty unless both snapshots were taken while tracemalloc was tracing.
+    """
+    if old.traces is None or new.traces is None:
+        return []
+    return [str(stat) for stat in new.traces.compare_to(old.traces, 'lineno')[:limit]]
+
+
+#===============================================================================
+# Retention Paths
+#
+# To find out why an object is still alive we search breadth first from it
+# towards the roots which keep objects alive (module globals and the frames of
+# running threads), asking the garbage collector for the referrers of a whole
+# chunk of the frontier at a time.  Each such call is a pass over the heap, so
+# the number of calls is kept down by the chunking and by limits on the depth
+# and number of objects searched, with a pause between calls so that other
+# threads keep running.  Objects are tracked by id; everything the search
+# itself holds (its frontier, the calling thread's frames) is ignored.
+#===============================================================================
+class RetentionPaths(object):
+    """Result of ``find_retention_paths``
+
+    ``paths`` is a list of ``(root label, [root, ..., obj])``, shortest first.
+    ``searched`` objects were looked at, to a depth of ``depth``; ``limited``
+    is True if the search stopped at a limit rather than running out of
+    referrers.
+    """
+
+    def __init__(self, paths, searched, depth, limited):
+        self.paths = paths
+        self.searched = searched
+        self.depth = depth
+        self.limited = limited
+
+
+def _roots(extra_roots):
+    """Return the labels of the roots by id, and the frames of other threads"""
+    roots = {}
+    frames = []
+    for name, module in sys.modules.items():
+        if module is not None:
+            roots[id(module.__dict__)] = "module %s" % name
+    names = dict((t.ident, t.name) for t in threading.enumerate())
+    current = thread.get_ident()
+    for ident, frame in sys._current_frames().items():
+        if ident == current:
+            continue
+        while frame is not None:
+            code = frame.f_code
+            roots[id(frame)] = "thread %s, frame %s (%s:%d)" % (
+                names.get(ident, ident), code.co_name,
+                os.path.basename(code.co_filename), frame.f_lineno)
+            frames.append(frame)
+            frame = frame.f_back
+    for obj, label in extra_roots or ():
+        roots[id(obj)] = label
+    return roots, frames
+
+
+def find_retention_paths(obj, max_paths=3, max_depth=12, max_nodes=50000,
+                         chunk_size=1000, pause=0.0005, extra_roots=None):
+    """Find the shortest chains of references keeping ``obj`` alive
+
+    Stops after ``max_paths`` chains, ``max_depth`` references or looking at
+    ``max_nodes`` objects.  ``extra_roots`` is a list of ``(object, label)``
+    for further objects to treat as roots, such as a console's namespace.  Frames of the
+    calling thread are never considered.
+    """
+    roots, frames = _roots(extra_roots)
+    # the garbage collector does not report running frames as referrers
+    frame_referents = {} # id -> frames referring to it
+    for frame in frames:
+        for referent in gc.get_referents(frame):
+            frame_referents.setdefault(id(referent), []).append(frame)
+    del frames
+    ignore = set()
+    frame = sys._getframe()
+    while frame is not None:
+        ignore.add(id(frame))
+        frame = frame.f_back
+    del frame
+    nodes = {id(obj): obj} # id -> object, for everything found so far
+    towards = {id(obj): None} # id -> id of the object it refers to, on the way to obj
+    ignore.add(id(nodes))
+    frontier = [id(obj)]
+    found = []
+    depth = 0
+    limited = False
+    while frontier and len(found) < max_paths:
+        if depth >= max_depth or len(nodes) >= max_nodes:
+            limited = True
+            break
+        depth += 1
+        next_frontier = []
+        for start in xrange(0, len(frontier), chunk_size):
+            chunk = tuple(nodes[node_id] for node_id in frontier[start:start + chunk_size])
+            chunk_ids = set(frontier[start:start + chunk_size])
+            referrers = gc.get_referrers(*chunk)
+            for node_id in chunk_ids:
+                referrers.extend(frame_referents.get(node_id, ()))
+            ignore.update((id(chunk), id(referrers)))
+            for referrer in referrers:
+                referrer_id = id(referrer)
+                if referrer_id in towards or referrer_id in ignore:
+                    continue
+                towards[referrer_id] = _referent_in(referrer, chunk_ids)
+                nodes[referrer_id] = referrer
+                if referrer_id in roots:
+                    found.append(referrer_id)
+                    if len(found) >= max_paths:
+                        break
+                else:
+                    next_frontier.append(referrer_id)
+            # ids of dead objects get reused, so stop ignoring them
+            ignore.difference_update((id(chunk), id(referrers)))
+            del chunk, referrers
+            if len(found) >= max_paths or len(nodes) >= max_nodes:
+                break
+            if pause is not None:
+                time.sleep(pause)
+        frontier = next_frontier
+
+    paths = []
+    for root_id in found:
+        path = []
+        node_id = root_id
+        while node_id is not None:
+            path.append(nodes[node_id])
+            node_id = towards[node_id]
+        paths.append((roots[root_id], path))
+    return RetentionPaths(paths, len(nodes), depth, limited)
+
+
+def _referent_in(referrer, ids):
+    for referent in gc.get_referents(referrer):
+        if id(referent) in ids:
+            return id(referent)
+    return None
+
+
+def _describe_reference(referrer, referent):
+    """How ``referrer`` refers to ``referent``, e.g. ``['key']`` or ``[3]``"""
+    if isinstance(referrer, dict):
+        for key, value in referrer.iteritems():
+            if value is referent:
+                return "[%s]" % _short(key)
+            if key is referent:
+                return "(a key)"
+    elif isinstance(referrer, (list, tuple)):
+        for index, value in enumerate(referrer):
+            if value is referent:
+                return "[%d]" % index
+    elif isinstance(referrer, FrameType):
+        for name, value in referrer.f_locals.iteritems():
+            if value is referent:
+                return "local %s" % name
+    for attr in ('__dict__', 'func_closure', 'func_globals', 'func_defaults',
+                 'im_self', 'im_func', '__self__', 'cell_contents', '__class__', '__bases__'):
+        try:
+            if getattr(referrer, attr) is referent:
+                return "." + attr
+        except Exception:
+            pass
+    return "(refers to)"
+
+
+def _short(obj, size=40):
+    try:
+        text = repr(obj)
+    except Exception:
+        text = '<%s>' % type(obj).__name__
+    return text if len(text) <= size else text[:size - 3] + '...'
+
+
+def _label(obj):
+    return "%s at 0x%x" % (_type_name(type(obj)), id(obj))
+
+
+def iter_path_lines(root_label, path):
+    """Generate lines describing a path found by ``find_retention_paths``
+
+    A reference through an object's ``__dict__`` is shown as ``.attribute``.
+    """
+    yield root_label
+    i = 0
+    while i < len(path) - 1:
+        referrer, referent = path[i], path[i + 1]
+        if i + 2 < len(path) and getattr(referrer, '__dict__', None) is referent \
+                and isinstance(referent, dict):
+            edge = _describe_reference(referent, path[i + 2])
+            if edge.startswith("['") and edge.endswith("']"):
+                edge = '.' + edge[2:-2]
+            i += 1
+            referent = path[i + 1]
+        else:
+            edge = _describe_reference(referrer, referent)
+        yield "  %s -> %s" % (edge, _label(referent))
+        i += 1
@@ -0,0 +1,200 @@
+"""Console servers for the workers of a pre-fork server (gunicorn, uwsgi...)
+
+A ``TelnetInteractiveConsoleServer`` started before the fork is inherited by
+every worker: they all share its listening socket, so a connection lands on
+whichever worker, while its server thread only runs in the parent.  One
+created in each worker after the fork collides on the port instead.
+``PreforkConsole`` is set up once, before the fork or at import, and gives
+each worker a server of its own when ``start()`` is first called there::
+
+    console = PreforkConsole('unix', directory='/var/run/myapp')
+
+    # in gunicorn.conf.py
+    def post_fork(server, worker):
+        console.start()
+
+``start()`` costs next to nothing once the worker's server is running, so it
+may as well be called on the request path, to start consoles lazily.  Where
+each worker listens depends on ``mode``:
+
+``'unix'``
+    Unix domain sockets named by pid in ``directory``: ``bugger-<pid>.sock``
+    for telnet (``socat - UNIX-CONNECT:bugger-<pid>.sock``) and
+    ``bugger-<pid>.json.sock`` for the JSON protocol.
+
+``'port_base'``
+    ``port`` plus the worker's index (and ``json_port`` plus the index, if
+    given).  The index is passed to ``start()``, or else the first free one
+    up to ``max_workers`` is taken.
+
+``'reuseport'``
+    Every worker listens on ``port`` (and ``json_port``) with SO_REUSEPORT,
+    and the kernel hands each connection to one of them.  Good enough to get
+    at "a worker"; the JSON protocol's hello says which.
+
+In the first two modes each worker adds the address of its JSON console (its
+telnet console, without one) to a ``registry`` file, ``bugger.registry`` in
+``directory`` by default, and removes it when the worker exits: that is what
+the fleet console reads (``python -m bugger.fleet --registry ...``).
+"""
+import atexit
+import errno
+import fcntl
+import os
+import socket
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from bugger.console import TelnetInteractiveConsoleServer
+from bugger.fleet import format_address, parse_address
+
+MODES = ('unix', 'port_base', 'reuseport')
+
+
+@contextmanager
+def _locked_registry(path):
+    """Yield the lines of a registry file, written back after the block"""
+    f = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0644), 'r+')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX) # released by closing
+        lines = [line.strip() for line in f if line.strip()]
+        yield lines
+        f.seek(0)
+        f.truncate()
+        f.write(''.join(line + '\n' for line in lines))
+    finally:
+        f.close()
+
+
+def register(path, address):
+    """Add ``address`` to the registry file at ``path``
+
+    Entries for Unix domain sockets whose file is gone (their worker was
+    killed without removing its entry) are dropped on the way.
+    """
+    entry = format_address(address)
+    with _locked_registry(path) as lines:
+        lines[:] = [line for line in lines if line != entry and (
+            line.startswith('#') or not isinstance(parse_address(line), basestring)
+            or os.path.exists(line))]
+        lines.append(entry)
+
+
+def unregister(path, address):
+    """Remove ``address`` from the registry file at ``path``"""
+    entry = format_address(address)
+    with _locked_registry(path) as lines:
+        lines[:] = [line for line in lines if line != entry]
+
+
+class PreforkConsole(object):
+    """A console server per worker process, started by ``start()`` in each
+
+    Other keyword arguments (``locals``, ``workers``...) are passed on to
+    ``TelnetInteractiveConsoleServer``.
+    """
+
+    def __init__(self, mode='unix', directory=None, name='bugger', host='127.0.0.1',
+                 port=7070, json_port=None, max_workers=64, registry=None,
+                 **server_options):
+        if mode not in MODES:
+            raise ValueError("mode must be one of %s" % ', '.join(MODES))
+        self.mode = mode
+        self.directory = directory if directory is not None else tempfile.gettempdir()
+        self.name = name
+        self.host = host
+        self.port = port
+        self.json_port = json_port
+        self.max_workers = max_workers
+        if registry is None and mode != 'reuseport':
+            registry = os.path.join(self.directory, name + '.registry')
+        self.registry = registry
+        self.server_options = server_options
+        self.server = None
+        self.worker_index = None
+        self._registered = None
+        self._thread = None
+        self._pid = None # the process self.server belongs to
+        self._lock = threading.Lock()
+        atexit.register(self._at_exit) # inherited by the workers
+
+    def start(self, worker_index=None):
+        """Start this process's console server, unless it is running already
+
+        A server inherited from the parent process is closed (in this process
+        only) first.  Returns the server.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return self.server
+        with self._lock:
+            if self._pid == pid: # another thread got here first
+                return self.server
+            if self.server is not None:
+                self.server.close_sockets()
+                self.server = None
+            server = self._listen(worker_index)
+            self._thread = threading.Thread(target=server.accept_interactions,
+                                            name='bugger-console')
+            self._thread.daemon = True
+            self._thread.start()
+            self.server = server
+            self._pid = pid
+            self._registered = None
+            if self.registry is not None:
+                self._registered = server.json_address or server.address
+                register(self.registry, self._registered)
+            return server
+
+    def _socket_path(self, suffix):
+        return os.path.join(self.directory, '%s-%d%s' % (self.name, os.getpid(), suffix))
+
+    def _listen(self, worker_index):
+        options = dict(self.server_options, host=self.host, port=self.port,
+                       json_port=self.json_port)
+        if self.mode == 'unix':
+            options['unix_socket'] = self._socket_path('.sock')
+            options['json_unix_socket'] = self._socket_path('.json.sock')
+        elif self.mode == 'reuseport':
+            options['reuse_port'] = True
+        if self.mode != 'port_base':
+            server = TelnetInteractiveConsoleServer(**options)
+            server.listen()
+            return server
+
+        indexes = [worker_index] if worker_index is not None else range(self.max_workers)
+        for index in indexes:
+            options['port'] = self.port + index
+            if self.json_port is not None:
+                options['json_port'] = self.json_port + index
+            server = TelnetInteractiveConsoleServer(**options)
+            try:
+                server.listen()
+            except socket.error as err:
+                server.close_sockets()
+                if err.args[0] != errno.EADDRINUSE or worker_index is not None:
+                    raise
+                continue # taken by another worker
+            self.worker_index = index
+            return server
+        raise socket.error(errno.EADDRINUSE, "ports %d to %d are all in use" %
+                           (self.port, self.port + self.max_workers - 1))
+
+    def stop(self, timeout=5.0):
+        """Stop this process's console server, if it started one"""
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            if self._registered is not None:
+                unregister(self.registry, self._registered)
+                self._registered = None
+            self.server.stop(timeout)
+            self.server = None
+            self._pid = None
+
+    def _at_exit(self):
+        try:
+            self.stop(timeout=1.0)
+        except Exception: # the process is exiting, don't get in its way
+            pass
@@ -0,0 +1,241 @@
+"""Profiling helpers behind the console's ``%profile`` and ``%sample`` commands
+
+``iter_report`` turns a ``cProfile.Profile`` into a ranked table of functions
+which fits a terminal of a given width, a line at a time.  ``Sampler`` is a
+low overhead sampling profiler of the whole process (``%sample``).
+"""
+import collections
+import os
+import pstats
+import sys
+import thread
+import threading
+import time
+
+SORT_KEYS = {
+    'cumulative': 3, # index of the time in a pstats entry (cc, nc, tt, ct, callers)
+    'tottime': 2,
+}
+
+
+def _function_label(func):
+    filename, lineno, name = func
+    if filename == '~' and lineno == 0: # built in
+        return name
+    return "%s (%s:%d)" % (name, os.path.basename(filename), lineno)
+
+
+def _shorten(text, width):
+    if len(text) <= width:
+        return text
+    return "..." + text[-(width - 3):] if width > 3 else text[:width]
+
+
+def iter_report(profiler, sort='cumulative', limit=20, width=80):
+    """Generate the lines of a report of the top ``limit`` functions
+
+    ``sort`` is 'cumulative' (time in the function and what it called) or
+    'tottime' (time in the function itself).  Function names are shortened
+    from the left to keep the lines within ``width`` characters.
+    """
+    stats = pstats.Stats(profiler)
+    key = SORT_KEYS[sort]
+    entries = sorted(stats.stats.iteritems(), key=lambda item: item[1][key], reverse=True)
+    yield "%d function calls (%d primitive) in %.3f seconds, by %s time" % (
+        stats.total_calls, stats.prim_calls, stats.total_tt, sort)
+    yield "%10s %9s %9s  %s" % ('ncalls', 'tottime', 'cumtime', 'function')
+    label_width = max(width - 32, 10)
+    for func, (cc, nc, tt, ct, _callers) in entries[:limit]:
+        ncalls = str(nc) if nc == cc else "%d/%d" % (nc, cc)
+        yield "%10s %9.4f %9.4f  %s" % (ncalls, tt, ct,
+                                        _shorten(_function_label(func), label_width))
+    if len(entries) > limit:
+        yield "(%d more functions)" % (len(entries) - limit)
+
+
+#===============================================================================
+# Sampling Profiler
+#
+# Rather than tracing every call, the sampler wakes up periodically and looks
+# at what every thread is doing through ``sys._current_frames()``.  Stacks are
+# folded into a trie (one node per distinct call path) so memory is bounded by
+# the number of distinct paths rather than the number of samples.
+#===============================================================================
+class _Node(object):
+    """Node of the stack trie: samples through this path and ending here"""
+
+    __slots__ = ('total', 'own', 'children')
+
+    def __init__(self):
+        self.total = 0
+        self.own = 0
+        self.children = {}
+
+
+def _code_label(code):
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+class Sampler(object):
+    """Background thread sampling the stacks of every other thread
+
+    Samples are taken every ``interval`` seconds.  The time spent sampling is
+    measured and, should it exceed ``max_overhead`` (a fraction of the time
+    elapsed), the sampler backs off to keep within it.  Stacks deeper than
+    ``max_depth`` are cut short at the outermost frames and once the trie has
+    ``max_nodes`` nodes new paths are counted against their deepest known
+    ancestor; both are counted in ``truncated``.
+    """
+
+    def __init__(self, interval=0.01, max_overhead=0.02, max_depth=128, max_nodes=100000):
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all samples taken so far"""
+        with self._lock:
+            self.root = _Node()
+            self.nodes = 1
+            self.samples = 0
+            self.truncated = 0
+            self.sampling_time = 0.0
+            self.elapsed = 0.0
+            self._own = collections.defaultdict(int) # code -> samples where it ran
+            self._inclusive = collections.defaultdict(int) # code -> samples it was on the stack
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(name='bugger-sampler', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        delay = self.interval
+        last = time.time()
+        while not self._stop.wait(delay):
+            start = time.time()
+            self.sample()
+            now = time.time()
+            cost = now - start
+            with self._lock:
+                self.sampling_time += cost
+                self.elapsed += now - last
+            last = now
+            # sleep long enough that sampling stays within max_overhead
+            delay = max(self.interval, cost / self.max_overhead - cost)
+
+    def sample(self, frames=None):
+        """Take one sample of every thread's stack (except the calling thread's)"""
+        if frames is None:
+            frames = sys._current_frames()
+        current = thread.get_ident()
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        with self._lock:
+            self.samples += 1
+            for ident, frame in frames.iteritems():
+                if ident == current:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                if frame is not None:
+                    self.truncated += 1
+                stack.reverse()
+                self._add(names.get(ident, str(ident)), stack)
+
+    def _add(self, thread_name, stack):
+        # called with self._lock held
+        node = self.root.children.get(thread_name)
+        if node is None: # thread nodes don't count against max_nodes
+            node = self.root.children[thread_name] = _Node()
+        node.total += 1
+        for code in stack:
+            child = self._child(node, code)
+            if child is None:
+                self.truncated += 1
+                break
+            node = child
+            node.total += 1
+        node.own += 1
+        if stack:
+            self._own[stack[-1]] += 1
+            for code in set(stack):
+                self._inclusive[code] += 1
+
+    def _child(self, node, key):
+        child = node.children.get(key)
+        if child is None:
+            if self.nodes >= self.max_nodes:
+                return None
+            child = node.children[key] = _Node()
+            self.nodes += 1
+        return child
+
+    def stats(self):
+        """Return a dict describing the samples taken and what they cost"""
+        with self._lock:
+            return {
+                'running': self.running,
+                'interval': self.interval,
+                'samples': self.samples,
+                'nodes': self.nodes,
+                'truncated': self.truncated,
+                'elapsed': self.elapsed,
+                'sampling_time': self.sampling_time,
+                'overhead': self.sampling_time / self.elapsed if self.elapsed else 0.0,
+            }
+
+    def iter_collapsed(self):
+        """Generate the samples as collapsed stacks, as used by flamegraph.pl"""
+        with self._lock:
+            entries = list(self._iter_paths(self.root, []))
+        for path, count in entries:
+            yield "%s %d" % (';'.join(path), count)
+
+    def _iter_paths(self, node, path):
+        for key, child in node.children.iteritems():
+            label = key if isinstance(key, basestring) else _code_label(key)
+            path.append(label.replace(';', ':').replace(' ', '_'))
+            if child.own:
+                yield list(path), child.own
+            for entry in self._iter_paths(child, path):
+                yield entry
+            path.pop()
+
+    def iter_top(self, limit=20, width=80):
+        """Generate a table of the functions seen most, by samples running them"""
+        with self._lock:
+            total = sum(self._own.itervalues())
+            entries = sorted(self._inclusive.iteritems(),
+                             key=lambda item: (self._own.get(item[0], 0), item[1]),
+                             reverse=True)
+            own = dict(self._own)
+        yield "%d samples of %d stacks" % (self.samples, total)
+        if not total:
+            return
+        yield "%7s %7s  %s" % ('own %', 'total %', 'function')
+        label_width = max(width - 17, 10)
+        for code, inclusive in entries[:limit]:
+            yield "%7.1f %7.1f  %s" % (100.0 * own.get(code, 0) / total,
+                                       100.0 * inclusive / total,
+                                       _shorten(_code_label(code), label_width))
@@ -0,0 +1,96 @@
+import os
+import telnetlib
+import threading
+import sys
+import time
+import unittest
+
+# TODO: hack!
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from bugger import aioconsole
+
+@unittest.skipIf(aioconsole.asyncio is None, "asyncio/trollius not available")
+class TestAsyncTelnetConsoleServer(unittest.TestCase):
+    # Test the AsyncTelnetConsoleServer running on a loop in another thread,
+    # the way an application with its own loop would embed it.
+
+    HOST = '127.0.0.1'
+    PORT = 5666 # unlikely to be in use
+
+    def setUp(self):
+        asyncio = aioconsole.asyncio
+        self.remote_session_locals = {}
+        self.loop = asyncio.new_event_loop()
+        self.server_console = aioconsole.AsyncTelnetConsoleServer(
+            host=self.HOST,
+            port=self.PORT,
+            locals=self.remote_session_locals)
+        self.loop.run_until_complete(self.server_console.start(self.loop))
+        self.loop_thread = threading.Thread(target=self.loop.run_forever)
+        self.loop_thread.start()
+
+    def tearDown(self):
+        asyncio = aioconsole.asyncio
+        def shutdown():
+            waiter = self.server_console.stop()
+            asyncio.ensure_future(waiter, loop=self.loop).add_done_callback(
+                lambda f: self.loop.stop())
+        self.loop.call_soon_threadsafe(shutdown)
+        self.loop_thread.join()
+        self.loop.close()
+
+    def _make_telnet_connection(self):
+        telnet_connection = telnetlib.Telnet()
+        telnet_connection.open(self.HOST, self.PORT, 5.0)
+        telnet_connection.read_until(">>> ", 1.0)
+        return telnet_connection
+
+    def test_basic_interaction(self):
+        tc = self._make_telnet_connection()
+        try:
+            tc.write("a = 3.14\r\n")
+            self.assertEqual(tc.read_until(">>> ", 1.0), ">>> ")
+            tc.write("print int(a * 1000)\r\n")
+            self.assertEqual(tc.read_until(">>> ", 1.0), "3140\r\n>>> ")
+            self.assertEqual(self.remote_session_locals['a'], 3.14)
+        finally:
+            tc.close()
+
+    def test_slow_command_does_not_block_loop(self):
+        tc1 = self._make_telnet_connection()
+        try:
+            tc1.write("import time; time.sleep(1.0); 'slow'\r\n")
+            time.sleep(0.1)
+
+            # the application's own callbacks still run...
+            ran = threading.Event()
+            self.loop.call_soon_threadsafe(ran.set)
+            self.assertTrue(ran.wait(0.5))
+
+            # ... and new sessions are still accepted and greeted
+            start = time.time()
+            tc2 = self._make_telnet_connection()
+            tc2.close()
+            self.assertTrue(time.time() - start < 0.5)
+
+            self.assertEqual(tc1.read_until(">>> ", 2.0), "'slow'\r\n>>> ")
+        finally:
+            tc1.close()
+
+    def test_input_order_kept_within_session(self):
+        tc = self._make_telnet_connection()
+        try:
+            tc.write("import time; time.sleep(0.2); x = 1\r\n")
+            time.sleep(0.05)
+            tc.write("x += 1\r\n")
+            time.sleep(0.05)
+            tc.write("x\r\n")
+            output = tc.read_until("2\r\n>>> ", 2.0)
+            self.assertTrue(output.endswith("2\r\n>>> "), output)
+            self.assertFalse("Error" in output, output)
+        finally:
+            tc.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import os
+import sys
+import unittest
+
+# TODO: hack!
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from bugger import bench
+
+class TestPercentile(unittest.TestCase):
+
+    def test_nearest_rank(self):
+        values = range(1, 101)
+        self.assertEqual(bench.percentile(values, 50), 50)
+        self.assertEqual(bench.percentile(values, 99), 99)
+        self.assertEqual(bench.percentile([3], 99), 3)
+        self.assertEqual(bench.percentile([], 50), None)
+
+class TestRun(unittest.TestCase):
+
+    def test_short_run(self):
+        result = bench.run(sessions=3, duration=None, commands_per_session=4,
+                           output_size=1000, paste_size=1000)
+        self.assertEqual(result['latency']['commands'], 12)
+        self.assertEqual(sum(kind['commands'] for kind in result['by_kind'].values()), 12)
+        self.assertTrue(result['latency']['p50_ms'] <= result['latency']['p99_ms'])
+        self.assertTrue(result['server']['max_rss_bytes'] > 0)
+
+if __name__ == '__main__':
+    unittest.main()
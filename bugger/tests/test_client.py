@@ -0,0 +1,131 @@
+import errno
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+import unittest
+
+# TODO: hack!
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from bugger import client
+from bugger import console
+
+class TestClient(unittest.TestCase):
+    # Talk to a console server over its JSON port, and its telnet port
+
+    HOST = '127.0.0.1'
+    PORT = 5665
+    JSON_PORT = 5666
+
+    def setUp(self):
+        self.locals = {'shared': 42}
+        self._start()
+
+    def _start(self):
+        self.server_console = console.TelnetInteractiveConsoleServer(
+            host=self.HOST, port=self.PORT, json_port=self.JSON_PORT,
+            locals=self.locals, workers=2)
+        self.server_console.listen()
+        self.server_thread = threading.Thread(target=self.server_console.accept_interactions)
+        self.server_thread.start()
+
+    def _stop(self):
+        self.server_console.stop()
+        self.server_thread.join()
+
+    def tearDown(self):
+        self._stop()
+
+    def test_eval_and_exec(self):
+        connection = client.Connection((self.HOST, self.JSON_PORT), 5.0)
+        self.addCleanup(connection.close)
+        self.assertEqual(connection.pid, os.getpid())
+        self.assertEqual(connection.eval("shared + 1"), '43')
+        self.assertEqual(connection.exec_("x = shared\nprint x"), '42\n')
+        with self.assertRaises(client.RemoteError) as context:
+            connection.eval("1 / 0")
+        self.assertEqual(context.exception.type, 'ZeroDivisionError')
+        responses = connection.pipeline([('eval', 'x + %d' % i) for i in range(20)])
+        self.assertEqual([r['result'] for r in responses], [str(42 + i) for i in range(20)])
+
+    def test_handshake(self):
+        connection = client.Connection((self.HOST, self.PORT), 5.0, handshake=True)
+        self.addCleanup(connection.close)
+        self.assertEqual(connection.eval("shared"), '42')
+
+    def test_pool_reuses_connections(self):
+        pool = client.ConnectionPool((self.HOST, self.JSON_PORT), timeout=5.0)
+        self.addCleanup(pool.close)
+        for i in range(5):
+            self.assertEqual(pool.eval("shared"), '42')
+        self.assertEqual(pool.connects, 1)
+
+    def test_pool_reconnects(self):
+        pool = client.ConnectionPool((self.HOST, self.JSON_PORT), timeout=5.0)
+        self.addCleanup(pool.close)
+        self.assertEqual(pool.eval("shared"), '42')
+        self._stop() # closes the pooled connection
+        self._start()
+        self.assertEqual(pool.eval("shared"), '42')
+        self.assertEqual(pool.connects, 2)
+
+    def test_stale_check_past_fd_setsize(self):
+        if resource.getrlimit(resource.RLIMIT_NOFILE)[0] < 1100:
+            self.skipTest("too few file descriptors allowed")
+        fillers = [] # use up the descriptors below select()'s FD_SETSIZE (1024)
+        while not fillers or fillers[-1] < 1024:
+            fillers.append(os.open(os.devnull, os.O_RDONLY))
+        try:
+            connection = client.Connection((self.HOST, self.JSON_PORT), 5.0)
+        finally:
+            for fd in fillers:
+                os.close(fd)
+        self.addCleanup(connection.close)
+        self.assertTrue(connection.sock.fileno() > 1024)
+        self.assertFalse(connection.is_stale())
+        self.assertEqual(connection.eval("shared"), '42')
+        self._stop()
+        self._start()
+        self.assertTrue(connection.is_stale())
+
+    def test_pool_retries_unsent_requests(self):
+        pool = client.ConnectionPool((self.HOST, self.JSON_PORT), timeout=5.0)
+        self.addCleanup(pool.close)
+        pool.exec_("runs = 0")
+        def refuse(data):
+            raise client.SendError("broken")
+        pool._idle[-1]._send = refuse
+        self.assertEqual(pool.exec_("runs += 1"), '')
+        self.assertEqual(pool.connects, 2)
+
+    def test_pool_does_not_retry_sent_requests(self):
+        pool = client.ConnectionPool((self.HOST, self.JSON_PORT), timeout=5.0)
+        self.addCleanup(pool.close)
+        pool.exec_("runs = 0")
+        def reset():
+            raise socket.error(errno.ECONNRESET, "reset")
+        pool._idle[-1]._readline = reset
+        self.assertRaises(socket.error, pool.exec_, "runs += 1")
+        self.assertEqual(pool.connects, 1) # not sent again on a new connection
+        self.assertNotEqual(pool.eval("runs"), '2')
+
+    def test_fan_out(self):
+        good = (self.HOST, self.JSON_PORT)
+        unreachable = (self.HOST, 5667)
+        results = client.fan_out([good, unreachable], "shared", timeout=2.0)
+        self.assertEqual(results.keys(), [good, unreachable])
+        self.assertEqual(results[good]['result'], '42')
+        self.assertEqual(results[unreachable]['error']['type'], 'ConnectionError')
+
+    def test_fan_out_timeout(self):
+        target = (self.HOST, self.JSON_PORT)
+        results = client.fan_out([target], "__import__('time').sleep(0.3)", timeout=0.1)
+        self.assertEqual(results[target]['error']['type'], 'Timeout')
+        time.sleep(0.5) # the request's thread has finished by now
+        self.assertEqual(results[target]['error']['type'], 'Timeout')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import sys
+import types
+import unittest
+
+# TODO: hack!
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from bugger import completion
+
+class Thing(object):
+    size = 3
+
+    def method(self):
+        pass
+
+class TestCompleter(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.index = completion.AttributeIndex(ttl=5.0, clock=lambda: self.now)
+        self.module = types.ModuleType('big')
+        for i in range(1000):
+            setattr(self.module, 'name%04d' % i, i)
+        self.namespace = {'thing': Thing(), 'big': self.module, 'foo_bar': 1, 'foo_baz': len}
+        self.completer = completion.Completer(self.namespace, index=self.index,
+                                              clock=lambda: self.now)
+
+    def test_global_matches(self):
+        result = self.completer.complete('foo_')
+        self.assertEqual(result.matches, ['foo_bar', 'foo_baz('])
+        self.assertEqual(result.prefix, 'foo_ba')
+        self.assertEqual(self.completer.complete('whi').matches, ['while']) # keyword
+        self.assertEqual(self.completer.complete('isinst').prefix, 'isinstance(') # builtin
+        self.assertEqual(self.completer.complete('nothing_like_this').total, 0)
+
+    def test_attr_matches(self):
+        self.assertEqual(self.completer.complete('thing.me').matches, ['thing.method('])
+        self.assertEqual(self.completer.complete('thing.si').prefix, 'thing.size')
+        self.assertTrue('thing.__class__(' in self.completer.complete('thing.__cl').matches)
+        result = self.completer.complete('big.name01', limit=5)
+        self.assertEqual(result.total, 100)
+        self.assertEqual(result.matches, ['big.name%04d' % i for i in range(100, 105)])
+        self.assertEqual(result.prefix, 'big.name01')
+        self.assertEqual(self.completer.complete('missing.x').total, 0)
+        self.assertEqual(self.completer.complete('foo_bar.real.im').matches,
+                         ['foo_bar.real.imag'])
+
+    def test_attributes_cached(self):
+        self.completer.complete('big.name')
+        self.completer.complete('big.name0')
+        self.assertEqual((self.index.hits, self.index.misses), (1, 1))
+
+    def test_cache_invalidated(self):
+        self.assertEqual(self.completer.complete('big.new').total, 0)
+        self.module.new_name = 1 # the module's __dict__ grew
+        self.assertEqual(self.completer.complete('big.new').matches, ['big.new_name'])
+        del self.module.name0000
+        self.module.other_name = 1 # same size, picked up once the entry expires
+        self.assertEqual(self.completer.complete('big.oth').total, 0)
+        self.now += 10
+        self.assertEqual(self.completer.complete('big.oth').matches, ['big.other_name'])
+
+    def test_namespace_invalidated(self):
+        self.assertEqual(self.completer.complete('new_').total, 0)
+        self.namespace['new_global'] = 1
+        self.assertEqual(self.completer.complete('new_').matches, ['new_global'])
+
+    def test_name_removed_since_indexed(self):
+        self.namespace['zzz_gone'] = 1
+        self.assertEqual(self.completer.complete('zzz').matches, ['zzz_gone'])
+        del self.namespace['zzz_gone']
+        self.namespace['other'] = 1 # same size, so the index is used again
+        result = self.completer.complete('zzz')
+        self.assertEqual((result.matches, result.prefix), ([], 'zzz'))
+
+if __name__ == '__main__':
+    unittest.main()
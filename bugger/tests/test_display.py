@@ -0,0 +1,44 @@
+import collections
+import os
+import sys
+import unittest
+
+# TODO: hack!
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from bugger import display
+
+def bounded_repr(obj, **kwargs):
+    return ''.join(display.iter_repr(obj, **kwargs))
+
+class TestIterRepr(unittest.TestCase):
+
+    def test_matches_repr(self):
+        for obj in [{'a': [1, 2, (3,)]}, (), (1,), [], {}, set([1]), set(),
+                    frozenset(['x']), 'text', u'unicode', None, 3.5,
+                    collections.OrderedDict(a=1), collections.defaultdict(list)]:
+            self.assertEqual(bounded_repr(obj), repr(obj))
+
+    def test_long_strings(self):
+        for s in ["a'b\"\n\xff" * 2000, u"a'b\"\n\u1234" * 2000]:
+            self.assertEqual(eval(bounded_repr(s)), s)
+
+    def test_recursive(self):
+        l = [1]
+        l.append(l)
+        self.assertEqual(bounded_repr(l), "[1, [...]]")
+
+    def test_limits(self):
+        self.assertEqual(bounded_repr([[[[1]]]], max_depth=2), "[[[...]]]")
+        self.assertEqual(bounded_repr(range(10), max_items=3), "[0, 1, 2, ...]")
+        self.assertEqual(bounded_repr({1: (1, 2, 3)}, max_items=2), "{1: (1, 2, ...)}")
+
+    def test_lazy(self):
+        # only the part of a huge container which is consumed gets walked
+        big = dict.fromkeys(xrange(1000000))
+        pieces = display.iter_repr(big)
+        self.assertEqual(next(pieces), '{')
+        self.assertEqual(next(pieces), '0')
+
+if __name__ == '__main__':
+    unittest.main()
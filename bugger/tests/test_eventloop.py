@@ -0,0 +1,137 @@
+import os
+import select
+import socket
+import sys
+import threading
+import time
+import unittest
+
+# TODO: hack!
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from bugger import eventloop
+
+class PollerTestMixin(object):
+    # Tests shared by all poller backends.  Subclasses provide make_poller()
+
+    def setUp(self):
+        self.poller = self.make_poller()
+        self.pairs = []
+
+    def tearDown(self):
+        for a, b in self.pairs:
+            a.close()
+            b.close()
+        self.poller.close()
+
+    def _socketpair(self):
+        pair = socket.socketpair()
+        self.pairs.append(pair)
+        return pair
+
+    def test_idle_poll_times_out(self):
+        a, _b = self._socketpair()
+        self.poller.register(a.fileno(), eventloop.EVENT_READ)
+        self.assertEqual(list(self.poller.poll(0.01)), [])
+
+    def test_only_ready_fds_reported(self):
+        idle = [self._socketpair() for _ in range(20)]
+        for a, _b in idle:
+            self.poller.register(a.fileno(), eventloop.EVENT_READ)
+        active, peer = self._socketpair()
+        self.poller.register(active.fileno(), eventloop.EVENT_READ)
+        peer.send('x')
+        self.assertEqual(list(self.poller.poll(1.0)),
+                         [(active.fileno(), eventloop.EVENT_READ)])
+
+    def test_modify_and_unregister(self):
+        a, _b = self._socketpair()
+        self.poller.register(a.fileno(), eventloop.EVENT_READ)
+        self.poller.modify(a.fileno(), eventloop.EVENT_READ | eventloop.EVENT_WRITE)
+        self.assertEqual(list(self.poller.poll(1.0)),
+                         [(a.fileno(), eventloop.EVENT_WRITE)])
+        self.poller.unregister(a.fileno())
+        self.assertEqual(list(self.poller.poll(0.01)), [])
+
+    def test_hangup_reported_as_read(self):
+        a, b = self._socketpair()
+        self.poller.register(a.fileno(), eventloop.EVENT_READ)
+        b.close()
+        self.assertEqual(list(self.poller.poll(1.0)),
+                         [(a.fileno(), eventloop.EVENT_READ)])
+        self.assertEqual(a.recv(1), '')
+
+@unittest.skipUnless(hasattr(select, 'epoll'), "epoll not available")
+class TestEpollPoller(PollerTestMixin, unittest.TestCase):
+    make_poller = eventloop.EpollPoller
+
+@unittest.skipUnless(hasattr(select, 'poll'), "poll not available")
+class TestPollPoller(PollerTestMixin, unittest.TestCase):
+    make_poller = eventloop.PollPoller
+
+class TestSelectPoller(PollerTestMixin, unittest.TestCase):
+    make_poller = eventloop.SelectPoller
+
+class TestWaker(unittest.TestCase):
+
+    def setUp(self):
+        self.poller = eventloop.default_poller()
+        self.waker = eventloop.Waker()
+        self.poller.register(self.waker.fileno(), eventloop.EVENT_READ)
+
+    def tearDown(self):
+        self.poller.close()
+        self.waker.close()
+
+    def test_wake_from_other_thread(self):
+        timer = threading.Timer(0.05, self.waker.wake)
+        timer.start()
+        start = time.time()
+        self.assertEqual(list(self.poller.poll(5.0)),
+                         [(self.waker.fileno(), eventloop.EVENT_READ)])
+        self.assertTrue(time.time() - start < 1.0)
+        timer.join()
+
+    def test_wakeups_coalesce_until_drained(self):
+        for _ in range(100000): # more than fits in the pipe
+            self.waker.wake()
+        self.assertEqual(len(self.poller.poll(0)), 1)
+        self.waker.drain()
+        self.assertEqual(list(self.poller.poll(0.01)), [])
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.wheel = eventloop.TimerWheel(resolution=1.0, slots=8, clock=lambda: self.now)
+
+    def test_empty_wheel_has_no_timeout(self):
+        self.assertEqual(self.wheel.timeout(), None)
+        self.assertEqual(self.wheel.expire(), [])
+
+    def test_expire_in_deadline_order(self):
+        self.wheel.schedule(2.5, 'b')
+        self.wheel.schedule(0.5, 'a')
+        self.wheel.schedule(30, 'c') # more than one revolution away
+        self.assertEqual(self.wheel.timeout(), 1.0)
+        self.now += 0.4
+        self.assertEqual(self.wheel.expire(), [])
+        self.now += 2.2
+        self.assertEqual(self.wheel.expire(), ['a', 'b'])
+        self.assertEqual(len(self.wheel), 1)
+        self.now += 27
+        self.assertEqual(self.wheel.expire(), [])
+        self.now += 1
+        self.assertEqual(self.wheel.expire(), ['c'])
+        self.assertEqual(self.wheel.timeout(), None)
+
+    def test_cancel(self):
+        timer = self.wheel.schedule(1, 'a')
+        self.wheel.cancel(timer)
+        self.wheel.cancel(timer)
+        self.assertEqual(len(self.wheel), 0)
+        self.now += 2
+        self.assertEqual(self.wheel.expire(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import StringIO
+import sys
+import tempfile
+import threading
+import unittest
+
+# TODO: hack!
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from bugger import console
+from bugger import fleet
+
+class TestRegistry(unittest.TestCase):
+
+    def test_read_registry(self):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        os.write(fd, "# workers\n/tmp/bugger-101.sock\n\nlocalhost:7071\n:7072\n/tmp/bugger-101.sock\n")
+        os.close(fd)
+        self.assertEqual(fleet.read_registry(path),
+                         ['/tmp/bugger-101.sock', ('localhost', 7071), ('127.0.0.1', 7072)])
+        self.assertEqual(fleet.read_registry(path + '.missing'), [])
+
+class TestFleetConsole(unittest.TestCase):
+    # Two "workers" (in this one process), answering on their JSON ports
+
+    HOST = '127.0.0.1'
+    JSON_PORTS = (5666, 5668)
+
+    def setUp(self):
+        self.servers = []
+        for i, json_port in enumerate(self.JSON_PORTS):
+            server = console.TelnetInteractiveConsoleServer(
+                host=self.HOST, port=json_port + 10, json_port=json_port,
+                locals={'worker': i})
+            server.listen()
+            thread = threading.Thread(target=server.accept_interactions)
+            thread.start()
+            self.servers.append((server, thread))
+        self.fleet = fleet.FleetConsole(
+            fleet.discover(range(5666, 5670), self.HOST), timeout=2.0)
+
+    def tearDown(self):
+        for server, thread in self.servers:
+            server.stop()
+            thread.join()
+
+    def test_discover(self):
+        self.assertEqual(self.fleet.targets, [(self.HOST, port) for port in self.JSON_PORTS])
+
+    def test_identical_answers_collapsed(self):
+        groups = self.fleet.broadcast("6 * 7", 'eval')
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(groups[0].text, '42')
+        self.assertEqual(groups[0].labels, [os.getpid(), os.getpid()])
+
+    def test_different_answers(self):
+        groups = self.fleet.broadcast("worker", 'eval')
+        self.assertEqual(sorted(group.text for group in groups), ['0', '1'])
+
+    def test_unreachable_worker(self):
+        self.fleet.targets.append((self.HOST, 5669))
+        groups = self.fleet.broadcast("1", 'eval')
+        self.assertEqual([group.text for group in groups][0], '1')
+        self.assertTrue(groups[1].text.startswith('ConnectionError'))
+        self.assertEqual(groups[1].describe(), '%s:5669' % self.HOST)
+
+    def test_push(self):
+        self.assertEqual(self.fleet.push("def f():"), (True, ''))
+        self.assertEqual(self.fleet.push("    return worker * 10"), (True, ''))
+        self.assertEqual(self.fleet.push(""), (False, "[pids %d, %d]\n" % (os.getpid(), os.getpid())))
+        more, output = self.fleet.push("f()")
+        self.assertFalse(more)
+        self.assertEqual(sorted(output.splitlines()),
+                         ["[pid %d] 0" % os.getpid(), "[pid %d] 10" % os.getpid()])
+        more, output = self.fleet.push("1 +")
+        self.assertTrue(output.startswith("SyntaxError"))
+
+    def test_interact(self):
+        stdout = StringIO.StringIO()
+        self.fleet.interact(StringIO.StringIO("print 'hi'\n%workers\n"), stdout)
+        self.assertEqual(stdout.getvalue().splitlines(), [
+            "2 workers",
+            "fleet>>> [pids %d, %d] hi" % (os.getpid(), os.getpid()),
+            "fleet>>> 2 workers",
+            "%s:5666 (pid %d)" % (self.HOST, os.getpid()),
+            "%s:5668 (pid %d)" % (self.HOST, os.getpid()),
+            "fleet>>> ",
+        ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import gc
+import os
+import sys
+import threading
+import types
+import unittest
+
+# TODO: hack!
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from bugger import heap
+
+class Leaky(object):
+    pass
+
+class TestCensus(unittest.TestCase):
+
+    def test_counts_by_type(self):
+        objects = [Leaky() for _ in range(1000)]
+        snapshot = heap.census(chunk_size=100)
+        count, size = snapshot.types['bugger.tests.test_heap.Leaky']
+        self.assertEqual(count, 1000)
+        self.assertEqual(size, 1000 * sys.getsizeof(objects[0]))
+        self.assertTrue(snapshot.count > 1000)
+        self.assertEqual(snapshot.top(1)[0][2], max(size for _count, size in snapshot.types.values()))
+
+    def test_untracked(self):
+        strings = ['leaky string %d' % i for i in range(1000)]
+        self.assertFalse(gc.is_tracked(strings[0]))
+        without = heap.census().types.get('str', (0, 0))[0]
+        counted = heap.census(untracked=True).types['str'][0]
+        self.assertTrue(counted >= without + 1000, (without, counted))
+
+    def test_gc_enabled_afterwards(self):
+        self.assertTrue(gc.isenabled())
+        heap.census(chunk_size=100, untracked=True)
+        self.assertTrue(gc.isenabled())
+
+    def test_other_threads_run_between_chunks(self):
+        progress = []
+        done = threading.Event()
+        def work():
+            while not done.is_set():
+                progress.append(1)
+                done.wait(0.0001)
+        thread = threading.Thread(target=work)
+        thread.start()
+        try:
+            del progress[:]
+            heap.census(chunk_size=500)
+            ran = len(progress)
+        finally:
+            done.set()
+            thread.join()
+        self.assertTrue(ran > 5, ran)
+
+    def test_diff(self):
+        before = heap.census()
+        objects = [Leaky() for _ in range(500)]
+        after = heap.census()
+        changes = heap.diff(before, after, limit=1000)
+        leaky = [change for change in changes if change[0] == 'bugger.tests.test_heap.Leaky']
+        self.assertEqual(leaky[0][1], len(objects))
+        self.assertEqual(heap.allocation_diff(before, after), [])
+
+def _hold(obj, ready, done):
+    ready.set()
+    done.wait()
+
+class TestRetentionPaths(unittest.TestCase):
+
+    def setUp(self):
+        self.module = types.ModuleType('bugger_test_leaky')
+        sys.modules[self.module.__name__] = self.module
+        self.target = Leaky()
+
+    def tearDown(self):
+        del sys.modules[self.module.__name__]
+
+    def _lines(self, result, index=0):
+        return list(heap.iter_path_lines(*result.paths[index]))
+
+    def test_path_from_module(self):
+        holder = Leaky()
+        holder.items = {'k': [1, 2, self.target]}
+        self.module.registry = [holder]
+        result = heap.find_retention_paths(self.target, extra_roots=[(self.__dict__, 'test case')])
+        self.assertEqual(result.paths[0][0], 'test case')
+        self.assertEqual(self._lines(result, 1), [
+            "module bugger_test_leaky",
+            "  ['registry'] -> list at 0x%x" % id(self.module.registry),
+            "  [0] -> bugger.tests.test_heap.Leaky at 0x%x" % id(holder),
+            "  .items -> dict at 0x%x" % id(holder.items),
+            "  ['k'] -> list at 0x%x" % id(holder.items['k']),
+            "  [2] -> bugger.tests.test_heap.Leaky at 0x%x" % id(self.target),
+        ])
+        self.assertFalse(result.limited)
+
+    def test_path_from_thread_stack(self):
+        obj, self.target = self.target, None
+        ready, done = threading.Event(), threading.Event()
+        thread = threading.Thread(name='holder', target=_hold, args=(obj, ready, done))
+        thread.start()
+        try:
+            ready.wait()
+            result = heap.find_retention_paths(obj, max_paths=1)
+        finally:
+            done.set()
+            thread.join()
+        self.assertTrue(result.paths[0][0].startswith('thread holder, frame _hold '))
+        self.assertEqual(self._lines(result)[1:], ["  local obj -> bugger.tests.test_heap.Leaky at 0x%x" % id(obj)])
+
+    def test_limits(self):
+        self.module.registry = [[[self.target]]]
+        result = heap.find_retention_paths(self.target, max_depth=2)
+        self.assertEqual(result.paths, [])
+        self.assertTrue(result.limited)
+        self.assertEqual(result.depth, 2)
+
+if __name__ == '__main__':
+    unittest.main()
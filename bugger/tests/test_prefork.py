@@ -0,0 +1,141 @@
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+# TODO: hack!
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from bugger import client
+from bugger import console
+from bugger import fleet
+from bugger import prefork
+
+COUNT_THREADS = "len([t for t in __import__('threading').enumerate() if t.name == 'bugger-console'])"
+
+class TestPreforkConsole(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _fork_worker(self, prefork_console):
+        # start a worker's console in a child, which waits to be told to exit
+        ready_r, ready_w = os.pipe()
+        exit_r, exit_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.close(exit_w)
+                prefork_console.start()
+                prefork_console.start()
+                os.write(ready_w, 'x')
+                os.read(exit_r, 1)
+                prefork_console.stop()
+                status = 0
+            finally:
+                os._exit(status)
+        self.addCleanup(self._kill_worker, pid)
+        os.close(ready_w)
+        os.close(exit_r)
+        self.assertEqual(os.read(ready_r, 1), 'x')
+        os.close(ready_r)
+        return pid, exit_w
+
+    def _join_worker(self, pid, exit_w):
+        os.write(exit_w, 'x') # later workers have a copy, so closing it isn't enough
+        os.close(exit_w)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+    def _kill_worker(self, pid):
+        # in case the test failed before the worker was told to exit
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+    def test_unix_workers(self):
+        prefork_console = prefork.PreforkConsole('unix', directory=self.directory)
+        parent_server = prefork_console.start() # inherited by the workers, and closed there
+        self.addCleanup(prefork_console.stop)
+        workers = [self._fork_worker(prefork_console) for i in range(2)]
+        pids = set(pid for pid, exit_w in workers)
+
+        addresses = fleet.read_registry(prefork_console.registry)
+        self.assertEqual(len(addresses), 3)
+        results = client.fan_out(addresses, "__import__('os').getpid()", timeout=5.0)
+        self.assertEqual(set(int(r['result']) for r in results.values()),
+                         pids | set([os.getpid()]))
+        results = client.fan_out(addresses, COUNT_THREADS, timeout=5.0)
+        self.assertEqual([r['result'] for r in results.values()], ['1', '1', '1'])
+
+        for pid, exit_w in workers:
+            self._join_worker(pid, exit_w)
+            self.assertFalse(os.path.exists(
+                os.path.join(self.directory, 'bugger-%d.json.sock' % pid)))
+        self.assertEqual(fleet.read_registry(prefork_console.registry),
+                         [parent_server.json_address])
+        connection = client.Connection(parent_server.address, 5.0, handshake=True)
+        self.addCleanup(connection.close)
+        self.assertEqual(connection.pid, os.getpid())
+
+    def test_start_once(self):
+        prefork_console = prefork.PreforkConsole('unix', directory=self.directory)
+        self.addCleanup(prefork_console.stop)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(prefork_console.start()))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(map(id, results))), 1)
+        connection = client.Connection(results[0].json_address, 5.0)
+        self.addCleanup(connection.close)
+        self.assertEqual(connection.eval(COUNT_THREADS), '1')
+
+    def test_port_base(self):
+        taken = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(taken.close)
+        taken.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        taken.bind(('127.0.0.1', 5665))
+        taken.listen(1)
+        prefork_console = prefork.PreforkConsole('port_base', directory=self.directory,
+                                                 port=5665, json_port=5675)
+        server = prefork_console.start()
+        self.addCleanup(prefork_console.stop)
+        self.assertEqual(prefork_console.worker_index, 1)
+        self.assertEqual(server.address, ('127.0.0.1', 5666))
+        self.assertEqual(fleet.read_registry(prefork_console.registry), [('127.0.0.1', 5676)])
+
+    def test_reuse_port(self):
+        servers = [console.TelnetInteractiveConsoleServer(host='127.0.0.1', port=5665,
+                                                          reuse_port=True) for i in range(2)]
+        for server in servers:
+            server.listen()
+            self.addCleanup(server.stop)
+        self.assertEqual(servers[1].address, ('127.0.0.1', 5665))
+
+class TestRegistry(unittest.TestCase):
+
+    def test_register(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'bugger.registry')
+        live = os.path.join(directory, 'live.sock')
+        open(live, 'w').close()
+        prefork.register(path, os.path.join(directory, 'gone.sock'))
+        prefork.register(path, live)
+        prefork.register(path, ('127.0.0.1', 7071))
+        self.assertEqual(fleet.read_registry(path), [live, ('127.0.0.1', 7071)])
+        prefork.unregister(path, live)
+        self.assertEqual(fleet.read_registry(path), [('127.0.0.1', 7071)])
+
+if __name__ == '__main__':
+    unittest.main()
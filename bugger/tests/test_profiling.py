@@ -0,0 +1,86 @@
+import cProfile
+import os
+import sys
+import threading
+import time
+import unittest
+
+# TODO: hack!
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from bugger import profiling
+
+def _leaf(n):
+    return sum(range(n))
+
+def _parent():
+    return [_leaf(1000) for _ in range(50)]
+
+class TestReport(unittest.TestCase):
+
+    def setUp(self):
+        self.profiler = cProfile.Profile()
+        self.profiler.runcall(_parent)
+
+    def test_ranked_by_cumulative_time(self):
+        lines = list(profiling.iter_report(self.profiler, limit=3))
+        self.assertTrue(lines[0].endswith("by cumulative time"))
+        self.assertTrue(lines[2].strip().endswith(
+            "_parent (test_profiling.py:%d)" % _parent.func_code.co_firstlineno), lines[2])
+        self.assertEqual(len(lines), 2 + 3 + 1)
+        self.assertTrue(lines[-1].endswith("more functions)"))
+
+    def test_self_time_and_recursion_counts(self):
+        lines = list(profiling.iter_report(self.profiler, sort='tottime', limit=10))
+        leaf = [line for line in lines if '_leaf' in line][0]
+        self.assertEqual(leaf.split()[0], '50')
+
+    def test_fits_width(self):
+        lines = list(profiling.iter_report(self.profiler, width=50))
+        for line in lines[1:]:
+            self.assertTrue(len(line) <= 50, line)
+        self.assertTrue(any('...' in line for line in lines))
+
+def _spin(stop):
+    while not stop.is_set():
+        _leaf(100)
+
+class TestSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.stop = threading.Event()
+        self.thread = threading.Thread(name='spinner', target=_spin, args=(self.stop,))
+        self.thread.start()
+
+    def tearDown(self):
+        self.stop.set()
+        self.thread.join()
+
+    def test_background_sampling(self):
+        sampler = profiling.Sampler(interval=0.002)
+        sampler.start()
+        time.sleep(0.2)
+        sampler.stop()
+        stats = sampler.stats()
+        self.assertFalse(stats['running'])
+        self.assertTrue(stats['samples'] > 10, stats)
+        self.assertTrue(stats['overhead'] < 0.5, stats)
+        spinning = [line for line in sampler.iter_collapsed() if line.startswith('spinner;')]
+        self.assertTrue(spinning)
+        self.assertTrue(all('_spin_(test_profiling.py' in line for line in spinning))
+        top = list(sampler.iter_top(limit=5))
+        self.assertTrue(any('_spin (' in line or '_leaf (' in line for line in top[2:]), top)
+
+    def test_stack_trie_bounded(self):
+        sampler = profiling.Sampler(max_depth=2, max_nodes=3)
+        for _ in range(10):
+            # this test's own stack is deep enough to be truncated
+            sampler.sample({-1: sys._getframe(), -2: sys._getframe(1)})
+        self.assertEqual(sampler.samples, 10)
+        self.assertTrue(sampler.nodes <= 3)
+        self.assertEqual(sampler.truncated, 20 + 10) # too deep, then out of nodes
+        counts = [int(line.rsplit(' ', 1)[1]) for line in sampler.iter_collapsed()]
+        self.assertEqual(sum(counts), 20)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import os
+import sys
+import thread
+import threading
+import time
+import unittest
+
+# TODO: hack!
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from bugger import threads
+
+def _hold(lock, ready, marker='x' * 100): # marker is shown with the locals
+    ready.set()
+    lock.acquire()
+    lock.release()
+
+class TestThreadDumper(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.lock.acquire()
+        ready = threading.Event()
+        self.thread = threading.Thread(name='stuck-worker', target=_hold, args=(self.lock, ready))
+        self.thread.daemon = True
+        self.thread.start()
+        ready.wait()
+        # wait for it to reach lock.acquire()
+        acquire_line = _hold.func_code.co_firstlineno + 2
+        deadline = time.time() + 2.0
+        while sys._current_frames()[self.thread.ident].f_lineno != acquire_line and \
+                time.time() < deadline:
+            time.sleep(0.001)
+        self.dumper = threads.ThreadDumper()
+
+    def tearDown(self):
+        self.lock.release()
+        self.thread.join()
+
+    def _dump(self, name_filter=None):
+        return list(self.dumper.iter_dump(name_filter))
+
+    def test_dump(self):
+        lines = self._dump()
+        header = [line for line in lines if line.startswith('Thread "stuck-worker"')]
+        self.assertEqual(len(header), 1)
+        self.assertTrue(', daemon' in header[0])
+        self.assertTrue(any(line.startswith('Thread "MainThread"') and 'this console' in line
+                            for line in lines))
+        stuck = '\n'.join(lines[lines.index(header[0]):]).split('\n')
+        self.assertTrue('    lock.acquire()' in stuck)
+        locals_line = [line for line in stuck if line.startswith('  locals: ')][0]
+        self.assertTrue("marker='xxxxxxxxx" in locals_line)
+        self.assertTrue("...," in locals_line) # long repr shortened
+
+    def test_blocked_on_second_dump(self):
+        first = self._dump('stuck')
+        self.assertFalse('BLOCKED' in first[0])
+        second = self._dump('stuck')
+        self.assertTrue(second[0].endswith('BLOCKED? waiting on a lock at the same place as the last dump'))
+        self.assertFalse(any(line.startswith('Thread "MainThread"') for line in second))
+
+def _lock_both(first, second, ready, go):
+    try:
+        with first:
+            ready.set()
+            go.wait()
+            with second:
+                pass
+    except thread.error: # a lock released by the test, to end the deadlock
+        pass
+
+class TestDeadlock(unittest.TestCase):
+    # Two threads taking the same two locks in opposite orders with ``with``
+
+    def setUp(self):
+        self.locks = [threading.Lock(), threading.Lock()]
+        go = threading.Event()
+        self.threads = []
+        for i, name in enumerate(['deadlock-a', 'deadlock-b']):
+            ready = threading.Event()
+            deadlocked = threading.Thread(name=name, target=_lock_both,
+                                          args=(self.locks[i], self.locks[1 - i], ready, go))
+            deadlocked.daemon = True
+            deadlocked.start()
+            ready.wait()
+            self.threads.append(deadlocked)
+        go.set()
+        inner_with = _lock_both.func_code.co_firstlineno + 5
+        deadline = time.time() + 2.0
+        while time.time() < deadline and any(
+                sys._current_frames()[t.ident].f_lineno != inner_with for t in self.threads):
+            time.sleep(0.001)
+
+    def tearDown(self):
+        self.locks[0].release() # enough to let both finish
+        for deadlocked in self.threads:
+            deadlocked.join()
+
+    def test_blocked_in_with(self):
+        dumper = threads.ThreadDumper()
+        list(dumper.iter_dump('deadlock'))
+        headers = [line for line in dumper.iter_dump('deadlock') if line.startswith('Thread ')]
+        self.assertEqual(len(headers), 2)
+        for header in headers:
+            self.assertTrue(header.endswith('BLOCKED? waiting on a lock at the same place '
+                                            'as the last dump'), header)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+"""Stack dumps of every thread in the process, for the ``%threads`` command
+
+Formatting stacks with ``traceback`` stats the source file of every frame
+(``linecache.checkcache``) on every call.  ``ThreadDumper`` reads source lines
+straight from the ``linecache`` cache instead and keeps the text of each
+frame it formats, keyed by code object and line, since most threads of a
+process sit in the same few places.  Repeated dumps cost little more than
+walking the frames.
+
+Each dump is compared with the previous one: a thread which is waiting to
+acquire a lock in the same place both times is flagged as possibly blocked.
+"""
+import dis
+import linecache
+import os
+import sys
+import threading
+
+from bugger.display import iter_repr
+
+LOCAL_REPR_SIZE = 40 # characters of each local's repr shown
+MAX_LOCALS = 12 # locals shown for the innermost frame of each thread
+MAX_FORMATTED = 10000 # formatted frames kept for reuse by later dumps
+
+_SETUP_WITH = dis.opmap['SETUP_WITH']
+
+
+def _short_repr(value, size=LOCAL_REPR_SIZE):
+    pieces = []
+    length = 0
+    try:
+        for piece in iter_repr(value, max_depth=1, max_items=4):
+            pieces.append(piece)
+            length += len(piece)
+            if length > size:
+                break
+    except Exception:
+        return '<%s (repr failed)>' % type(value).__name__
+    text = ''.join(pieces)
+    return text if len(text) <= size else text[:size - 3] + '...'
+
+
+def _waiting_on_lock(frame, line):
+    """Guess whether a frame is blocked acquiring a lock
+
+    A frame entering a ``with`` block is taken to be waiting on a lock too:
+    ``Lock.__enter__`` has no frame of its own.
+    """
+    code = frame.f_code
+    if '.acquire(' in line or ord(code.co_code[frame.f_lasti]) == _SETUP_WITH:
+        return True
+    return os.path.basename(code.co_filename).startswith('threading.py') and \
+        code.co_name in ('wait', 'acquire', 'join', '_wait_for_tstate_lock')
+
+
+class ThreadDumper(object):
+    """Formats the stacks of all threads, remembering where each one waited"""
+
+    def __init__(self):
+        self._waiting = {} # thread ident -> (code, lineno, depth) it waited at
+        self._formatted = {} # (code, lineno) -> text describing a frame there
+
+    def _format_frame(self, frame):
+        key = (frame.f_code, frame.f_lineno)
+        text = self._formatted.get(key)
+        if text is None:
+            code = frame.f_code
+            text = '  File "%s", line %d, in %s' % (code.co_filename, frame.f_lineno, code.co_name)
+            source = linecache.getline(code.co_filename, frame.f_lineno, frame.f_globals)
+            if source:
+                text += '\n    ' + source.strip()
+            if len(self._formatted) >= MAX_FORMATTED:
+                self._formatted.clear()
+            self._formatted[key] = text
+        return text
+
+    def iter_dump(self, name_filter=None, frames=None):
+        """Generate the lines of a dump of every thread's stack
+
+        Only threads whose name contains ``name_filter`` are shown (but all
+        are checked for being blocked).  Stacks are listed innermost frame
+        last, like a traceback, followed by the locals of the innermost frame.
+        """
+        if frames is None:
+            frames = sys._current_frames()
+        threads = dict((t.ident, t) for t in threading.enumerate())
+        current = threading.current_thread().ident
+        waiting = {}
+        for ident, frame in sorted(frames.iteritems()):
+            thread = threads.get(ident)
+            name = thread.name if thread is not None else '<unknown>'
+            stack = []
+            while frame is not None:
+                stack.append(frame)
+                frame = frame.f_back
+            innermost = stack[0]
+            code, lineno = innermost.f_code, innermost.f_lineno
+            line = linecache.getline(code.co_filename, lineno, innermost.f_globals).strip()
+            blocked = False
+            if _waiting_on_lock(innermost, line):
+                waiting[ident] = place = (code, lineno, len(stack))
+                blocked = self._waiting.get(ident) == place
+            if name_filter and name_filter not in name:
+                continue
+
+            notes = []
+            if thread is not None and thread.daemon:
+                notes.append('daemon')
+            if ident == current:
+                notes.append('this console')
+            if blocked:
+                notes.append('BLOCKED? waiting on a lock at the same place as the last dump')
+            yield 'Thread "%s" (%d)%s' % (name, ident, ''.join(', ' + n for n in notes))
+            yield '\n'.join([self._format_frame(stack_frame) for stack_frame in reversed(stack)])
+            if innermost.f_locals is not innermost.f_globals:
+                local_items = sorted(innermost.f_locals.items())
+                if local_items:
+                    summary = ', '.join('%s=%s' % (key, _short_repr(value))
+                                        for key, value in local_items[:MAX_LOCALS])
+                    if len(local_items) > MAX_LOCALS:
+                        summary += ', ... (%d more)' % (len(local_items) - MAX_LOCALS)
+                    yield '  locals: ' + summary
+            yield ''
+        self._waiting = waiting